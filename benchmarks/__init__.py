@@ -0,0 +1,3 @@
+"""
+性能計測用のスクリプト群。リポジトリ直下から python -m benchmarks.<名前> で実行する。
+"""
@@ -0,0 +1,66 @@
+"""
+結合処理の比較: 従来の「ページごとに PdfReader を作って PdfMerger.append する」方法と
+webtools_common.pdf_merge (元PDFを1回だけ開く) の処理時間と出力サイズを比べる。
+
+    python -m benchmarks.bench_merge --pages 60 150 300 600
+
+3つの元PDFのページを交互に並べた順序で結合する (画面でページを並び替えた場合に相当)。
+ページあたりの時間がページ数によらずほぼ一定なら、処理時間はページ数に比例している。
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from PyPDF2 import PdfMerger, PdfReader
+
+from benchmarks.corpus import make_pdf
+from webtools_common.pdf_merge import merge_pages
+
+SOURCES = 3
+
+
+def legacy_merge(pages, output):
+    """最適化前の execute_merge と同じ処理 (1ページごとに PdfReader を開き直して PdfMerger で追加する)。"""
+    merger = PdfMerger()
+    for pdf_path, page_index in pages:
+        reader = PdfReader(pdf_path)
+        merger.append(reader, pages=(page_index, page_index + 1))
+    merger.write(output)
+    merger.close()
+
+
+def _measure(func, pages, output):
+    start = time.perf_counter()
+    func(pages, output)
+    elapsed = time.perf_counter() - start
+    return elapsed, os.path.getsize(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[60, 150, 300, 600],
+                        help='結合後の総ページ数 (複数指定可)')
+    parser.add_argument('--kind', choices=['text', 'scan'], default='text')
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'legacy s':>9} {'ms/page':>8} {'size KB':>9} "
+          f"{'engine s':>9} {'ms/page':>8} {'size KB':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for total in args.pages:
+            per_source = -(-total // SOURCES)
+            sources = [make_pdf(os.path.join(tmp_dir, f"src{n}_{total}.pdf"), per_source, args.kind, seed=n)
+                       for n in range(SOURCES)]
+            order = [(sources[i % SOURCES], i // SOURCES) for i in range(total)]
+
+            legacy_s, legacy_size = _measure(legacy_merge, order, os.path.join(tmp_dir, 'legacy.pdf'))
+            engine_s, engine_size = _measure(merge_pages, order, os.path.join(tmp_dir, 'engine.pdf'))
+            assert len(PdfReader(os.path.join(tmp_dir, 'engine.pdf')).pages) == total
+
+            print(f"{total:>6} {legacy_s:>9.2f} {legacy_s / total * 1000:>8.1f} {legacy_size / 1024:>9.0f} "
+                  f"{engine_s:>9.2f} {engine_s / total * 1000:>8.1f} {engine_size / 1024:>9.0f} "
+                  f"{legacy_s / engine_s:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
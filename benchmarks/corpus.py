@@ -0,0 +1,118 @@
+"""
+ベンチマーク用の合成PDFを生成する。外部のPDFやフォントは使わず、毎回同じ内容になる。
+
+- text: 全ページで同じフォントとロゴ画像を共有し、ページごとに数十行のテキストを持つ
+- scan: ページごとに別々のグレースケール画像を1枚ずつ持つ (スキャン文書の代わり)
+
+CORPORA は総ページ数から「どんな構成のPDFを何冊作るか」を決める関数の表で、
+benchmarks.suite が使う。
+"""
+import os
+import random
+import zlib
+
+from PyPDF2 import PageObject, PdfWriter
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+A4 = (595, 842)
+
+
+def _image(writer, width, height, data):
+    image = StreamObject()
+    image._data = zlib.compress(data)
+    image.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Image'),
+        NameObject('/Width'): NumberObject(width),
+        NameObject('/Height'): NumberObject(height),
+        NameObject('/ColorSpace'): NameObject('/DeviceGray'),
+        NameObject('/BitsPerComponent'): NumberObject(8),
+        NameObject('/Filter'): NameObject('/FlateDecode'),
+    })
+    return writer._add_object(image)
+
+
+def _scan_bytes(rng, width, height):
+    # ノイズだけだと現実のスキャンより縮まないので、行ごとに同じ値を並べた帯を混ぜる
+    rows = []
+    for _ in range(height):
+        if rng.random() < 0.7:
+            rows.append(bytes([rng.randrange(200, 256)]) * width)
+        else:
+            rows.append(rng.randbytes(width))
+    return b''.join(rows)
+
+
+def make_pdf(path, pages, kind='text', seed=0, scan_size=(850, 1100)):
+    rng = random.Random(seed)
+    writer = PdfWriter()
+
+    font = writer._add_object(DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/Helvetica'),
+    }))
+    logo = _image(writer, 128, 128, bytes(rng.randrange(256) for _ in range(128 * 128)))
+
+    for i in range(pages):
+        page = writer.add_page(PageObject.create_blank_page(None, *A4))
+        xobjects = DictionaryObject({NameObject('/Logo'): logo})
+        ops = [b'q 64 0 0 64 40 760 cm /Logo Do Q']
+        if kind == 'scan':
+            width, height = scan_size
+            xobjects[NameObject('/Scan')] = _image(writer, width, height, _scan_bytes(rng, width, height))
+            ops.append(b'q 595 0 0 842 0 0 cm /Scan Do Q')
+        ops.append(b'BT /F1 11 Tf 40 740 Td 14 TL')
+        for line in range(40 if kind == 'text' else 2):
+            words = ' '.join(f"w{rng.randrange(10000)}" for _ in range(10))
+            ops.append(f"(Page {i + 1} line {line + 1}: {words}) '".encode('ascii'))
+        ops.append(b'ET')
+
+        content = DecodedStreamObject()
+        content.set_data(b'\n'.join(ops))
+        page[NameObject('/Contents')] = writer._add_object(content)
+        page[NameObject('/Resources')] = DictionaryObject({
+            NameObject('/Font'): DictionaryObject({NameObject('/F1'): font}),
+            NameObject('/XObject'): xobjects,
+            NameObject('/ProcSet'): ArrayObject([NameObject('/PDF'), NameObject('/Text'), NameObject('/ImageB')]),
+        })
+
+    with open(path, 'wb') as f:
+        writer.write(f)
+    return path
+
+
+# 名前 -> 総ページ数から (ページ数, 種類, スキャン画像の大きさ) のリストを返す関数
+CORPORA = {
+    # 1冊のテキスト文書
+    'text': lambda pages: [(pages, 'text', None)],
+    # 1冊のスキャン文書 (画像は小さめにして 1000 ページでも扱える大きさに抑える)
+    'scan': lambda pages: [(pages, 'scan', (425, 550))],
+    # 2ページずつの小さな文書をたくさん
+    'many-small': lambda pages: [(2, 'text', None)] * max(1, pages // 2),
+    # 大きなスキャン画像のページを持つ文書が2冊
+    'few-huge': lambda pages: [(max(1, pages // 2), 'scan', (850, 1100))] * 2,
+}
+
+
+def make_corpus(directory, name, pages):
+    """
+    CORPORA[name] の構成で合成PDFを directory に作り、パスのリストを返す。
+    同じ名前・ページ数のファイルが既にあれば作り直さない (内容は毎回同じなので)。
+    """
+    paths = []
+    for n, (doc_pages, kind, scan_size) in enumerate(CORPORA[name](pages)):
+        path = os.path.join(directory, f"{name}-{pages}-{n}.pdf")
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            make_pdf(tmp_path, doc_pages, kind, seed=n, **({'scan_size': scan_size} if scan_size else {}))
+            os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
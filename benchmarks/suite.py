@@ -0,0 +1,369 @@
+"""
+分割・結合・サムネイル生成の一連の処理を合成PDFで計測し、結果をJSONで保存・比較する。
+
+    python -m benchmarks.suite run --out results.json
+    python -m benchmarks.suite run --sizes 10 100 1000 --corpora text scan --out results.json
+    python -m benchmarks.suite compare baseline.json results.json --threshold 0.2
+
+計測対象 (TARGETS) は実際の Flask のエンドポイントをテストクライアントから呼ぶ。
+1ケース (対象 × コーパス × ページ数) ごとに子プロセスを起動し、作業用ディレクトリ
+(ワークスペース・ストレージ・描画キャッシュ・ジョブ) も毎回空の状態から始めるので、
+ピークRSSやキャッシュの状態が他のケースの影響を受けない。
+
+記録する値:
+
+- wall_s: 処理時間 (秒、--repeat 回のうち最短)
+- peak_rss_kb: ケース実行中のPythonプロセスの最大RSS
+- child_peak_rss_kb: 子プロセス (pdfinfo / pdftoppm) の最大RSS。Linux では fork した時点の
+  親のRSSを引き継ぐので、親より小さな値にはならない (子プロセスを起動しなければ 0)
+- subprocesses: 起動した子プロセスの数
+- optimize_s: 出力の最適化 (pdf_optimize の optimize / optimize_write / qpdf の段階) にかかった時間の合計
+- qpdf_runs: qpdf を起動した回数
+- output_bytes: レスポンスまたは出力ファイルの大きさ
+
+compare は2つの結果ファイルで共通するケースを比べ、いずれかの値が threshold を超えて
+増えていれば終了コード 1 を返す (CI で使う想定)。
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import CORPORA, make_corpus
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+METRICS = ('wall_s', 'peak_rss_kb', 'child_peak_rss_kb', 'subprocesses', 'output_bytes', 'optimize_s', 'qpdf_runs')
+
+# ジョブの完了を待つ間隔 (秒)
+_POLL_INTERVAL = 0.01
+
+
+# --- 計測対象 ---
+# setup(module, client, pdf_paths) は計測前の準備をして状態を返し、run(module, client, state) が計測される処理。
+# run は出力のバイト数を返す。
+
+def _load_app(name):
+    """pdf-merger/app.py などを読み込む (どちらもモジュール名が app なので、パスから直接読む)。"""
+    path = os.path.join(REPO_ROOT, name, 'app.py')
+    spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_app", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # Flask はこれを見てテンプレートの場所を決める
+    spec.loader.exec_module(module)
+    # 計測したいのは処理の速さなので、アップロードサイズの上限は外す
+    module.app.config['MAX_CONTENT_LENGTH'] = None
+    return module
+
+
+def _wait_job(client, status_url):
+    while True:
+        job = client.get(status_url).get_json()
+        if job['status'] == 'error':
+            raise RuntimeError(f"job failed: {job.get('message')}")
+        if job['state'] == 'done':
+            return job
+        time.sleep(_POLL_INTERVAL)
+
+
+def _split_points(page_count):
+    step = max(1, page_count // 10)
+    return list(range(step, page_count, step))
+
+
+def _page_count(pdf_path):
+    from PyPDF2 import PdfReader
+    return len(PdfReader(pdf_path).pages)
+
+
+def _upload_to_splitter(client, pdf_path):
+    with open(pdf_path, 'rb') as f:
+        response = client.post('/preview', data={'file': (f, os.path.basename(pdf_path))})
+    assert response.status_code == 200, response.status_code
+    return response
+
+
+def _upload_to_merger(client, pdf_paths):
+    files = [open(path, 'rb') for path in pdf_paths]
+    try:
+        response = client.post('/main', data={
+            'pdf_files': [(f, os.path.basename(path)) for f, path in zip(files, pdf_paths)],
+        })
+    finally:
+        for f in files:
+            f.close()
+    assert response.status_code == 200, response.status_code
+
+
+class SplitByPoints:
+    app = 'pdf-splitter'
+    corpora = ('text', 'scan', 'few-huge')
+
+    def setup(self, module, client, pdf_paths):
+        return pdf_paths[0], _split_points(_page_count(pdf_paths[0]))
+
+    def run(self, module, client, state):
+        from webtools_common.pdf_io import open_pdf_reader
+        pdf_path, split_points = state
+        with open_pdf_reader(pdf_path) as reader:
+            parts = module.split_pdf_by_points(reader, split_points + [len(reader.pages)], 'bench')
+        return sum(len(data.getvalue()) for _, data in parts)
+
+
+class SplitterPreview:
+    app = 'pdf-splitter'
+    corpora = ('text', 'scan', 'few-huge')
+
+    def setup(self, module, client, pdf_paths):
+        return pdf_paths[0]
+
+    def run(self, module, client, pdf_path):
+        return len(_upload_to_splitter(client, pdf_path).data)
+
+
+class SplitterDownload:
+    app = 'pdf-splitter'
+    corpora = ('text', 'scan', 'few-huge')
+
+    def setup(self, module, client, pdf_paths):
+        _upload_to_splitter(client, pdf_paths[0])
+        points = _split_points(_page_count(pdf_paths[0]))
+        client.post('/confirm', data={'split_points': ','.join(map(str, points))})
+
+    def run(self, module, client, state):
+        job = client.post('/download').get_json()
+        _wait_job(client, job['status_url'])
+        return len(client.get(job['result_url']).data)
+
+
+# ブラウザが画面遷移のときに送る Accept (WebP を受け付ける)
+_BROWSER_ACCEPT = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8'
+
+
+class MergerEditPdf:
+    """編集画面の表示から、サムネイル生成ジョブの完了とストリップ (WebP) の取得までを計測する。"""
+    app = 'pdf-merger'
+    corpora = tuple(CORPORA)
+
+    def setup(self, module, client, pdf_paths):
+        _upload_to_merger(client, pdf_paths)
+
+    def run(self, module, client, state):
+        response = client.get('/edit_pdf', headers={'Accept': _BROWSER_ACCEPT})
+        match = re.search(rb"fetch\('(/jobs/[0-9a-f]+)'\)", response.data)
+        if match:
+            _wait_job(client, match.group(1).decode())
+        size = len(response.data)
+        for url in re.findall(rb'data-strips-url="([^"]+)"', response.data):
+            index = client.get(url.decode().replace('&amp;', '&')).get_json()
+            for strip in index.get('strips', []):
+                size += len(client.get(strip['url'], headers={'Accept': 'image/webp,*/*;q=0.8'}).data)
+        return size
+
+
+class MergerExecuteMerge:
+    """全文書のページを交互に並べた順序での結合 (ジョブ完了と結果の取得まで) を計測する。"""
+    app = 'pdf-merger'
+    corpora = tuple(CORPORA)
+
+    def setup(self, module, client, pdf_paths):
+        _upload_to_merger(client, pdf_paths)
+        with client.session_transaction() as session:
+            pdfs = [(pdf['id'], _page_count(pdf['path'])) for pdf in session['pdf_files']]
+        order = []
+        for page_index in range(max(count for _, count in pdfs)):
+            order.extend({'pdf_id': pdf_id, 'page_index': page_index}
+                         for pdf_id, count in pdfs if page_index < count)
+        client.post('/update_global_page_order', json={'order': order})
+
+    def run(self, module, client, state):
+        job = client.post('/execute_merge').get_json()
+        _wait_job(client, job['status_url'])
+        return len(client.get('/download').data)
+
+
+TARGETS = {
+    'split_pdf_by_points': SplitByPoints(),
+    'splitter_preview': SplitterPreview(),
+    'splitter_download': SplitterDownload(),
+    'merger_edit_pdf': MergerEditPdf(),
+    'merger_execute_merge': MergerExecuteMerge(),
+}
+
+
+# --- 1ケースの実行 (子プロセス側) ---
+
+class _SubprocessCounter:
+    """subprocess.Popen の起動回数を数える (pdf2image は Popen で pdftoppm を起動する)。"""
+
+    def __init__(self):
+        self.count = 0
+        original_init = subprocess.Popen.__init__
+
+        def counting_init(popen, *args, **kwargs):
+            self.count += 1
+            original_init(popen, *args, **kwargs)
+
+        subprocess.Popen.__init__ = counting_init
+
+
+def _stage_totals():
+    """段階ごとの (合計秒数, 回数)。このプロセスで記録された分だけ (計測の前後の差を取る)。"""
+    from webtools_common.instrumentation import STAGE_SECONDS
+
+    with STAGE_SECONDS._lock:
+        return {key[0]: (entry[-2], entry[-1]) for key, entry in STAGE_SECONDS._values.items()}
+
+
+def _run_case(target_name, pdf_paths):
+    target = TARGETS[target_name]
+    with tempfile.TemporaryDirectory(prefix='webtools_bench_') as work_dir:
+        for var in ('WORKSPACE_DIR', 'STORAGE_DIR', 'RENDER_CACHE_DIR', 'JOB_DIR', 'METRICS_DIR',
+                    'RENDER_GOVERNOR_DIR'):
+            os.environ[var] = os.path.join(work_dir, var.lower())
+        module = _load_app(target.app)
+        # 本番 (gunicorn --preload) と同じく、重いライブラリは計測の前に読み込んでおく
+        from webtools_common.app_factory import warm_up
+        warm_up()
+        client = module.app.test_client()
+        state = target.setup(module, client, pdf_paths)
+
+        counter = _SubprocessCounter()
+        stages_before = _stage_totals()
+        start = time.perf_counter()
+        output_bytes = target.run(module, client, state)
+        wall = time.perf_counter() - start
+        stages = {name: (seconds - stages_before.get(name, (0, 0))[0], count - stages_before.get(name, (0, 0))[1])
+                  for name, (seconds, count) in _stage_totals().items()}
+
+    # ru_maxrss は Linux では KB、macOS ではバイト
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return {
+        'wall_s': round(wall, 4),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        'child_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale,
+        'subprocesses': counter.count,
+        'output_bytes': output_bytes,
+        'optimize_s': round(sum(stages.get(name, (0, 0))[0] for name in ('optimize', 'optimize_write', 'qpdf')), 4),
+        'qpdf_runs': stages.get('qpdf', (0, 0))[1],
+    }
+
+
+# --- 全ケースの実行 (親プロセス側) ---
+
+def _case_in_subprocess(target_name, pdf_paths):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.suite', '_case', target_name, *pdf_paths],
+        cwd=REPO_ROOT, env=env, check=True, stdout=subprocess.PIPE, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(args):
+    os.makedirs(args.corpus_dir, exist_ok=True)
+    results = {}
+    for target_name in args.targets:
+        target = TARGETS[target_name]
+        for corpus in args.corpora:
+            if corpus not in target.corpora:
+                continue
+            for pages in args.sizes:
+                pdf_paths = make_corpus(args.corpus_dir, corpus, pages)
+                runs = [_case_in_subprocess(target_name, pdf_paths) for _ in range(args.repeat)]
+                result = {metric: max(r[metric] for r in runs) for metric in METRICS}
+                result['wall_s'] = min(r['wall_s'] for r in runs)
+                key = f"{target_name}/{corpus}/{pages}"
+                results[key] = result
+                print(f"{key:<40} {result['wall_s']:>8.3f}s {result['peak_rss_kb'] / 1024:>7.1f}MB "
+                      f"{result['subprocesses']:>4} proc {result['output_bytes'] / 1024:>9.0f}KB "
+                      f"opt {result['optimize_s']:.3f}s/{result['qpdf_runs']} qpdf", file=sys.stderr)
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'repeat': args.repeat,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+def compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)['results']
+
+    regressions = []
+    for key in sorted(set(baseline) & set(current)):
+        for metric in args.metrics:
+            if metric not in baseline[key] or metric not in current[key]:
+                continue  # 古い結果ファイルにはない値
+            before, after = baseline[key][metric], current[key][metric]
+            if metric == 'wall_s' and max(before, after) < args.min_wall:
+                continue  # 短すぎる処理時間は誤差の方が大きい
+            change = (after - before) / before if before else (1.0 if after else 0.0)
+            flag = 'REGRESSION' if change > args.threshold else ''
+            print(f"{key:<40} {metric:<18} {before:>12} {after:>12} {change:>+8.1%} {flag}")
+            if flag:
+                regressions.append((key, metric))
+
+    for key in sorted(set(baseline) ^ set(current)):
+        print(f"{key:<40} only in {'baseline' if key in baseline else 'current'}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='ベンチマークを実行して結果をJSONで出力する')
+    run_parser.add_argument('--targets', nargs='+', choices=list(TARGETS), default=list(TARGETS))
+    run_parser.add_argument('--corpora', nargs='+', choices=list(CORPORA), default=list(CORPORA))
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='総ページ数 (複数指定可)')
+    run_parser.add_argument('--repeat', type=int, default=1, help='各ケースの実行回数 (処理時間は最短を採る)')
+    run_parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'webtools_bench_corpus'),
+                            help='合成PDFの置き場所 (2回目以降は作り直さない)')
+    run_parser.add_argument('--out', help='結果の出力先 (省略時は標準出力)')
+
+    compare_parser = commands.add_parser('compare', help='2つの結果を比べ、悪化があれば終了コード 1 を返す')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.2, help='許容する増加率 (0.2 = 20%%)')
+    compare_parser.add_argument('--metrics', nargs='+', choices=METRICS, default=list(METRICS))
+    compare_parser.add_argument('--min-wall', type=float, default=0.05,
+                                help='両方がこの秒数未満なら処理時間は比べない')
+
+    case_parser = commands.add_parser('_case')  # 内部用: 1ケースを実行して結果を1行のJSONで出力する
+    case_parser.add_argument('target', choices=list(TARGETS))
+    case_parser.add_argument('pdf_paths', nargs='+')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    else:
+        print(json.dumps(_run_case(args.target, args.pdf_paths)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,76 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, jsonify
+from flask import render_template, request, redirect, url_for, session, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
 import os
-import tempfile
 import uuid
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
-import shutil
-from pdf2image import convert_from_path # For PDF to image conversion
-from io import BytesIO # For image processing in memory
-
-app = Flask(__name__)
-app.secret_key = 'your_secret_key_here'
-app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
+import json
+import logging
+from webtools_common import bulk, instrumentation
+from webtools_common.app_factory import create_app
+from webtools_common.http_cache import cached_response, not_modified, send_cached_file, version_token
+from webtools_common.instrumentation import stage
+from webtools_common.jobs import DONE, ERROR, JobQueue
+from webtools_common.pdf_io import open_pdf_reader
+from webtools_common.pdf_merge import merge_pages
+from webtools_common.pdf_optimize import PdfOptimizer
+from webtools_common.rasterize import missing_pages, render_documents
+from webtools_common.render_cache import RenderCache, file_digest, save_with_digest
+from webtools_common.render_governor import RenderBusy, estimate_cost, get_governor
+from webtools_common.storage import StorageManager
+from webtools_common.thumbnails import FORMATS, ThumbnailEncoder
+from webtools_common.uploads import ChunkedUploads, UploadError
+from webtools_common.workspace import WorkspaceStore, ensure_workspace_id
+
+# Working state lives server-side; the session cookie only carries a signed workspace id.
+# The page order is kept in its own compact table (see _set_page_order).
+workspace_store = WorkspaceStore.from_env('pdf-merger')
+
+# The factory sets the secret key from SECRET_KEY, installs the workspace session,
+# /metrics (request/stage timings) and the /healthz and /readyz endpoints.
+# PyPDF2 and pdf2image are imported where they are used and loaded by the warm-up
+# (see webtools_common/app_factory.py), which keeps cold start short.
+app = create_app(__name__, 'pdf-merger', workspace_store)
+# Per-request cap: multipart uploads and each chunk of a chunked upload (see /uploads below)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
-app.config['THUMBNAIL_FOLDER'] = os.path.join(tempfile.gettempdir(), 'pdf_thumbnails')
+app.config['THUMBNAIL_WIDTH'] = 200
 
-# Ensure thumbnail directory exists (exist_ok=True allows creation even if it exists)
-if not os.path.exists(app.config['THUMBNAIL_FOLDER']):
-    os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+# Use logger.debug("... %s", value) rather than f-strings so disabled levels cost nothing (LOG_LEVEL).
+logger = logging.getLogger(__name__)
+
+# Thumbnails live in a content-addressed disk cache shared with pdf-splitter,
+# so re-uploading the same PDF never runs poppler again.
+render_cache = RenderCache.from_env()
+
+# Thumbnails are served as WebP/JPEG when the browser accepts them, and the edit grid
+# loads each document as a few strips (many pages in one image) instead of one request per page.
+thumbnail_encoder = ThumbnailEncoder.from_env(render_cache)
+
+# Merges and thumbnail generation run in the background; pages poll /jobs/<job_id>
+job_queue = JobQueue.from_env('pdf-merger')
+
+# Uploads and merged outputs go into a per-workspace directory. A background
+# sweeper removes workspaces idle past their TTL and enforces a byte quota.
+storage = StorageManager.from_env('pdf-merger', workspace_store, job_queue)
+
+# Merged output goes through the shared size optimization (dedup, stream compression,
+# optional image downsampling via PDF_IMAGE_DPI, object streams when qpdf is installed)
+pdf_optimizer = PdfOptimizer.from_env()
+
+# Large PDFs are uploaded in resumable chunks written straight into the workspace
+# (UPLOAD_MAX_BYTES per file, UPLOAD_CHUNK_BYTES per request)
+chunked_uploads = ChunkedUploads.from_env(storage)
+
+# poppler runs are capped across all gunicorn workers (RENDER_MAX_CONCURRENT); page images
+# that cannot get a slot in time are answered with 503 and Retry-After
+render_governor = get_governor()
+
+instrumentation.register_stats('render_cache', render_cache.stats, fields=['bytes', 'max_bytes'])
+instrumentation.register_stats('storage', storage.stats, fields=['live_bytes', 'live_workspaces'],
+                               counters=['reclaimed_bytes'])
+instrumentation.register_stats('render_governor', render_governor.stats)
+
+@app.before_request
+def _start_storage_sweeper():
+    storage.ensure_sweeper()
 
 # Helper function to convert a PDF page to an image
 def _convert_pdf_page_to_image(pdf_path, page_num, desired_thumbnail_path):
@@ -24,29 +78,160 @@ def _convert_pdf_page_to_image(pdf_path, page_num, desired_thumbnail_path):
     指定されたPDFのページを画像に変換し、指定されたパスに保存するヘルパー関数。
     desired_thumbnail_path は、最終的に保存したい画像ファイルのフルパス。
     """
-    print(f"[DEBUG] _convert_pdf_page_to_image called for PDF: {pdf_path}, Page: {page_num + 1}, Desired path: {desired_thumbnail_path}")
+    from pdf2image import convert_from_path # For PDF to image conversion
+
+    logger.debug("_convert_pdf_page_to_image called for PDF: %s, Page: %d, Desired path: %s",
+                 pdf_path, page_num + 1, desired_thumbnail_path)
     try:
         # pdf2image.convert_from_path を使用して特定のページを画像に変換
         # page_num は0ベースなので、pdftoppmの-f/-lオプションと同様に+1する
-        images = convert_from_path(
-            pdf_path,
-            first_page=page_num + 1,
-            last_page=page_num + 1,
-            size=(200, None) # 幅を200pxにスケール (高さを自動調整)
-        )
+        cost = estimate_cost(1, app.config['THUMBNAIL_WIDTH'])
+        with render_governor.slot(cost, interactive=True), stage('rasterize', pages=1):
+            images = convert_from_path(
+                pdf_path,
+                first_page=page_num + 1,
+                last_page=page_num + 1,
+                size=(app.config['THUMBNAIL_WIDTH'], None) # 幅を200pxにスケール (高さを自動調整)
+            )
 
         if images:
             # 変換された画像（単一ページなのでリストの最初の要素）をPNGとして保存
-            images[0].save(desired_thumbnail_path, format='PNG')
-            print(f"[DEBUG] Thumbnail saved to {desired_thumbnail_path}")
+            with stage('encode_png', pages=1):
+                images[0].save(desired_thumbnail_path, format='PNG')
+            logger.debug("Thumbnail saved to %s", desired_thumbnail_path)
             return desired_thumbnail_path
         else:
-            print(f"[ERROR] pdf2image did not convert page {page_num + 1} from {pdf_path}")
+            logger.error("pdf2image did not convert page %d from %s", page_num + 1, pdf_path)
             return None
+    except RenderBusy:
+        raise  # Answered with 503 and Retry-After (see app_factory)
     except Exception as e:
-        print(f"[ERROR] An error occurred during PDF to image conversion using pdf2image: {e}")
+        logger.error("An error occurred during PDF to image conversion using pdf2image: %s", e)
         return None
 
+def _remember_job(job_id):
+    # Only jobs started from this session may be polled (keep the cookie small)
+    session['job_ids'] = (session.get('job_ids', []) + [job_id])[-10:]
+
+def _render_thumbnails_job(progress, documents, fmt):
+    """
+    Background thumbnail rendering. The result counts the pages that could not be
+    rendered; the job fails only when none of them could.
+    """
+    width = app.config['THUMBNAIL_WIDTH']
+    rendered = render_documents(render_cache, documents, width, progress=progress)
+    pages = {pdf_sha256: page_count for _, pdf_sha256, page_count in documents}
+    total = sum(pages.values())
+    done = sum(len(rendered.get(pdf_sha256, {})) for pdf_sha256 in pages)
+    if total and not done:
+        raise RuntimeError(f'Could not render any of the {total} thumbnails')
+    if done < total:
+        logger.warning("Rendered %d of %d thumbnails", done, total)
+    # Encode every strip now, one pass per strip, so the grid loads without waiting for encodes
+    for pdf_path, pdf_sha256, _ in documents:
+        thumbnail_encoder.encode_strips(pdf_path, pdf_sha256, width, fmt)
+    return {'pages': total, 'rendered': done, 'failed': total - done}
+
+def _merge_job(progress, pages, merged_path):
+    """
+    Background merge. pages is a list of (pdf_path, page_index, rotation) in output order.
+    Each source PDF is parsed once, however many of its pages are used.
+    """
+    report = merge_pages(pages, merged_path, progress=progress, optimizer=pdf_optimizer)
+    if not report: # Check if any pages were actually merged
+        raise ValueError('No valid pages were found to merge.')
+    logger.info("Merged %d pages into %d bytes (optimization saved %d bytes in %.3fs)",
+                report['pages'], report['bytes'], report['saved_bytes'], report['seconds'])
+    # The content hash is the ETag of /download
+    return {'merged_pdf': merged_path, 'merged_sha256': file_digest(merged_path), 'optimization': report}
+
+def _get_page_order():
+    """Current global page order as a list of (pdf_id, page_index)."""
+    return workspace_store.get_page_order(session.sid) if session.sid else []
+
+def _set_page_order(order):
+    workspace_store.set_page_order(ensure_workspace_id(session, workspace_store), order)
+
+def _find_pdf(pdfs, pdf_id):
+    return next((pdf for pdf in pdfs if pdf['id'] == pdf_id), None)
+
+def _normalize_edits(order, rotations, page_count, previous=None):
+    """
+    Validates a per-document edit list. order lists original page indexes (omitted
+    pages are deleted); rotations maps an original index (as a string, for JSON) to
+    clockwise degrees. When rotations is None the previous rotations are kept.
+    """
+    if not isinstance(order, list) or not order:
+        raise ValueError('order must be a non-empty list of page indexes')
+    for page_index in order:
+        if not isinstance(page_index, int) or not 0 <= page_index < page_count:
+            raise ValueError(f'page index {page_index!r} is out of range (0-{page_count - 1})')
+    if len(set(order)) != len(order):
+        raise ValueError('order contains duplicate pages')
+    if rotations is None:
+        rotations = (previous or {}).get('rotations', {})
+    normalized = {}
+    for page_index, degrees in rotations.items():
+        if not isinstance(degrees, int) or degrees % 90:
+            raise ValueError('rotations must be multiples of 90 degrees')
+        if int(page_index) in order and degrees % 360:
+            normalized[str(int(page_index))] = degrees % 360
+    return {'order': order, 'rotations': normalized}
+
+def _page_count(pdf_data):
+    """The document's page count, counted once and then kept with the session entry."""
+    if pdf_data.get('page_count') is None:
+        with stage('parse'), open_pdf_reader(pdf_data['path']) as reader:
+            pdf_data['page_count'] = len(reader.pages)
+        instrumentation.record_pages('parse', pdf_data['page_count'])
+    return pdf_data['page_count']
+
+def _document_pages(pdf_data, page_count):
+    """A document's pages after its edit list, as (original_index, rotation)."""
+    edits = pdf_data.get('edits') or {}
+    rotations = edits.get('rotations', {})
+    return [(i, rotations.get(str(i), 0)) for i in edits.get('order', range(page_count))]
+
+def _apply_document_edits(global_order, pdfs_in_session):
+    """
+    Applies the per-document edit lists to the global order (pdf_id, page_index) and
+    returns (pdf_id, page_index, rotation). Deleted pages are dropped, and the slots a
+    document occupies in the global order are refilled with its pages in edit order,
+    so moves between documents made on the edit page are kept.
+    """
+    edited = {pdf_id: pdf['edits'] for pdf_id, pdf in pdfs_in_session.items() if pdf.get('edits')}
+    ranks = {pdf_id: {page_index: n for n, page_index in enumerate(edits['order'])}
+             for pdf_id, edits in edited.items()}
+    slots = {}
+    result = []
+    for pdf_id, page_index in global_order:
+        if pdf_id in ranks and page_index not in ranks[pdf_id]:
+            continue # Deleted in the document's edit list
+        slots.setdefault(pdf_id, []).append(len(result))
+        result.append([pdf_id, page_index, 0])
+
+    for pdf_id, positions in slots.items():
+        if pdf_id not in edited:
+            continue
+        edits, rank = edited[pdf_id], ranks[pdf_id]
+        ordered = sorted((result[pos][1] for pos in positions), key=rank.__getitem__)
+        for pos, page_index in zip(positions, ordered):
+            result[pos][1] = page_index
+            result[pos][2] = edits['rotations'].get(str(page_index), 0)
+    return [tuple(page) for page in result]
+
+def _get_thumbnail(pdf_data, page_num):
+    """
+    サムネイルをキャッシュから取得し、なければ生成してキャッシュに格納する。
+    成功時はキャッシュ上のパス、失敗時は None を返す。
+    """
+    pdf_sha256 = pdf_data.get('sha256') or file_digest(pdf_data['path'])
+    return render_cache.get_or_render(
+        pdf_sha256, page_num,
+        lambda tmp_path: _convert_pdf_page_to_image(pdf_data['path'], page_num, tmp_path),
+        width=app.config['THUMBNAIL_WIDTH'],
+    )
+
 
 @app.route('/')
 def index():
@@ -56,25 +241,67 @@ def index():
 def upload():
     return render_template('upload.html')
 
+# Chunked, resumable uploads (protocol: see webtools_common/uploads.py). The page posts
+# the finished upload ids to /main; errors are answered by the handler in app_factory.
+
+def _upload_status(status):
+    return dict(status, upload_url=url_for('upload_chunk', upload_id=status['upload_id']))
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    body = request.get_json(silent=True) or {}
+    status = chunked_uploads.create(ensure_workspace_id(session, workspace_store),
+                                    body.get('filename'), body.get('size'), body.get('sha256'))
+    return jsonify(_upload_status(status)), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PATCH'])
+def upload_chunk(upload_id):
+    workspace_id = ensure_workspace_id(session, workspace_store)
+    if request.method == 'GET':
+        status = chunked_uploads.status(workspace_id, upload_id)
+    else:
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            raise UploadError('Send the chunk position as Upload-Offset.')
+        status = chunked_uploads.write_chunk(workspace_id, upload_id, offset, request.stream)
+    response = jsonify(_upload_status(status))
+    response.headers['Upload-Offset'] = str(status['offset'])
+    return response
+
 @app.route('/main', methods=['GET', 'POST'])
 def main():
     if request.method == 'POST':
         uploaded_files = request.files.getlist('pdf_files')
-        if not uploaded_files:
+        upload_ids = request.form.getlist('upload_ids')
+        if not uploaded_files and not upload_ids:
             return "PDFファイルを選択してください", 400
 
         pdf_list = []
+        # Files already received through /uploads (validated and page-counted on the last chunk)
+        for upload_id in upload_ids:
+            try:
+                upload = chunked_uploads.take(ensure_workspace_id(session, workspace_store), upload_id)
+            except UploadError as e:
+                return f"アップロードが見つかりません: {e.message}", 400
+            pdf_list.append({
+                'id': upload['upload_id'],
+                'filename': secure_filename(upload['filename']),
+                'path': upload['path'],
+                'sha256': upload['sha256'],
+                'page_count': upload['page_count']
+            })
         for file in uploaded_files:
             if file.filename == '':
                 continue
             filename = secure_filename(file.filename)
             unique_id = str(uuid.uuid4())
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{unique_id}_{filename}")
-            file.save(save_path)
+            save_path = storage.workspace_path(ensure_workspace_id(session, workspace_store), f"{unique_id}_{filename}")
+            pdf_sha256 = save_with_digest(file, save_path)
             pdf_list.append({
                 'id': unique_id,
                 'filename': filename,
-                'path': save_path
+                'path': save_path,
+                'sha256': pdf_sha256
             })
 
         session['pdf_files'] = pdf_list
@@ -85,152 +312,246 @@ def main():
 
 @app.route('/edit_pdf') # No longer takes pdf_id as argument
 def edit_pdf():
-    print("[DEBUG] /edit_pdf route accessed.")
+    logger.debug("/edit_pdf route accessed.")
     all_pdfs_data = []
     pdfs_in_session = session.get('pdf_files', [])
 
+    # First pass: count pages of every document (cheap, no rasterization)
+    documents = []
     for pdf_data in pdfs_in_session:
         pdf_id = pdf_data['id']
         pdf_path = pdf_data['path']
-        filename = pdf_data['filename']
 
         if not os.path.exists(pdf_path):
-            print(f"[WARNING] PDF file not found at {pdf_path} for PDF ID {pdf_id}. Skipping.")
+            logger.warning("PDF file not found at %s for PDF ID %s. Skipping.", pdf_path, pdf_id)
             continue
 
+        # Chunked uploads were already page-counted when their last chunk arrived
         try:
-            reader = PdfReader(pdf_path)
-            pages_data = []
-            for i in range(len(reader.pages)):
-                # Generate thumbnail and get its URL
-                thumbnail_filename = f"{pdf_id}_page_{i}.png"
-                thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-
-                print(f"[DEBUG] Checking thumbnail for PDF {pdf_id}, page {i}: {thumbnail_path}")
-                if not os.path.exists(thumbnail_path):
-                    print(f"[DEBUG] Thumbnail not found. Attempting to generate for {pdf_path} page {i}.")
-                    generated_path = _convert_pdf_page_to_image(pdf_path, i, thumbnail_path)
-                    if generated_path and os.path.exists(generated_path): # Check if generation was successful
-                        print(f"[DEBUG] Thumbnail generation successful for {pdf_id}, page {i}.")
-                        pass
-                    else:
-                        print(f"[ERROR] Thumbnail generation failed or file not found after generation for {pdf_id}, page {i}.")
-                        thumbnail_path = None # Indicate failure
-                else:
-                    print(f"[DEBUG] Thumbnail already exists for {pdf_id}, page {i}.")
-
-                thumbnail_url = url_for('get_pdf_page_image', pdf_id=pdf_id, page_num=i) if thumbnail_path and os.path.exists(thumbnail_path) else None
-                print(f"[DEBUG] Thumbnail URL for PDF {pdf_id}, page {i}: {thumbnail_url}")
-
-                pages_data.append({
-                    'page_number': i + 1,
-                    'original_pdf_id': pdf_id, # Keep track of original PDF
-                    'original_page_index': i, # Keep track of original page index
-                    'thumbnail_url': thumbnail_url
-                })
-            all_pdfs_data.append({
-                'id': pdf_id,
-                'filename': filename,
-                'pages': pages_data
-            })
+            page_count = _page_count(pdf_data)
         except Exception as e:
-            print(f"[ERROR] Error processing PDF {filename} (ID: {pdf_id}): {e}")
+            logger.error("Error processing PDF %s (ID: %s): %s", pdf_data['filename'], pdf_id, e)
             continue
-
-    # Store current page order in session for persistence across reloads
-    # This will be a flat list of dictionaries, each representing a page with its original pdf_id and page_index
-    flat_page_list = []
-    for pdf_data in all_pdfs_data:
-        for page in pdf_data['pages']:
-            flat_page_list.append({
-                'pdf_id': page['original_pdf_id'],
-                'page_index': page['original_page_index']
+        pdf_sha256 = pdf_data.get('sha256') or file_digest(pdf_path)
+        documents.append((pdf_data, pdf_sha256, page_count))
+    session['pdf_files'] = pdfs_in_session # Keeps the page counts for the edit endpoints
+
+    # Second pass: render every missing thumbnail in the background, in a few
+    # batched poppler runs spread over the rasterization pool. The page polls
+    # the job and only then loads the images.
+    render_targets = [(pdf_data['path'], pdf_sha256, page_count) for pdf_data, pdf_sha256, page_count in documents]
+    thumbnail_job_url = None
+    if missing_pages(render_cache, render_targets, app.config['THUMBNAIL_WIDTH']):
+        job_id = job_queue.submit('thumbnails', _render_thumbnails_job, render_targets,
+                                  thumbnail_encoder.negotiate(request))
+        _remember_job(job_id)
+        thumbnail_job_url = url_for('job_status', job_id=job_id)
+
+    for pdf_data, pdf_sha256, page_count in documents:
+        pdf_id = pdf_data['id']
+        pages_data = []
+        # Pages in the document's edit order; thumbnails stay keyed by the original index
+        for i, rotation in _document_pages(pdf_data, page_count):
+            # The content hash in the URL lets the browser cache the image as immutable
+            thumbnail_url = url_for('get_pdf_page_image', pdf_id=pdf_id, page_num=i, v=version_token(pdf_sha256))
+
+            pages_data.append({
+                'page_number': i + 1,
+                'original_pdf_id': pdf_id, # Keep track of original PDF
+                'original_page_index': i, # Keep track of original page index
+                'rotation': rotation,
+                'thumbnail_url': thumbnail_url
             })
-    session['current_page_order'] = flat_page_list
-
-    return render_template('edit.html', all_pdfs_data=all_pdfs_data)
+        all_pdfs_data.append({
+            'id': pdf_id,
+            'filename': pdf_data['filename'],
+            'strips_url': url_for('get_pdf_strips', pdf_id=pdf_id, v=version_token(pdf_sha256)),
+            'pages': pages_data
+        })
+
+    # Seed the global page order (a flat list of (pdf_id, page_index) pairs) only when
+    # there is none yet or the documents (or their order) changed, so moves between documents made on
+    # an earlier visit survive a reload
+    pdf_ids = [pdf_data['id'] for pdf_data in all_pdfs_data]
+    if session.get('page_order_pdf_ids') != pdf_ids or not _get_page_order():
+        _set_page_order([
+            (page['original_pdf_id'], page['original_page_index'])
+            for pdf_data in all_pdfs_data
+            for page in pdf_data['pages']
+        ])
+        session['page_order_pdf_ids'] = pdf_ids
+
+    return render_template('edit.html', all_pdfs_data=all_pdfs_data, thumbnail_job_url=thumbnail_job_url)
 
 
 @app.route('/get_pdf_page_image/<pdf_id>/<int:page_num>')
 def get_pdf_page_image(pdf_id, page_num):
-    thumbnail_filename = f"{pdf_id}_page_{page_num}.png"
-    thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-    print(f"[DEBUG] /get_pdf_page_image accessed for {pdf_id}, page {page_num}. Looking for: {thumbnail_path}")
+    target_pdf = _find_pdf(session.get('pdf_files', []), pdf_id)
+    if not target_pdf:
+        return "Image not found", 404
 
-    if os.path.exists(thumbnail_path):
-        print(f"[DEBUG] Thumbnail found at {thumbnail_path}. Sending file.")
-        return send_file(thumbnail_path, mimetype='image/png')
-    else:
-        print(f"[WARNING] Thumbnail not found at {thumbnail_path}. Attempting regeneration or returning 404.")
-        # If for some reason thumbnail is missing, try to regenerate or return placeholder
-        # Try to regenerate thumbnail if not found
-        pdfs_in_session = session.get('pdf_files', [])
-        target_pdf_path = None
-        for pdf_data in pdfs_in_session:
-            if pdf_data['id'] == pdf_id:
-                target_pdf_path = pdf_data['path']
-                break
-        
-        if target_pdf_path and os.path.exists(target_pdf_path):
-            print(f"[DEBUG] Original PDF found at {target_pdf_path}. Attempting to regenerate thumbnail.")
-            generated_path = _convert_pdf_page_to_image(target_pdf_path, page_num, thumbnail_path)
-            if generated_path and os.path.exists(generated_path):
-                print(f"[DEBUG] Thumbnail regenerated successfully for {pdf_id}, page {page_num}.")
-                # If generation successful, and it's not already the correct name, rename it
-                if generated_path != thumbnail_path: # This check is redundant after the fix, but harmless.
-                    os.rename(generated_path, thumbnail_path)
-                return send_file(thumbnail_path, mimetype='image/png')
-            else:
-                print(f"[ERROR] Regeneration failed for {pdf_id}, page {page_num}.")
-
-        print(f"[ERROR] Image not found and could not be regenerated for {pdf_id}, page {page_num}.")
+    # The ETag is the render cache key, so a revalidation is answered before touching the disk
+    fmt = thumbnail_encoder.negotiate(request)
+    pdf_sha256 = target_pdf.get('sha256') or file_digest(target_pdf['path'])
+    etag = thumbnail_encoder.etag(pdf_sha256, page_num, app.config['THUMBNAIL_WIDTH'], fmt)
+    response = not_modified(etag, pdf_sha256, vary=['Accept'])
+    if response:
+        return response
+
+    if os.path.exists(target_pdf['path']):
+        thumbnail_path = _get_thumbnail(target_pdf, page_num)
+        if thumbnail_path:
+            image_path = thumbnail_encoder.page_image(pdf_sha256, page_num, thumbnail_path, app.config['THUMBNAIL_WIDTH'], fmt)
+            if image_path:
+                return send_cached_file(image_path, etag, pdf_sha256, vary=['Accept'], mimetype=FORMATS[fmt][0])
+
+    logger.error("Image not found and could not be regenerated for %s, page %d.", pdf_id, page_num)
+    return "Image not found", 404
+
+@app.route('/get_pdf_strips/<pdf_id>')
+def get_pdf_strips(pdf_id):
+    """
+    Index of a document's thumbnail strips: for each strip its URL and, for each page
+    in it, the y offset and size. Pages that failed to render are left out.
+    """
+    target_pdf = _find_pdf(session.get('pdf_files', []), pdf_id)
+    if not target_pdf or not os.path.exists(target_pdf['path']):
+        return jsonify({'status': 'error', 'message': 'Target PDF not found'}), 404
+
+    pdf_sha256 = target_pdf.get('sha256') or file_digest(target_pdf['path'])
+    layout = _strip_layout(target_pdf, pdf_sha256)
+    if layout is None:
+        return jsonify({'status': 'error', 'message': 'Thumbnails could not be rendered'}), 500
+
+    strips = [dict(strip, url=url_for('get_pdf_strip', pdf_id=pdf_id, number=number, v=version_token(pdf_sha256)))
+              for number, strip in enumerate(layout['strips'])]
+    response = jsonify({'status': 'success', 'strips': strips})
+    return cached_response(response, thumbnail_encoder.layout_etag(pdf_sha256, app.config['THUMBNAIL_WIDTH']), pdf_sha256)
+
+def _strip_layout(pdf_data, pdf_sha256):
+    """
+    The document's strip index. A request never rasterizes a whole document: while pages
+    are missing the index is left to the thumbnail job and the client is asked to retry.
+    """
+    width = app.config['THUMBNAIL_WIDTH']
+    layout = thumbnail_encoder.cached_layout(pdf_sha256, width)
+    if layout is not None:
+        return layout
+    if missing_pages(render_cache, [(pdf_data['path'], pdf_sha256, _page_count(pdf_data))], width):
+        raise RenderBusy(2, 'thumbnails are still being rendered')
+    # Every page image is cached, so this only reads their headers
+    return thumbnail_encoder.layout(pdf_data['path'], pdf_sha256, width, interactive=True)
+
+@app.route('/get_pdf_strip/<pdf_id>/<int:number>')
+def get_pdf_strip(pdf_id, number):
+    target_pdf = _find_pdf(session.get('pdf_files', []), pdf_id)
+    if not target_pdf or not os.path.exists(target_pdf['path']):
         return "Image not found", 404
 
+    width = app.config['THUMBNAIL_WIDTH']
+    fmt = thumbnail_encoder.negotiate(request)
+    pdf_sha256 = target_pdf.get('sha256') or file_digest(target_pdf['path'])
+    etag = thumbnail_encoder.strip_etag(pdf_sha256, number, width, fmt)
+    response = not_modified(etag, pdf_sha256, vary=['Accept'])
+    if response:
+        return response
+
+    layout = _strip_layout(target_pdf, pdf_sha256)
+    if not layout or not 0 <= number < len(layout['strips']):
+        return "Image not found", 404
+    strip_path = thumbnail_encoder.strip_image(target_pdf['path'], pdf_sha256, layout, number, width, fmt,
+                                               interactive=True)
+    if not strip_path:
+        return "Image not found", 404
+    return send_cached_file(strip_path, etag, pdf_sha256, vary=['Accept'], mimetype=FORMATS[fmt][0])
+
 
 @app.route('/update_pdf_page_order/<pdf_id>', methods=['POST'])
 def update_pdf_page_order(pdf_id):
-    # This endpoint needs to be updated to handle global page order, not just for a single PDF
-    # For now, it will remain as is but noted for future change.
+    # Per-document edit list: the order of original page indexes (pages left out are
+    # deleted) and optional rotations. The uploaded file is never rewritten, so its
+    # sha256 and the cached thumbnails stay valid; the edits are applied at merge time.
     new_order = request.json.get('order') # This will be a list of original_index
+    rotations = request.json.get('rotations') # Optional {original_index: degrees}
     if not new_order:
         return jsonify({'status': 'error', 'message': 'No page order provided'}), 400
 
     pdfs = session.get('pdf_files', [])
-    target_pdf = None
-    for pdf in pdfs:
-        if pdf['id'] == pdf_id:
-            target_pdf = pdf
-            break
-
+    target_pdf = _find_pdf(pdfs, pdf_id)
     if not target_pdf or not os.path.exists(target_pdf['path']):
         return jsonify({'status': 'error', 'message': 'Target PDF not found'}), 404
 
     try:
-        reader = PdfReader(target_pdf['path'])
-        writer = PdfWriter()
+        edits = _normalize_edits(new_order, rotations, _page_count(target_pdf), target_pdf.get('edits'))
+    except (ValueError, TypeError) as e:
+        return jsonify({'status': 'error', 'message': f'Invalid page order: {e}'}), 400
+    except Exception as e:
+        logger.error("Error reading %s: %s", target_pdf['path'], e)
+        return jsonify({'status': 'error', 'message': f'Error updating page order: {e}'}), 500
 
-        for original_index in new_order:
-            writer.add_page(reader.pages[original_index])
-        
-        # Overwrite the original file with the reordered pages
-        with open(target_pdf['path'], 'wb') as f:
-            writer.write(f)
+    target_pdf['edits'] = edits
+    session['pdf_files'] = pdfs
+    return jsonify({'status': 'success', 'message': 'Page order updated successfully'})
 
-        return jsonify({'status': 'success', 'message': 'Page order updated successfully'})
+@app.route('/rotate_pdf_page/<pdf_id>', methods=['POST'])
+def rotate_pdf_page(pdf_id):
+    # Adds to a page's rotation in the document's edit list (clockwise, multiple of 90)
+    page_index = request.json.get('page_index')
+    degrees = request.json.get('degrees', 90)
 
+    pdfs = session.get('pdf_files', [])
+    target_pdf = _find_pdf(pdfs, pdf_id)
+    if not target_pdf or not os.path.exists(target_pdf['path']):
+        return jsonify({'status': 'error', 'message': 'Target PDF not found'}), 404
+
+    edits = target_pdf.get('edits') or {}
+    try:
+        page_count = _page_count(target_pdf)
+        order = edits.get('order', list(range(page_count)))
+        rotations = dict(edits.get('rotations', {}))
+        if page_index not in order:
+            raise ValueError(f'page {page_index!r} is not in the document')
+        if not isinstance(degrees, int) or degrees % 90:
+            raise ValueError('degrees must be a multiple of 90')
+        rotations[str(page_index)] = rotations.get(str(page_index), 0) + degrees
+        edits = _normalize_edits(order, rotations, page_count)
+    except (ValueError, TypeError) as e:
+        return jsonify({'status': 'error', 'message': f'Invalid rotation: {e}'}), 400
     except Exception as e:
-        print(f"Error updating page order for {target_pdf['path']}: {e}")
-        return jsonify({'status': 'error', 'message': f'Error updating page order: {e}'}), 500
+        logger.error("Error reading %s: %s", target_pdf['path'], e)
+        return jsonify({'status': 'error', 'message': f'Error rotating page: {e}'}), 500
+
+    target_pdf['edits'] = edits
+    session['pdf_files'] = pdfs
+    return jsonify({'status': 'success', 'rotation': edits['rotations'].get(str(page_index), 0)})
 
 @app.route('/update_global_page_order', methods=['POST'])
 def update_global_page_order():
-    new_global_order = request.json.get('order') # List of {pdf_id, page_index}
+    body = request.get_json(silent=True)
+    new_global_order = body.get('order') if isinstance(body, dict) else None # List of {pdf_id, page_index}
     if not new_global_order:
         return jsonify({'status': 'error', 'message': 'No global page order provided'}), 400
-    
-    session['current_page_order'] = new_global_order
+
+    try:
+        _set_page_order([(page['pdf_id'], page['page_index']) for page in new_global_order])
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'status': 'error', 'message': f'Invalid page order: {e}'}), 400
     return jsonify({'status': 'success', 'message': 'Global page order updated successfully'})
 
+@app.route('/patch_global_page_order', methods=['POST'])
+def patch_global_page_order():
+    # Incremental reorder: a list of move/delete/insert ops (see WorkspaceStore.patch_page_order)
+    body = request.get_json(silent=True)
+    ops = body.get('ops') if isinstance(body, dict) else None
+    if not isinstance(ops, list) or not ops:
+        return jsonify({'status': 'error', 'message': 'No page order changes provided'}), 400
+
+    try:
+        page_count = workspace_store.patch_page_order(ensure_workspace_id(session, workspace_store), ops)
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'status': 'error', 'message': f'Invalid page order change: {e}'}), 400
+    return jsonify({'status': 'success', 'message': 'Global page order updated successfully', 'page_count': page_count})
+
 @app.route('/update_pdf_order', methods=['POST'])
 def update_pdf_order():
     new_order_ids = request.json.get('order')
@@ -252,54 +573,76 @@ def merging():
 
 @app.route('/execute_merge', methods=['POST'])
 def execute_merge():
-    global_page_order = session.get('current_page_order', [])
+    global_page_order = _get_page_order()
     if not global_page_order:
         return jsonify({'status': 'error', 'message': 'No pages to merge. Please upload PDFs and edit their order.'}), 400
 
     # Reconstruct pdf_files dictionary for easy lookup by pdf_id
     pdfs_in_session = {pdf['id']: pdf for pdf in session.get('pdf_files', [])}
 
-    merger = PdfMerger()
-    for page_info in global_page_order:
-        pdf_id = page_info['pdf_id']
-        page_index = page_info['page_index']
-        
+    pages = []
+    for pdf_id, page_index, rotation in _apply_document_edits(global_page_order, pdfs_in_session):
         if pdf_id not in pdfs_in_session or not os.path.exists(pdfs_in_session[pdf_id]['path']):
-            print(f"Warning: Original PDF for page {page_index + 1} of {pdf_id} not found. Skipping.")
-            continue
-
-        try:
-            reader = PdfReader(pdfs_in_session[pdf_id]['path'])
-            merger.append(reader, pages=(page_index, page_index + 1)) # Append only this specific page
-        except Exception as e:
-            print(f"Error appending page {page_index + 1} from {pdfs_in_session[pdf_id]['filename']}: {e}")
-            # Depending on desired behavior, you might want to return an error or skip this page
+            logger.warning("Original PDF for page %d of %s not found. Skipping.", page_index + 1, pdf_id)
             continue
+        pages.append((pdfs_in_session[pdf_id]['path'], page_index, rotation))
 
-    if not merger.pages: # Check if any pages were actually added to the merger
+    if not pages:
         return jsonify({'status': 'error', 'message': 'No valid pages were found to merge.'}), 400
 
-    merged_path = os.path.join(app.config['UPLOAD_FOLDER'], f"merged_{uuid.uuid4().hex}.pdf")
-    merger.write(merged_path)
-    merger.close()
-
-    session['merged_pdf'] = merged_path
-    return jsonify({'status': 'success', 'redirect_url': url_for('preview')})
+    merged_path = storage.workspace_path(ensure_workspace_id(session, workspace_store), f"merged_{uuid.uuid4().hex}.pdf")
+    job_id = job_queue.submit('merge', _merge_job, pages, merged_path)
+    _remember_job(job_id)
+    return jsonify({'status': 'accepted', 'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.status(job_id) if job_id in session.get('job_ids', []) else None
+    if not job:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+
+    if job['state'] == ERROR:
+        return jsonify({'status': 'error', 'state': job['state'], 'message': job['error']})
+
+    response = {
+        'status': 'success',
+        'state': job['state'],
+        'done': job['done'],
+        'total': job['total'],
+        'message': job['message'],
+    }
+    if job['state'] == DONE and job['kind'] == 'merge':
+        session['merged_pdf'] = job['result']['merged_pdf']
+        session['merged_sha256'] = job['result'].get('merged_sha256')
+        response['optimization'] = job['result'].get('optimization')
+        response['redirect_url'] = url_for('preview')
+    elif job['state'] == DONE and job['kind'] == 'thumbnails':
+        response['thumbnails'] = job['result']
+    return jsonify(response)
 
 @app.route('/preview')
 def preview():
     if 'merged_pdf' not in session or not os.path.exists(session['merged_pdf']):
         return redirect(url_for('index'))
-    return render_template('preview.html')
+    return render_template('preview.html', version=version_token(_merged_sha256()))
+
+def _merged_sha256():
+    if not session.get('merged_sha256'):
+        session['merged_sha256'] = file_digest(session['merged_pdf'])
+    return session['merged_sha256']
 
 @app.route('/download')
 def download():
+    # ETag and Range support let the viewer revalidate with a 304 on reload and,
+    # with PDF_LINEARIZE=1, show the first page before the whole file has arrived
     merged_path = session.get('merged_pdf')
     if not merged_path or not os.path.exists(merged_path):
         return redirect(url_for('index'))
 
     as_attachment = request.args.get('download', 'false').lower() == 'true'
-    return send_file(merged_path, as_attachment=as_attachment)
+    merged_sha256 = _merged_sha256()
+    return send_cached_file(merged_path, merged_sha256, merged_sha256,
+                            mimetype='application/pdf', as_attachment=as_attachment)
 
 @app.route('/delete_pdf', methods=['POST'])
 def delete_pdf():
@@ -316,7 +659,7 @@ def delete_pdf():
                 os.remove(pdf['path'])
                 found = True
             except Exception as e:
-                print(f"Error deleting file {pdf['path']}: {e}")
+                logger.error("Error deleting file %s: %s", pdf['path'], e)
             continue
         updated_pdf_files.append(pdf)
 
@@ -329,21 +672,62 @@ def delete_pdf():
 
 @app.route('/reset')
 def reset():
-    for pdf in session.get('pdf_files', []):
-        try:
-            os.remove(pdf['path'])
-        except Exception:
-            pass
-
-    merged_pdf = session.get('merged_pdf')
-    if merged_pdf:
-        try:
-            os.remove(merged_pdf)
-        except Exception:
-            pass
+    # Uploads and merged outputs all live in the workspace directory
+    if session.sid:
+        storage.remove_workspace(session.sid)
 
     session.clear()
     return redirect(url_for('index'))
 
+# --- Bulk API (v1) ---
+# Headless merge of many uploads in one request; each output is merged on the bulk pool
+# (spec format: see webtools_common/bulk.py).
+#   curl -F files=@a.pdf -F files=@b.pdf -F 'spec={}' http://.../api/v1/merge -o result.zip
+
+def _api_error(message, status=400):
+    return jsonify({'status': 'error', 'message': message}), status
+
+@app.route('/api/v1/merge', methods=['POST'])
+def api_merge():
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return _api_error('Send the PDFs to merge as "files".')
+    filenames = [bulk.safe_name(f.filename) for f in files]
+    if len(set(filenames)) != len(filenames):
+        return _api_error('Uploaded file names must be unique (outputs refer to inputs by name).')
+    try:
+        spec = bulk.parse_merge_spec(json.loads(request.form.get('spec') or '{}'), filenames)
+    except ValueError as e:
+        return _api_error(f'Invalid spec: {e}')
+
+    # Results live next to the workspaces and are removed by the storage sweeper
+    batch_id = uuid.uuid4().hex
+    out_dir = storage.workspace_dir(batch_id)
+    input_dir = os.path.join(out_dir, 'input')
+    os.makedirs(input_dir)
+
+    paths = {}
+    documents = []
+    for n, (file, filename, stem) in enumerate(zip(files, filenames, bulk.unique_stems(filenames))):
+        pdf_path = os.path.join(input_dir, f"{n}.pdf")
+        pdf_sha256 = save_with_digest(file, pdf_path)
+        paths[filename] = pdf_path
+        documents.append((pdf_path, pdf_sha256, stem))
+
+    tasks = [
+        (name, bulk.merge_output, ([(paths[filename], pages) for filename, pages in inputs], os.path.join(out_dir, name)))
+        for name, inputs in spec['outputs']
+    ]
+    return bulk.batch_response(batch_id, out_dir, tasks, spec,
+                               lambda name: url_for('api_result', batch_id=batch_id, name=name),
+                               render_cache=render_cache, documents=documents)
+
+@app.route('/api/v1/results/<batch_id>/<name>')
+def api_result(batch_id, name):
+    directory = bulk.batch_dir(storage, batch_id)
+    if not directory:
+        return _api_error('Result not found', 404)
+    return send_from_directory(directory, name, as_attachment=True)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -1,73 +1,266 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, session, render_template_string
-from werkzeug.utils import secure_filename  # ※未使用でも一応残しておく
-from PyPDF2 import PdfReader, PdfWriter
-from pdf2image import convert_from_bytes
+from flask import render_template, request, url_for, send_file, send_from_directory, session, render_template_string, jsonify, Response
 from io import BytesIO
 import os
-import zipfile
-import tempfile
 import uuid
-import base64
-import re  # ← 追加
+import re
+import json
+import logging
+from webtools_common import bulk
+from webtools_common import instrumentation
+from webtools_common.app_factory import create_app
+from webtools_common.http_cache import not_modified, send_cached_file, version_token
+from webtools_common.instrumentation import stage
+from webtools_common.jobs import DONE, ERROR, JobQueue
+from webtools_common.pdf_io import open_pdf_reader, page_metadata
+from webtools_common.pdf_optimize import PdfOptimizer, combine_reports
+from webtools_common.render_cache import RenderCache, save_with_digest
+from webtools_common.render_governor import RenderBusy, estimate_cost, get_governor
+from webtools_common.storage import StorageManager
+from webtools_common.thumbnails import FORMATS, MAX_WIDTH, MIN_WIDTH, ThumbnailEncoder
+from webtools_common.uploads import ChunkedUploads, UploadError
+from webtools_common.workspace import WorkspaceStore, ensure_workspace_id
+from webtools_common.zipstream import COMPRESSION, attachment_header, iter_zip, write_zip
 
-app = Flask(__name__)
-app.secret_key = 'your_secret_key_here'
-app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
-app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024
+# 作業状態はサーバー側 (SQLite) に保存し、Cookie には署名付きのワークスペースIDだけを入れる
+workspace_store = WorkspaceStore.from_env('pdf-splitter')
+
+# secret_key (環境変数 SECRET_KEY)、セッション、/metrics、/healthz・/readyz の設定は共通の app_factory で行う。
+# PyPDF2 と pdf2image は使う関数の中で import し、起動時の読み込みを軽くしている
+app = create_app(__name__, 'pdf-splitter', workspace_store)
+# アップロードはディスクに直接書き、PDFは mmap で読むので、ファイル全体がメモリに載ることはない。
+# これは1リクエストの上限で、画面からはチャンクに分けて送るので1ファイルは UPLOAD_MAX_BYTES まで送れる
+app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+# プレビュー用サムネイルの幅(px)。?width= で上書き可能だが MIN/MAX の範囲に丸める
+app.config['THUMBNAIL_WIDTH'] = 200
+app.config['THUMBNAIL_MIN_WIDTH'] = MIN_WIDTH
+app.config['THUMBNAIL_MAX_WIDTH'] = MAX_WIDTH
+# 分割結果ZIPの圧縮方式 ('stored' / 'deflated')。PDFはほぼ縮まないので既定は無圧縮
+app.config['SPLIT_ZIP_COMPRESSION'] = 'stored'
+
+# ページ画像は pdf-merger と共有するディスクキャッシュに、PDFの内容のハッシュをキーに保存する
+render_cache = RenderCache.from_env()
+# ブラウザが受け付けるなら PNG ではなく WebP / JPEG で返す (Accept ヘッダーで選ぶ)
+thumbnail_encoder = ThumbnailEncoder.from_env(render_cache)
+
+# 分割とZIP作成はバックグラウンドジョブで行い、画面は /jobs/<job_id> で進捗を問い合わせる
+job_queue = JobQueue.from_env('pdf-splitter')
+
+# アップロードしたPDFと分割ZIPはワークスペースごとのディレクトリに置き、
+# 一定時間使われなかったものや容量を超えた分はバックグラウンドで削除する
+storage = StorageManager.from_env('pdf-splitter', workspace_store, job_queue)
+
+# 分割パートは書き出す前に共通の最適化 (重複オブジェクトの統合、ストリームの圧縮、
+# PDF_IMAGE_DPI による画像の縮小、qpdf があればオブジェクトストリーム化) を通す
+pdf_optimizer = PdfOptimizer.from_env(split_parts=True)
+
+# 大きなPDFはチャンクに分けてワークスペースに直接書き込み、切れても続きから再開できるようにする
+chunked_uploads = ChunkedUploads.from_env(storage)
+
+# pdftoppm の同時実行数は全ワーカーを通して RENDER_MAX_CONCURRENT までに制限し、
+# 空きを待ちきれないページ画像のリクエストは 503 と Retry-After で返す
+render_governor = get_governor()
+
+instrumentation.register_stats('render_cache', render_cache.stats, fields=['bytes', 'max_bytes'])
+instrumentation.register_stats('storage', storage.stats, fields=['live_bytes', 'live_workspaces'],
+                               counters=['reclaimed_bytes'])
+instrumentation.register_stats('render_governor', render_governor.stats)
+
+@app.before_request
+def _start_storage_sweeper():
+    storage.ensure_sweeper()
+
+
+def _convert_pdf_page_to_image(pdf_path, page_num, desired_thumbnail_path, width):
+    """
+    指定されたPDFの1ページだけを幅 width px の PNG に変換して保存する。
+    page_num は0ベース。成功時は保存先パス、失敗時は None を返す。
+    """
+    from pdf2image import convert_from_path
+
+    try:
+        with render_governor.slot(estimate_cost(1, width), interactive=True), stage('rasterize', pages=1):
+            images = convert_from_path(
+                pdf_path,
+                first_page=page_num + 1,
+                last_page=page_num + 1,
+                size=(width, None)  # 幅だけ指定し、高さはアスペクト比から自動計算
+            )
+        if not images:
+            return None
+        with stage('encode_png', pages=1):
+            images[0].save(desired_thumbnail_path, format='PNG')
+        return desired_thumbnail_path
+    except RenderBusy:
+        raise  # 503 と Retry-After で返す (app_factory)
+    except Exception as e:
+        logger.error("サムネイル生成に失敗しました (%s, page %d): %s", pdf_path, page_num + 1, e)
+        return None
+
+
+def iter_split_parts(reader, split_points, base_name, progress=None, reports=None):
+    """
+    分割したPDFを1つずつ (ファイル名, bytes) で返すジェネレータ。
+    次のパートは呼び出し側が前のパートを使い終わってから作るので、メモリ上には1パートぶんしか残らない。
+    reports にリストを渡すと、パートごとの最適化の結果を追加していく。
+    """
+    from PyPDF2 import PdfWriter
 
-def split_pdf_by_points(reader, split_points, base_name):
-    split_files = []
     start = 0
     for i, end in enumerate(split_points):
         if end <= start:
             continue  # 不正な範囲をスキップ
-        writer = PdfWriter()
-        for j in range(start, end):
-            writer.add_page(reader.pages[j])
-        output = BytesIO()
-        writer.write(output)
-        output.seek(0)
+        with stage('split_write', pages=end - start):
+            writer = PdfWriter()
+            for j in range(start, end):
+                writer.add_page(reader.pages[j])
+            output = BytesIO()
+            report = pdf_optimizer.write(writer, output)
+        if reports is not None:
+            reports.append(report)
         filename = f"{base_name}-part-{i+1}.pdf"
-        split_files.append((filename, output))
+        yield filename, output.getvalue()
         start = end
-    return split_files
+        if progress:
+            progress(i + 1, len(split_points))
+
+
+def split_pdf_by_points(reader, split_points, base_name):
+    return [(filename, BytesIO(data)) for filename, data in iter_split_parts(reader, split_points, base_name)]
+
+
+def _split_job(progress, temp_pdf_path, split_points, base_name, zip_path, compression):
+    """バックグラウンドで分割し、ZIPを zip_path に書き出す。"""
+    reports = []
+    with open_pdf_reader(temp_pdf_path) as reader:
+        write_zip(zip_path, iter_split_parts(reader, split_points, base_name, progress=progress, reports=reports), compression)
+    optimization = combine_reports(reports)
+    logger.info("分割パート %d 件: %d bytes (最適化で %d bytes 削減, %.3f 秒)",
+                len(reports), optimization['bytes'], optimization['saved_bytes'], optimization['seconds'])
+    return {'zip_path': zip_path, 'download_name': f"{base_name}-split.zip", 'optimization': optimization}
+
+
+def _zip_compression():
+    compression = request.form.get('compression', app.config['SPLIT_ZIP_COMPRESSION'])
+    return compression if compression in COMPRESSION else app.config['SPLIT_ZIP_COMPRESSION']
 
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# --- チャンクアップロード (手順は webtools_common/uploads.py) ---
+# 画面は最後のチャンクまで送ったら upload_id を /preview に送る。エラーは app_factory のハンドラーが返す
+
+def _upload_status(status):
+    return dict(status, upload_url=url_for('upload_chunk', upload_id=status['upload_id']))
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    body = request.get_json(silent=True) or {}
+    status = chunked_uploads.create(ensure_workspace_id(session, workspace_store),
+                                    body.get('filename'), body.get('size'), body.get('sha256'))
+    return jsonify(_upload_status(status)), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PATCH'])
+def upload_chunk(upload_id):
+    workspace_id = ensure_workspace_id(session, workspace_store)
+    if request.method == 'GET':
+        status = chunked_uploads.status(workspace_id, upload_id)
+    else:
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            raise UploadError('Send the chunk position as Upload-Offset.')
+        status = chunked_uploads.write_chunk(workspace_id, upload_id, offset, request.stream)
+    response = jsonify(_upload_status(status))
+    response.headers['Upload-Offset'] = str(status['offset'])
+    return response
+
+
 @app.route('/preview', methods=['POST'])
 def preview():
     file = request.files.get('file')
-    if not file or file.filename == '':
+    upload = None
+    if request.form.get('upload_id'):
+        # チャンクアップロードで受け取り済み (ヘッダー・末尾・ページ数は確認済み)
+        try:
+            upload = chunked_uploads.take(ensure_workspace_id(session, workspace_store), request.form['upload_id'])
+        except UploadError as e:
+            return f"アップロードが見つかりません: {e.message}", 400
+    elif not file or file.filename == '':
         return "PDFファイルを選択してください", 400
 
     # 日本語ファイル名を安全に扱うため、危険文字だけ除去
-    original_name = file.filename
+    original_name = upload['filename'] if upload else file.filename
     name_without_ext, ext = os.path.splitext(original_name)
     safe_name = re.sub(r'[\/\\\0\r\n]', '', name_without_ext)
     filename = f"{safe_name}{ext}"
 
-    unique_id = str(uuid.uuid4())
-    temp_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{unique_id}_{filename}")
-    file.save(temp_pdf_path)
+    unique_id = upload['upload_id'] if upload else str(uuid.uuid4())
+    # 同じワークスペースで前にアップロードしたPDFはもう使わないので消しておく
+    previous_pdf_path = session.get('temp_pdf_path')
+    if previous_pdf_path and os.path.exists(previous_pdf_path):
+        os.remove(previous_pdf_path)
+
+    if upload:
+        temp_pdf_path, pdf_sha256 = upload['path'], upload['sha256']
+    else:
+        temp_pdf_path = storage.workspace_path(ensure_workspace_id(session, workspace_store), f"{unique_id}_{filename}")
+        pdf_sha256 = save_with_digest(file, temp_pdf_path)
+
+    try:
+        with stage('parse'), open_pdf_reader(temp_pdf_path) as reader:
+            pages = page_metadata(reader)
+        instrumentation.record_pages('parse', len(pages))
+    except Exception as e:
+        os.remove(temp_pdf_path)
+        return f"PDFファイルを読み込めませんでした: {e}", 400
 
     session['temp_pdf_path'] = temp_pdf_path
     session['filename'] = filename
     session['pdf_id'] = unique_id
+    # ページ数はここで求めたものを使い回し、/confirm ではPDFを読み直さない
+    session['total_pages'] = len(pages)
+    session['pdf_sha256'] = pdf_sha256
+
+    # ここではページ画像を生成せず、メタデータ (番号と縦横比) だけを返す。
+    # 画像はブラウザが表示範囲に入ったページから /page_image で個別に取得する
+    for i, page in enumerate(pages):
+        page['index'] = i
+    total_pages = len(pages)
+    return render_template('preview.html', pages=pages, total=total_pages, pdf_id=unique_id,
+                           thumbnail_width=app.config['THUMBNAIL_WIDTH'], version=version_token(pdf_sha256))
 
-    with open(temp_pdf_path, 'rb') as f:
-        images = convert_from_bytes(f.read())
+@app.route('/page_image/<pdf_id>/<int:page_num>')
+def get_pdf_page_image(pdf_id, page_num):
+    temp_pdf_path = session.get('temp_pdf_path')
+    if session.get('pdf_id') != pdf_id or not temp_pdf_path or not os.path.exists(temp_pdf_path):
+        return "Image not found", 404
+    if page_num < 0 or page_num >= session.get('total_pages', 0):
+        return "Image not found", 404
 
-    encoded_images = []
-    for i, img in enumerate(images):
-        buf = BytesIO()
-        img.save(buf, format='PNG')
-        encoded = base64.b64encode(buf.getvalue()).decode('utf-8')
-        encoded_images.append({'index': i, 'data': encoded})
+    width = request.args.get('width', app.config['THUMBNAIL_WIDTH'], type=int)
+    width = max(app.config['THUMBNAIL_MIN_WIDTH'], min(width, app.config['THUMBNAIL_MAX_WIDTH']))
 
-    return render_template('preview.html', images=encoded_images, total=len(encoded_images))
+    # ETag はキャッシュのキー (内容のハッシュ・ページ・幅・形式) なので、再検証にはキャッシュを見ずに 304 を返せる
+    fmt = thumbnail_encoder.negotiate(request)
+    pdf_sha256 = session['pdf_sha256']
+    etag = thumbnail_encoder.etag(pdf_sha256, page_num, width, fmt)
+    response = not_modified(etag, pdf_sha256, vary=['Accept'])
+    if response:
+        return response
+
+    thumbnail_path = render_cache.get_or_render(
+        pdf_sha256, page_num,
+        lambda tmp_path: _convert_pdf_page_to_image(temp_pdf_path, page_num, tmp_path, width),
+        width=width,
+    )
+    if thumbnail_path:
+        thumbnail_path = thumbnail_encoder.page_image(pdf_sha256, page_num, thumbnail_path, width, fmt)
+    if not thumbnail_path:
+        return "Image not found", 404
+    return send_cached_file(thumbnail_path, etag, pdf_sha256, vary=['Accept'], mimetype=FORMATS[fmt][0])
 
 @app.route('/confirm', methods=['POST'])
 def confirm():
@@ -80,9 +273,7 @@ def confirm():
     if not temp_pdf_path or not os.path.exists(temp_pdf_path):
         return "PDFファイルが見つかりません。", 400
 
-    with open(temp_pdf_path, 'rb') as f:
-        reader = PdfReader(BytesIO(f.read()))
-        total_pages = len(reader.pages)
+    total_pages = session.get('total_pages', 0)
 
     ranges = []
     prev = 0
@@ -102,9 +293,9 @@ def confirm():
           <li style="margin-bottom: 8px;">📄 <strong>{{ filename }}-part-{{ i }}.pdf</strong>（{{ start }} ～ {{ end }} ページ）</li>
         {% endfor %}
       </ul>
-      <form action="{{ url_for('download') }}" method="post" style="display:inline;">
-        <button type="submit" style="padding: 10px 20px; font-size: 16px; background-color: #0078D4; color: #fff; border: none; border-radius: 6px; cursor: pointer;">保存</button>
-      </form>
+      <label style="display: block; margin-bottom: 16px; color: #555;"><input type="checkbox" id="zipDeflate"> ZIPを圧縮する（PDFはほとんど小さくならないため通常は不要）</label>
+      <p id="downloadProgress" style="margin-bottom: 16px; color: #555;"></p>
+      <button id="downloadButton" onclick="startDownload()" style="padding: 10px 20px; font-size: 16px; background-color: #0078D4; color: #fff; border: none; border-radius: 6px; cursor: pointer;">保存</button>
       <button onclick="document.getElementById('popupOverlay').style.display='none';" style="margin-left: 12px; padding: 10px 20px; font-size: 16px; background-color: #ccc; border: none; border-radius: 6px; cursor: pointer;">キャンセル</button>
     </div>
     ''', ranges=ranges, filename=filename)
@@ -116,23 +307,114 @@ def download():
     split_points = session.get('split_points', [])
     temp_pdf_path = session.get('temp_pdf_path')
     if not temp_pdf_path or not os.path.exists(temp_pdf_path):
-        return "PDFファイルが見つかりません。", 400
+        return jsonify({'status': 'error', 'message': 'PDFファイルが見つかりません。'}), 400
 
-    with open(temp_pdf_path, 'rb') as f:
-        file_data = f.read()
-    reader = PdfReader(BytesIO(file_data))
+    base_name = os.path.splitext(session.get('filename', 'output'))[0]
+    zip_path = storage.workspace_path(ensure_workspace_id(session, workspace_store), f"{session.get('pdf_id')}-{uuid.uuid4().hex}-split.zip")
+    job_id = job_queue.submit('split', _split_job, temp_pdf_path, split_points, base_name, zip_path, _zip_compression())
+    # このセッションで開始したジョブだけ問い合わせ・取得できるようにする
+    session['job_ids'] = (session.get('job_ids', []) + [job_id])[-10:]
+    return jsonify({
+        'status': 'accepted',
+        'job_id': job_id,
+        'status_url': url_for('job_status', job_id=job_id),
+        'result_url': url_for('job_result', job_id=job_id),
+    }), 202
+
+@app.route('/download/stream', methods=['POST'])
+def download_stream():
+    """
+    ジョブを使わずに、分割しながらZIPをチャンク転送で返す (スクリプトなどからの直接利用向け)。
+    パートを1つ作るたびにZIPに書いて送るので、メモリ上には1パートぶんしか残らない。
+    """
+    split_points = session.get('split_points', [])
+    temp_pdf_path = session.get('temp_pdf_path')
+    if not temp_pdf_path or not os.path.exists(temp_pdf_path):
+        return "PDFファイルが見つかりません。", 400
 
     base_name = os.path.splitext(session.get('filename', 'output'))[0]
-    split_files = split_pdf_by_points(reader, split_points, base_name)
+    compression = _zip_compression()
+
+    def generate():
+        # レスポンスを送り終えるまでPDFを開いたままにする
+        with open_pdf_reader(temp_pdf_path) as reader:
+            yield from iter_zip(iter_split_parts(reader, split_points, base_name), compression)
+
+    return Response(generate(), mimetype='application/zip',
+                    headers={'Content-Disposition': attachment_header(f"{base_name}-split.zip")})
+
+def _session_job(job_id):
+    if job_id not in session.get('job_ids', []):
+        return None
+    return job_queue.status(job_id)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = _session_job(job_id)
+    if not job:
+        return jsonify({'status': 'error', 'message': 'ジョブが見つかりません。'}), 404
+    if job['state'] == ERROR:
+        return jsonify({'status': 'error', 'state': job['state'], 'message': job['error']})
+    response = {
+        'status': 'success',
+        'state': job['state'],
+        'done': job['done'],
+        'total': job['total'],
+    }
+    if job['state'] == DONE:
+        response['optimization'] = job['result'].get('optimization')
+    return jsonify(response)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = _session_job(job_id)
+    if not job or job['state'] != DONE or not os.path.exists(job['result']['zip_path']):
+        return "ファイルが見つかりません。", 404
+    return send_file(job['result']['zip_path'], as_attachment=True,
+                     download_name=job['result']['download_name'], mimetype='application/zip')
+
+# --- 一括処理API (v1) ---
+# 画面を使わずに、複数のPDFを1回のリクエストでまとめて分割する (spec の書式は webtools_common/bulk.py)。
+#   curl -F files=@a.pdf -F files=@b.pdf -F 'spec={"every": 10}' http://.../api/v1/split -o result.zip
+
+def _api_error(message, status=400):
+    return jsonify({'status': 'error', 'message': message}), status
+
+@app.route('/api/v1/split', methods=['POST'])
+def api_split():
+    try:
+        spec = bulk.parse_split_spec(json.loads(request.form.get('spec') or '{}'))
+    except ValueError as e:
+        return _api_error(f"spec が不正です: {e}")
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return _api_error('PDFファイルを files で送ってください。')
+
+    # 結果はワークスペースと同じ置き場に置き、期限が来たらスイーパーが消す
+    batch_id = uuid.uuid4().hex
+    out_dir = storage.workspace_dir(batch_id)
+    input_dir = os.path.join(out_dir, 'input')
+    os.makedirs(input_dir)
+
+    filenames = [bulk.safe_name(f.filename) for f in files]
+    tasks = []
+    documents = []
+    for n, (file, filename, stem) in enumerate(zip(files, filenames, bulk.unique_stems(filenames))):
+        pdf_path = os.path.join(input_dir, f"{n}.pdf")
+        pdf_sha256 = save_with_digest(file, pdf_path)
+        tasks.append((filename, bulk.split_document, (pdf_path, spec, out_dir, stem)))
+        documents.append((pdf_path, pdf_sha256, stem))
 
-    zip_stream = BytesIO()
-    with zipfile.ZipFile(zip_stream, 'w') as zipf:
-        for name, file_stream in split_files:
-            zipf.writestr(name, file_stream.read())
-    zip_stream.seek(0)
+    return bulk.batch_response(batch_id, out_dir, tasks, spec,
+                               lambda name: url_for('api_result', batch_id=batch_id, name=name),
+                               render_cache=render_cache, documents=documents)
 
-    zip_filename = f"{base_name}-split.zip"
-    return send_file(zip_stream, as_attachment=True, download_name=zip_filename, mimetype='application/zip')
+@app.route('/api/v1/results/<batch_id>/<name>')
+def api_result(batch_id, name):
+    directory = bulk.batch_dir(storage, batch_id)
+    if not directory:
+        return _api_error('結果が見つかりません。', 404)
+    return send_from_directory(directory, name, as_attachment=True)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,34 @@
+"""
+共通部品 (webtools_common) とアプリのテスト。リポジトリのルートで `python -m pytest tests` で実行する。
+"""
+import io
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def make_pdf(pages, width=200, height=300):
+    """白紙のページを pages 枚持つPDFのバイト列。"""
+    from PyPDF2 import PdfWriter
+
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=width, height=height)
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+@pytest.fixture
+def pdf_file(tmp_path):
+    """make_pdf(pages) をファイルに書いてパスを返す関数。"""
+    def write(pages, name='doc.pdf'):
+        path = tmp_path / name
+        path.write_bytes(make_pdf(pages))
+        return str(path)
+    return write
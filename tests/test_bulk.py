@@ -0,0 +1,70 @@
+import pytest
+
+from webtools_common.bulk import parse_page_ranges, parse_split_spec, split_ranges, unique_stems
+from webtools_common.pdf_io import open_pdf_reader
+
+
+def test_parse_split_spec_every():
+    assert parse_split_spec({'every': 5}) == {'mode': 'every', 'value': 5, 'format': 'zip', 'thumbnails': None}
+
+
+def test_parse_split_spec_ranges_and_options():
+    spec = parse_split_spec({'ranges': ['1-3', '4-'], 'format': 'zip', 'thumbnails': 120})
+    assert (spec['mode'], spec['value'], spec['thumbnails']) == ('ranges', ['1-3', '4-'], 120)
+
+
+def test_parse_split_spec_max_bytes():
+    spec = parse_split_spec({'max_bytes': 100000, 'format': 'ndjson'})
+    assert (spec['mode'], spec['value'], spec['format']) == ('max_bytes', 100000, 'ndjson')
+
+
+@pytest.mark.parametrize('spec', [
+    [],
+    {},
+    {'every': 2, 'ranges': ['1']},
+    {'every': 0},
+    {'every': True},
+    {'every': '2'},
+    {'max_bytes': -1},
+    {'ranges': []},
+    {'ranges': ['3-1']},
+    {'ranges': ['a']},
+    {'every': 1, 'format': 'tar'},
+    {'every': 1, 'thumbnails': 10},
+    {'every': 1, 'thumbnails': 100, 'format': 'ndjson'},
+])
+def test_parse_split_spec_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_split_spec(spec)
+
+
+def test_parse_page_ranges():
+    assert parse_page_ranges('1-3,5,8-', 10) == [(0, 3), (4, 5), (7, 10)]
+    assert parse_page_ranges('8-', None) == [(7, None)]
+    with pytest.raises(ValueError):
+        parse_page_ranges('9-11', 10)
+    with pytest.raises(ValueError):
+        parse_page_ranges('0', 10)
+
+
+def test_split_ranges_every_and_ranges(pdf_file):
+    with open_pdf_reader(pdf_file(7)) as reader:
+        assert split_ranges(reader, parse_split_spec({'every': 3})) == [(0, 3), (3, 6), (6, 7)]
+        assert split_ranges(reader, parse_split_spec({'ranges': ['2-3', '5-']})) == [(1, 3), (4, 7)]
+
+
+def test_split_ranges_max_bytes(pdf_file):
+    with open_pdf_reader(pdf_file(6)) as reader:
+        # どのページも1ページで上限を超えるので1ページずつ
+        assert split_ranges(reader, parse_split_spec({'max_bytes': 1})) == [(i, i + 1) for i in range(6)]
+        assert split_ranges(reader, parse_split_spec({'max_bytes': 10 ** 9})) == [(0, 6)]
+
+
+def test_unique_stems():
+    assert unique_stems(['a.pdf', 'b.pdf', 'a.pdf', 'a.pdf', 'A.PDF']) == ['a', 'b', 'a-2', 'a-3', 'A']
+
+
+def test_unique_stems_does_not_collide_with_existing_names():
+    stems = unique_stems(['a.pdf', 'a.pdf', 'a-2.pdf'])
+    assert stems == ['a', 'a-2', 'a-2-2']
+    assert len(set(stems)) == len(stems)
@@ -0,0 +1,73 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+from conftest import REPO_ROOT
+
+
+@pytest.fixture(scope='module')
+def merger(tmp_path_factory):
+    """pdf-merger/app.py を、保存先を一時ディレクトリにして読み込む。"""
+    root = tmp_path_factory.mktemp('merger')
+    with pytest.MonkeyPatch.context() as mp:
+        for name in ('WORKSPACE_DIR', 'STORAGE_DIR', 'RENDER_CACHE_DIR', 'METRICS_DIR', 'JOB_DIR',
+                     'RENDER_GOVERNOR_DIR', 'SECRET_KEY_DIR'):
+            mp.setenv(name, str(root / name.lower()))
+        mp.setenv('SECRET_KEY', 'test')
+        spec = importlib.util.spec_from_file_location(
+            'pdf_merger_app', os.path.join(REPO_ROOT, 'pdf-merger', 'app.py'))
+        module = importlib.util.module_from_spec(spec)
+        mp.setitem(sys.modules, 'pdf_merger_app', module)
+        spec.loader.exec_module(module)
+        yield module
+
+
+def pdfs(**edits):
+    return {pdf_id: {'id': pdf_id, 'edits': edit} for pdf_id, edit in edits.items()}
+
+
+def test_without_edits_keeps_global_order(merger):
+    order = [('a', 0), ('b', 0), ('a', 1)]
+    assert merger._apply_document_edits(order, pdfs(a=None, b=None)) == [('a', 0, 0), ('b', 0, 0), ('a', 1, 0)]
+
+
+def test_deleted_pages_are_dropped(merger):
+    order = [('a', 0), ('a', 1), ('a', 2)]
+    edits = {'order': [0, 2], 'rotations': {}}
+    assert merger._apply_document_edits(order, pdfs(a=edits)) == [('a', 0, 0), ('a', 2, 0)]
+
+
+def test_document_order_refills_its_slots(merger):
+    # b の1ページ目を a の間に移した全体の順は保ったまま、a の中は編集後の順 (2, 1, 0) で埋める
+    order = [('a', 0), ('b', 0), ('a', 1), ('a', 2), ('b', 1)]
+    edits = {'order': [2, 1, 0], 'rotations': {'0': 90, '2': 270}}
+    assert merger._apply_document_edits(order, pdfs(a=edits, b=None)) == [
+        ('a', 2, 270), ('b', 0, 0), ('a', 1, 0), ('a', 0, 90), ('b', 1, 0)]
+
+
+def test_pages_of_unknown_documents_pass_through(merger):
+    order = [('x', 3), ('a', 0)]
+    edits = {'order': [0], 'rotations': {'0': 180}}
+    assert merger._apply_document_edits(order, pdfs(a=edits)) == [('x', 3, 0), ('a', 0, 180)]
+
+
+def test_normalize_edits(merger):
+    assert merger._normalize_edits([2, 0], {'0': 450, '1': 90, '2': 360}, 3) == {
+        'order': [2, 0], 'rotations': {'0': 90}}
+    previous = {'order': [0, 1], 'rotations': {'1': 90}}
+    assert merger._normalize_edits([1], None, 2, previous) == {'order': [1], 'rotations': {'1': 90}}
+
+
+@pytest.mark.parametrize('order, rotations', [
+    ([], {}),
+    ([0, 0], {}),
+    ([3], {}),
+    ([-1], {}),
+    (['0'], {}),
+    ([0], {'0': 45}),
+])
+def test_normalize_edits_rejects(merger, order, rotations):
+    with pytest.raises(ValueError):
+        merger._normalize_edits(order, rotations, 3)
@@ -0,0 +1,113 @@
+import hashlib
+import io
+
+import pytest
+
+from conftest import make_pdf
+from webtools_common.storage import StorageManager
+from webtools_common.uploads import ChunkedUploads, UploadError
+
+WORKSPACE = 'w' * 32
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    storage = StorageManager(str(tmp_path / 'storage'), None, ttl=3600, quota_bytes=10 ** 9, sweep_interval=300)
+    return ChunkedUploads(storage, max_bytes=10 ** 7, chunk_bytes=4096)
+
+
+def send(uploads, upload_id, data, offset=0, chunk=4096):
+    """data を chunk バイトずつ offset から送り、最後の status() を返す。"""
+    status = None
+    for start in range(offset, len(data), chunk):
+        status = uploads.write_chunk(WORKSPACE, upload_id, start, io.BytesIO(data[start:start + chunk]))
+    return status
+
+
+def test_chunked_upload_completes(uploads):
+    data = make_pdf(100)
+    upload = uploads.create(WORKSPACE, 'a.pdf', len(data), hashlib.sha256(data).hexdigest())
+    status = send(uploads, upload['upload_id'], data)
+    assert status['complete'] and status['offset'] == len(data)
+    taken = uploads.take(WORKSPACE, upload['upload_id'])
+    assert taken['page_count'] == 100
+    assert taken['sha256'] == hashlib.sha256(data).hexdigest()
+    with open(taken['path'], 'rb') as f:
+        assert f.read() == data
+
+
+def test_wrong_offset_is_rejected_with_current_offset(uploads):
+    data = make_pdf(100)
+    upload_id = uploads.create(WORKSPACE, 'a.pdf', len(data))['upload_id']
+    uploads.write_chunk(WORKSPACE, upload_id, 0, io.BytesIO(data[:4096]))
+    for offset in (0, 5000):
+        with pytest.raises(UploadError) as e:
+            uploads.write_chunk(WORKSPACE, upload_id, offset, io.BytesIO(data[offset:offset + 100]))
+        assert (e.value.status, e.value.offset) == (409, 4096)
+    # 正しい offset からは再開できる
+    assert send(uploads, upload_id, data, offset=4096)['complete']
+
+
+def test_resume_in_another_process_recomputes_sha(uploads):
+    data = make_pdf(100)
+    upload_id = uploads.create(WORKSPACE, 'a.pdf', len(data), hashlib.sha256(data).hexdigest())['upload_id']
+    uploads.write_chunk(WORKSPACE, upload_id, 0, io.BytesIO(data[:4096]))
+    # 別のワーカー (受け取り済み部分のハッシュを持っていない) が続きを受ける
+    other = ChunkedUploads(uploads.storage, uploads.max_bytes, uploads.chunk_bytes)
+    assert send(other, upload_id, data, offset=4096)['complete']
+
+
+def test_chunk_larger_than_limit(uploads):
+    data = make_pdf(100)
+    upload_id = uploads.create(WORKSPACE, 'a.pdf', len(data))['upload_id']
+    with pytest.raises(UploadError) as e:
+        uploads.write_chunk(WORKSPACE, upload_id, 0, io.BytesIO(data[:5000]))
+    assert (e.value.status, e.value.offset) == (413, 0)
+    assert uploads.status(WORKSPACE, upload_id)['offset'] == 0
+
+
+def test_non_pdf_header_is_rejected(uploads):
+    # ヘッダーは先頭 1024 バイト以内にあればよいので、その外に置く
+    data = b'<html>' + b' ' * 1024 + make_pdf(100)
+    upload_id = uploads.create(WORKSPACE, 'a.pdf', len(data))['upload_id']
+    with pytest.raises(UploadError) as e:
+        send(uploads, upload_id, data)
+    assert e.value.status == 415
+    with pytest.raises(UploadError):
+        uploads.status(WORKSPACE, upload_id)  # 断ったアップロードは削除される
+
+
+def test_truncated_pdf_is_rejected(uploads):
+    data = make_pdf(3)
+    data = data[:data.rindex(b'startxref')]
+    upload_id = uploads.create(WORKSPACE, 'a.pdf', len(data))['upload_id']
+    with pytest.raises(UploadError) as e:
+        send(uploads, upload_id, data)
+    assert e.value.status == 422
+
+
+def test_sha256_mismatch_is_rejected(uploads):
+    data = make_pdf(3)
+    upload_id = uploads.create(WORKSPACE, 'a.pdf', len(data), '0' * 64)['upload_id']
+    with pytest.raises(UploadError) as e:
+        send(uploads, upload_id, data)
+    assert e.value.status == 422
+
+
+@pytest.mark.parametrize('size, sha256, status', [
+    (0, None, 400),
+    ('10', None, 400),
+    (10 ** 8, None, 413),
+    (10, 'ABC', 400),
+])
+def test_create_validates(uploads, size, sha256, status):
+    with pytest.raises(UploadError) as e:
+        uploads.create(WORKSPACE, 'a.pdf', size, sha256)
+    assert e.value.status == status
+
+
+def test_take_incomplete_upload(uploads):
+    upload_id = uploads.create(WORKSPACE, 'a.pdf', 10000)['upload_id']
+    with pytest.raises(UploadError) as e:
+        uploads.take(WORKSPACE, upload_id)
+    assert (e.value.status, e.value.offset) == (409, 0)
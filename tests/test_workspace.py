@@ -0,0 +1,67 @@
+import pytest
+
+from webtools_common.workspace import WorkspaceStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = WorkspaceStore(str(tmp_path / 'ws.sqlite3'))
+    store.set_page_order('w', [('a', 0), ('a', 1), ('a', 2), ('b', 0), ('b', 1)])
+    return store
+
+
+def test_set_and_get_page_order(store):
+    assert store.get_page_order('w') == [('a', 0), ('a', 1), ('a', 2), ('b', 0), ('b', 1)]
+    assert store.get_page_order('other') == []
+
+
+def test_patch_move(store):
+    assert store.patch_page_order('w', [{'op': 'move', 'from': 0, 'to': 3, 'count': 2}]) == 5
+    assert store.get_page_order('w') == [('a', 2), ('b', 0), ('b', 1), ('a', 0), ('a', 1)]
+
+
+def test_patch_delete(store):
+    assert store.patch_page_order('w', [{'op': 'delete', 'index': 1, 'count': 3}]) == 2
+    assert store.get_page_order('w') == [('a', 0), ('b', 1)]
+
+
+def test_patch_insert_with_new_document(store):
+    ops = [{'op': 'insert', 'index': 1, 'pages': [['c', 4], ['b', 1]]}]
+    assert store.patch_page_order('w', ops) == 7
+    assert store.get_page_order('w')[:4] == [('a', 0), ('c', 4), ('b', 1), ('a', 1)]
+
+
+def test_patch_applies_ops_in_order(store):
+    store.patch_page_order('w', [
+        {'op': 'delete', 'index': 0},
+        {'op': 'move', 'from': 3, 'to': 0},
+        {'op': 'insert', 'index': 4, 'pages': [['a', 0]]},
+    ])
+    assert store.get_page_order('w') == [('b', 1), ('a', 1), ('a', 2), ('b', 0), ('a', 0)]
+
+
+@pytest.mark.parametrize('op', [
+    {'op': 'move', 'from': 4, 'to': 0, 'count': 2},
+    {'op': 'move', 'from': 0, 'to': 4, 'count': 2},
+    {'op': 'delete', 'index': 5},
+    {'op': 'delete', 'index': 0, 'count': 0},
+    {'op': 'insert', 'index': 6, 'pages': [['a', 0]]},
+    {'op': 'insert', 'index': 0, 'pages': [['a', -1]]},
+    {'op': 'insert', 'index': 0, 'pages': [['a', 2 ** 32]]},
+    {'op': 'insert', 'index': 0, 'pages': [['a', '1']]},
+    {'op': 'rotate'},
+    'move',
+])
+def test_patch_rejects_and_keeps_order(store, op):
+    before = store.get_page_order('w')
+    # 先頭の有効な操作も取り消される
+    with pytest.raises(ValueError):
+        store.patch_page_order('w', [{'op': 'delete', 'index': 0}, op])
+    assert store.get_page_order('w') == before
+
+
+@pytest.mark.parametrize('order', [[('a', -1)], [('a', 2 ** 32)], [('a', 1.5)], [('a', True)], [(None, 0)]])
+def test_set_page_order_rejects_invalid_pages(store, order):
+    with pytest.raises(ValueError):
+        store.set_page_order('w', order)
+    assert len(store.get_page_order('w')) == 5
@@ -0,0 +1,6 @@
+"""
+pdf-splitter / pdf-merger で共有するモジュール群。
+
+各アプリのコンテナでは /app/webtools_common として配置される
+(docker-compose.yml のビルドコンテキストとボリューム設定を参照)。
+"""
@@ -0,0 +1,149 @@
+"""
+両アプリに共通の Flask アプリの組み立てと、起動直後のウォームアップ。
+
+create_app は次をまとめて行う。
+
+- secret_key を環境変数 SECRET_KEY から読む (未設定ならアプリごとの鍵ファイルを作って全ワーカーで共有する)
+- セッションをサーバー側のワークスペースに保存する (WorkspaceSessionInterface)
+- 計測 (/metrics) とログの設定 (instrumentation.init_app)
+- /healthz (プロセスが応答するか) と /readyz (ウォームアップが終わったか) を追加する
+- 描画の空きがないとき (render_governor.RenderBusy) は 503 と Retry-After で返す
+- チャンクアップロードのエラー (uploads.UploadError) は JSON と、わかれば Upload-Offset を付けて返す
+
+PyPDF2・pdf2image・Pillow は import に時間がかかるので、各モジュールでは使う関数の中で
+import し、アプリの読み込み時には読まない。代わりに warm_up() がまとめて読み込み、
+poppler の有無などを確かめてから /readyz を 200 にする。gunicorn を --preload で動かすときは
+マスターで warm_up() してから fork するので、ワーカーは読み込み済みの状態で起動する
+(webtools_common/gunicorn_conf.py)。ウォームアップではスレッドやプール、DB接続を
+マスターに残さないので、fork しても安全。
+"""
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+
+from flask import Flask, jsonify
+
+from webtools_common import instrumentation
+from webtools_common.render_governor import RenderBusy
+from webtools_common.uploads import UploadError
+from webtools_common.workspace import WorkspaceSessionInterface
+
+logger = logging.getLogger(__name__)
+
+# ウォームアップの状態 (プロセスごと。--preload ではマスターの状態を fork で引き継ぐ)
+_state = {'ready': False, 'error': None, 'seconds': None, 'pid': None}
+_state_lock = threading.Lock()
+_warmups = []
+
+
+def load_secret_key(name):
+    """
+    環境変数 SECRET_KEY、なければ SECRET_KEY_DIR (既定は一時ディレクトリ) の鍵ファイルの値を返す。
+    鍵ファイルは初回に作り、gunicorn の全ワーカーが同じ鍵を使うようにする。
+    """
+    key = os.environ.get('SECRET_KEY')
+    if key:
+        return key
+    directory = os.environ.get('SECRET_KEY_DIR', tempfile.gettempdir())
+    path = os.path.join(directory, f"webtools_{name}.secret")
+    if not os.path.exists(path):
+        # 書き終えた一時ファイルを link で置くので、同時に起動したワーカーが書きかけを読むことはない
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='ascii') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, path)
+            logger.warning('SECRET_KEY is not set; generated a key in %s', path)
+        except FileExistsError:
+            pass  # 他のワーカーが先に作った
+        finally:
+            os.remove(tmp_path)
+    with open(path, encoding='ascii') as f:
+        return f.read().strip()
+
+
+def create_app(import_name, name, workspace_store, warmups=()):
+    """
+    name はアプリ名 (pdf-merger など)。warmups はウォームアップ時に呼ぶ関数
+    (DBへの接続確認など、アプリ固有の準備)。
+    """
+    app = Flask(import_name)
+    app.secret_key = load_secret_key(name)
+    app.session_interface = WorkspaceSessionInterface(workspace_store)
+    instrumentation.init_app(app, name)
+    _warmups.append(workspace_store.check)
+    _warmups.extend(warmups)
+
+    @app.before_request
+    def _ensure_warm_up():
+        warm_up_async()
+
+    @app.route('/healthz')
+    def healthz():
+        return jsonify({'status': 'ok'})
+
+    @app.route('/readyz')
+    def readyz():
+        with _state_lock:
+            state = dict(_state)
+        if not state['ready']:
+            return jsonify({'status': 'starting' if not state['error'] else 'error', 'message': state['error']}), 503
+        return jsonify({'status': 'ready', 'warm_up_seconds': state['seconds']})
+
+    @app.errorhandler(RenderBusy)
+    def render_busy(e):
+        response = jsonify({'status': 'busy', 'message': str(e), 'retry_after': e.retry_after})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    @app.errorhandler(UploadError)
+    def upload_error(e):
+        body = {'status': 'error', 'message': e.message}
+        response = jsonify(body if e.offset is None else dict(body, offset=e.offset))
+        response.status_code = e.status
+        if e.offset is not None:
+            response.headers['Upload-Offset'] = str(e.offset)
+        return response
+
+    return app
+
+
+def warm_up():
+    """重いライブラリを読み込み、外部コマンドとアプリ固有の準備を確かめる。"""
+    start = time.perf_counter()
+    try:
+        import PIL.Image  # noqa: F401 (pdf2image と PNG の保存で使う)
+        import PIL.PngImagePlugin  # noqa: F401
+        import PyPDF2  # noqa: F401
+        import pdf2image  # noqa: F401
+
+        for command in ('pdfinfo', 'pdftoppm'):
+            if shutil.which(command) is None:
+                raise RuntimeError(f"{command} (poppler-utils) が見つかりません")
+        for warmup in _warmups:
+            warmup()
+    except Exception as e:
+        logger.exception('Warm-up failed')
+        with _state_lock:
+            _state.update(ready=False, error=str(e))
+        return False
+    seconds = round(time.perf_counter() - start, 3)
+    with _state_lock:
+        _state.update(ready=True, error=None, seconds=seconds)
+    logger.info('Warm-up finished in %.3fs', seconds)
+    return True
+
+
+def warm_up_async():
+    """このプロセスでまだウォームアップしていなければ、バックグラウンドで始める。"""
+    with _state_lock:
+        if _state['ready'] or _state['pid'] == os.getpid():
+            return
+        _state['pid'] = os.getpid()
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
@@ -0,0 +1,452 @@
+"""
+一括処理API (/api/v1/...) の中身: 分割・結合の指定 (spec) の解釈と、複数文書の並列処理。
+
+画面を使う流れと違い、1回のリクエストで複数のPDFと spec を受け取り、文書ごと
+(結合なら出力ファイルごと) の処理をプロセスプールで並列に実行する。PyPDF2 の処理は
+Python のコードなので、スレッドでは並列にならない。ページ画像は頼まれたときだけ作る。
+
+分割の spec (どれか1つ):
+
+    {"ranges": ["1-3", "4-10", "11-"]}   ページ範囲ごとに1ファイル (1始まり、"11-" は最後まで)
+    {"every": 5}                          5ページごとに1ファイル
+    {"max_bytes": 5000000}                1ファイルがおよそこの大きさを超えないように分ける
+
+結合の spec:
+
+    {"outputs": [{"name": "a.pdf", "inputs": [{"file": "x.pdf", "pages": "1-3,5"}, {"file": "y.pdf"}]}]}
+
+outputs を省略すると、アップロードした順にすべてのページをつないだ merged.pdf を1つ作る。
+どちらの spec にも "format" ("zip" または "ndjson") と "thumbnails" (ページ画像の幅 px) を付けられる。
+"""
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import Response, stream_with_context
+
+from webtools_common.instrumentation import REGISTRY
+from webtools_common.pdf_io import open_pdf_reader
+from webtools_common.pdf_merge import MergeEngine
+from webtools_common.pdf_optimize import PdfOptimizer, combine_reports
+from webtools_common.rasterize import render_documents
+from webtools_common.render_cache import RenderCache
+from webtools_common.thumbnails import MAX_WIDTH, MIN_WIDTH
+from webtools_common.util import is_hex_id
+from webtools_common.zipstream import attachment_header, iter_zip
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('zip', 'ndjson')
+
+# max_bytes で分けるときに見積もる、オブジェクト1つあたりの見出しや相互参照表の大きさ
+_OBJECT_OVERHEAD = 64
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def pool_size():
+    # BULK_WORKERS はホスト全体の子プロセス数。gunicorn のワーカーごとにプールを作るので、ワーカー数で割る
+    total = int(os.environ.get('BULK_WORKERS', os.cpu_count() or 1))
+    web_workers = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+    return max(1, total // max(1, web_workers))
+
+
+def _get_pool():
+    # gunicorn のワーカーごとに作る。ジョブのスレッドが動いているプロセスを fork すると
+    # ロックを持ったまま複製されることがあるので、子プロセスは spawn で起動する
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=pool_size(), mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _reset_pool(broken):
+    """子プロセスが落ちて使えなくなったプール broken を捨てる (次の _get_pool で作り直す)。"""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+# --- spec の解釈 ---
+
+def _positive_int(value, name):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"{name} must be a positive integer")
+    return value
+
+
+def _common_options(spec):
+    fmt = spec.get('format', 'zip')
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    thumbnails = spec.get('thumbnails')
+    if thumbnails is not None:
+        _positive_int(thumbnails, 'thumbnails')
+        if not MIN_WIDTH <= thumbnails <= MAX_WIDTH:
+            raise ValueError(f"thumbnails must be between {MIN_WIDTH} and {MAX_WIDTH}")
+        if fmt != 'zip':
+            raise ValueError('thumbnails are only returned in zip format')
+    return {'format': fmt, 'thumbnails': thumbnails}
+
+
+def parse_split_spec(spec):
+    """分割の spec を検証し、{'mode', 'value', 'format', 'thumbnails'} を返す。不正なら ValueError。"""
+    if not isinstance(spec, dict):
+        raise ValueError('spec must be a JSON object')
+    modes = [mode for mode in ('ranges', 'every', 'max_bytes') if mode in spec]
+    if len(modes) != 1:
+        raise ValueError('spec must contain exactly one of ranges, every, max_bytes')
+    mode = modes[0]
+    value = spec[mode]
+    if mode == 'ranges':
+        if not isinstance(value, list) or not value or not all(isinstance(r, str) for r in value):
+            raise ValueError('ranges must be a non-empty list of strings such as "1-3"')
+        for text in value:
+            parse_page_ranges(text, None)
+    else:
+        _positive_int(value, mode)
+    return dict(_common_options(spec), mode=mode, value=value)
+
+
+def parse_merge_spec(spec, filenames):
+    """
+    結合の spec を検証し、{'outputs': [(出力名, [(ファイル名, ページ範囲 or None), ...]), ...], ...} を返す。
+    filenames はアップロードされたファイル名のリスト (順序どおり)。
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('spec must be a JSON object')
+    outputs = spec.get('outputs')
+    if outputs is None:
+        outputs = [{'name': 'merged.pdf', 'inputs': [{'file': name} for name in filenames]}]
+    if not isinstance(outputs, list) or not outputs:
+        raise ValueError('outputs must be a non-empty list')
+
+    parsed = []
+    names = set()
+    for output in outputs:
+        if not isinstance(output, dict) or not isinstance(output.get('name'), str) or not output['name']:
+            raise ValueError('each output needs a name')
+        name = safe_name(output['name'])
+        if not name.lower().endswith('.pdf'):
+            name += '.pdf'
+        if name in names:
+            raise ValueError(f"duplicate output name: {name}")
+        names.add(name)
+        inputs = output.get('inputs')
+        if not isinstance(inputs, list) or not inputs:
+            raise ValueError(f"{name}: inputs must be a non-empty list")
+        parsed_inputs = []
+        for item in inputs:
+            if not isinstance(item, dict) or item.get('file') not in filenames:
+                raise ValueError(f"{name}: every input needs the name of an uploaded file")
+            pages = item.get('pages')
+            if pages is not None:
+                if not isinstance(pages, str):
+                    raise ValueError(f"{name}: pages must be a string such as \"1-3,5\"")
+                parse_page_ranges(pages, None)
+            parsed_inputs.append((item['file'], pages))
+        parsed.append((name, parsed_inputs))
+    return dict(_common_options(spec), outputs=parsed)
+
+
+def parse_page_ranges(text, page_count):
+    """
+    "1-3,5,8-" のようなページ指定 (1始まり) を0始まりの半開区間 [(start, end), ...] にする。
+    page_count が None のときは書式だけを確かめる ("8-" の終わりは None のまま)。
+    """
+    ranges = []
+    for item in text.split(','):
+        item = item.strip()
+        first, sep, last = item.partition('-')
+        try:
+            start = int(first)
+            end = (int(last) if last else page_count) if sep else start
+        except ValueError:
+            raise ValueError(f"invalid page range: {item!r}") from None
+        if start < 1 or (end is not None and end < start and last):
+            raise ValueError(f"invalid page range: {item!r}")
+        if page_count is not None and max(start, end) > page_count:
+            raise ValueError(f"page range {item!r} is beyond the last page ({page_count})")
+        ranges.append((start - 1, end))
+    return ranges
+
+
+def safe_name(filename):
+    """ZIP内やURLで使うファイル名。パス区切りや制御文字だけを取り除く (日本語はそのまま)。"""
+    name = ''.join(c for c in os.path.basename(filename.replace('\\', '/')) if c >= ' ' and c != '/')
+    return name.lstrip('.') or 'document.pdf'
+
+
+def unique_stems(filenames):
+    """
+    拡張子を除いた名前を、重複しないように "-2", "-3" を付けて返す。
+    付けた名前が他のファイルの名前と同じになる場合 (a.pdf, a.pdf, a-2.pdf) も重ならない。
+    """
+    used = set()
+    stems = []
+    for filename in filenames:
+        stem = os.path.splitext(filename)[0] or 'document'
+        candidate, count = stem, 1
+        while candidate in used:
+            count += 1
+            candidate = f"{stem}-{count}"
+        used.add(candidate)
+        stems.append(candidate)
+    return stems
+
+
+# --- 分割範囲の計算 ---
+
+def _page_objects(page):
+    """ページから参照されている間接オブジェクトの {(番号, 世代): 見積もりサイズ}。/Parent はたどらない。"""
+    from PyPDF2.generic import IndirectObject, StreamObject
+
+    sizes = {}
+    stack = [page]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in sizes:
+                continue
+            resolved = obj.get_object()
+            sizes[key] = _OBJECT_OVERHEAD + (len(resolved._data or b'') if isinstance(resolved, StreamObject) else 0)
+            stack.append(resolved)
+        elif isinstance(obj, dict):
+            stack.extend(value for key, value in obj.items() if key != '/Parent')
+        elif isinstance(obj, list):
+            stack.extend(obj)
+    return sizes
+
+
+def _size_ranges(reader, max_bytes):
+    """
+    1ファイルがおよそ max_bytes 以下になるようにページを前から詰める。
+    ページ間で共有しているフォントや画像は同じファイル内では1回だけ数える。
+    1ページだけで max_bytes を超える場合はそのページだけのファイルにする。
+    """
+    ranges = []
+    start = 0
+    part_objects = set()
+    part_size = 0
+    for index, page in enumerate(reader.pages):
+        objects = _page_objects(page)
+        added = _OBJECT_OVERHEAD + sum(size for key, size in objects.items() if key not in part_objects)
+        if index > start and part_size + added > max_bytes:
+            ranges.append((start, index))
+            start = index
+            part_objects = set()
+            added = _OBJECT_OVERHEAD + sum(objects.values())
+        part_objects.update(objects)
+        part_size = (part_size if index > start else 0) + added
+    ranges.append((start, len(reader.pages)))
+    return ranges
+
+
+def split_ranges(reader, spec):
+    """parse_split_spec の結果から、分割後の各ファイルのページ範囲 [(start, end), ...] を求める。"""
+    page_count = len(reader.pages)
+    if spec['mode'] == 'ranges':
+        return [r for text in spec['value'] for r in parse_page_ranges(text, page_count)]
+    if spec['mode'] == 'every':
+        step = spec['value']
+        return [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    return _size_ranges(reader, spec['value'])
+
+
+# --- プールで実行する処理 (引数と戻り値はプロセス間で受け渡せるものだけ) ---
+
+def split_document(pdf_path, spec, out_dir, base_name):
+    """1つのPDFを分割して out_dir に書き出し、出力ファイルの一覧を返す。"""
+    from PyPDF2 import PdfWriter
+
+    optimizer = PdfOptimizer.from_env(split_parts=True)
+    outputs = []
+    reports = []
+    with open_pdf_reader(pdf_path) as reader:
+        page_count = len(reader.pages)
+        for n, (start, end) in enumerate(split_ranges(reader, spec), start=1):
+            writer = PdfWriter()
+            for index in range(start, end):
+                writer.add_page(reader.pages[index])
+            name = f"{base_name}-part-{n}.pdf"
+            path = os.path.join(out_dir, name)
+            report = optimizer.write(writer, path)
+            reports.append(report)
+            outputs.append({'name': name, 'pages': [start + 1, end], 'bytes': report['bytes']})
+    return {'pages': page_count, 'outputs': outputs, 'optimization': combine_reports(reports)}
+
+
+def merge_output(inputs, out_path):
+    """inputs は (PDFのパス, ページ指定 or None) のリスト。結合して out_path に書き出す。"""
+    with MergeEngine() as engine:
+        for pdf_path, pages in inputs:
+            page_count = engine.source_page_count(pdf_path)
+            for start, end in parse_page_ranges(pages, page_count) if pages else [(0, page_count)]:
+                for index in range(start, end):
+                    engine.add_page(pdf_path, index)
+        report = engine.write(out_path)
+        page_count = engine.page_count
+    return {'pages': page_count, 'optimization': report, 'outputs': [
+        {'name': os.path.basename(out_path), 'pages': [1, page_count], 'bytes': report['bytes']},
+    ]}
+
+
+def render_thumbnails(cache_root, cache_max_bytes, pdf_path, doc_hash, width, folder):
+    """1文書のページ画像を用意し、ZIPに入れる (ZIP内の名前, キャッシュ上のパス) の一覧を返す。"""
+    cache = RenderCache(cache_root, cache_max_bytes)
+    with open_pdf_reader(pdf_path) as reader:
+        page_count = len(reader.pages)
+    rendered = render_documents(cache, [(pdf_path, doc_hash, page_count)], width)[doc_hash]
+    return {'pages': page_count, 'entries': [
+        (f"thumbnails/{folder}/page-{page_index + 1}.png", rendered[page_index])
+        for page_index in range(page_count) if page_index in rendered
+    ]}
+
+
+def _run_instrumented(func, args):
+    """子プロセスで func(*args) を実行し、(結果, その間に記録した計測値) を返す。"""
+    REGISTRY.drain()  # 失敗した前のタスクの分は捨てる
+    return func(*args), REGISTRY.drain()
+
+
+def run_tasks(tasks):
+    """
+    tasks は (名前, 関数, 引数のタプル) のリスト。プールで並列に実行し、
+    終わった順に (名前, 結果 or None, エラーメッセージ or None) を返すイテラブルを返す。
+    投入はこの関数の中で済ませる (レスポンスを返し始めてからプールの失敗に気づかないように)。
+    投入できなかったタスクも、エラーとして同じ形で返す。
+    """
+    submitted = {}
+    for name, func, args in tasks:
+        future, pool = _submit(func, args)
+        submitted[future] = (name, pool)
+    return _completed(submitted)
+
+
+def _submit(func, args):
+    error = None
+    for _ in range(2):
+        pool = _get_pool()
+        try:
+            return pool.submit(_run_instrumented, func, args), pool
+        except BrokenProcessPool as e:
+            # 前のリクエストで子プロセスが落ちたプール。作り直して1回だけやり直す
+            _reset_pool(pool)
+            error = e
+        except Exception as e:  # 子プロセスを起動できないなど
+            logger.error('Submitting a bulk task failed: %s', e)
+            error = e
+            break
+    future = Future()
+    future.set_exception(error)
+    return future, None
+
+
+def _completed(submitted):
+    for future in as_completed(submitted):
+        name, pool = submitted[future]
+        try:
+            result, metrics = future.result()
+        except BrokenProcessPool:
+            # 子プロセスが落ちた (メモリ不足など)。このプールに残っていた処理もすべて失敗する
+            if pool is not None:
+                _reset_pool(pool)
+            yield name, None, 'the worker process exited unexpectedly'
+        except Exception as e:
+            yield name, None, str(e) or e.__class__.__name__
+        else:
+            REGISTRY.absorb(metrics)
+            REGISTRY.flush()
+            yield name, result, None
+
+
+# --- レスポンス ---
+
+def batch_dir(storage, batch_id):
+    """一括処理の結果を置くディレクトリ。batch_id が不正か、もう削除されていれば None。"""
+    if not is_hex_id(batch_id):
+        return None
+    path = os.path.join(storage.root, batch_id)
+    return path if os.path.isdir(path) else None
+
+
+def batch_response(batch_id, out_dir, tasks, spec, result_url, render_cache=None, documents=()):
+    """
+    tasks (run_tasks に渡すもの) を実行し、終わったものから順にレスポンスとして送る。
+
+    - zip: 出力ファイルと、文書ごとの結果をまとめた manifest.json を入れたZIP
+    - ndjson: 1文書 (1出力) につき1行の JSON。出力は result_url(名前) から取得する。最後の行は集計
+
+    spec['thumbnails'] があれば、documents ((PDFのパス, 内容のハッシュ, ZIP内のフォルダ名) のリスト)
+    のページ画像もプールで描画し、ZIP の thumbnails/ に入れる。
+    """
+    thumbnail_tasks = {}
+    if spec['thumbnails']:
+        for pdf_path, doc_hash, folder in documents:
+            thumbnail_tasks[f"thumbnails/{folder}"] = folder
+            tasks = tasks + [(f"thumbnails/{folder}", render_thumbnails,
+                              (render_cache.root, render_cache.max_bytes, pdf_path, doc_hash, spec['thumbnails'], folder))]
+    completed = run_tasks(tasks)
+
+    def result_line(name, result, error):
+        line = {'file': name, 'status': 'error' if error else 'done'}
+        if error:
+            line['message'] = error
+        else:
+            line['pages'] = result['pages']
+            line['optimization'] = result['optimization']
+            line['outputs'] = [dict(output, url=result_url(output['name'])) for output in result['outputs']]
+        return line
+
+    def summary(lines):
+        return {'status': 'complete', 'batch_id': batch_id, 'files': len(lines),
+                'errors': sum(1 for line in lines if line['status'] == 'error')}
+
+    if spec['format'] == 'ndjson':
+        def generate():
+            lines = []
+            for name, result, error in completed:
+                line = result_line(name, result, error)
+                lines.append(line)
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+            yield json.dumps(summary(lines), ensure_ascii=False) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    def entries():
+        # 出力もページ画像もパスで渡し、zipstream に少しずつ読ませる
+        lines = []
+        thumbnails = []
+        for name, result, error in completed:
+            if name in thumbnail_tasks:
+                thumbnail = {'folder': thumbnail_tasks[name], 'status': 'error' if error else 'done'}
+                if error:
+                    thumbnail['message'] = error
+                else:
+                    thumbnail.update(pages=result['pages'], rendered=len(result['entries']))
+                    for entry_name, path in result['entries']:
+                        if os.path.exists(path):  # 描画の後で LRU から消されていれば入れない
+                            yield entry_name, path
+                thumbnails.append(thumbnail)
+                continue
+            line = result_line(name, result, error)
+            lines.append(line)
+            for output in line.get('outputs', []):
+                yield output['name'], os.path.join(out_dir, output['name'])
+        manifest = dict(summary(lines), results=lines)
+        if thumbnail_tasks:
+            manifest['thumbnails'] = thumbnails
+        yield 'manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+
+    return Response(stream_with_context(iter_zip(entries())), mimetype='application/zip',
+                    headers={'Content-Disposition': attachment_header(f"{batch_id}.zip")})
@@ -0,0 +1,63 @@
+"""
+両アプリ共通の gunicorn 設定。
+
+    python -m gunicorn -c webtools_common/gunicorn_conf.py app:app
+
+- gthread ワーカー: poppler の実行やアップロードの受信を待っている間も、同じワーカーの
+  別スレッドが他のリクエストを処理できる (sync ワーカーはその間ほかのリクエストを受けられない)
+- --preload: マスターでアプリを読み込み、warm_up() で PyPDF2・pdf2image・Pillow も読み込んでから
+  fork する。ワーカーは起動した時点で /readyz が 200 になり、読み込んだモジュールのメモリも共有される
+- max_requests と RSS の上限でワーカーを入れ替え、メモリの断片化やリークが溜まらないようにする
+
+値はすべて環境変数で変えられる。
+"""
+import logging
+import os
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+preload_app = os.environ.get('WEB_PRELOAD', '1') != '0'
+# 大きなPDFのアップロードや同期の結合でも切られないように長めにする
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 60))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 100))
+# ワーカーのRSSがこれを超えたら、処理中のリクエストを終えてから入れ替える (0 で無効)
+max_rss_bytes = int(os.environ.get('WEB_MAX_RSS_MB', 1024)) * 1024 * 1024
+# /tmp が tmpfs でないコンテナでもハートビートのファイル書き込みで詰まらないようにする
+worker_tmp_dir = os.environ.get('WEB_WORKER_TMP_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else None)
+accesslog = os.environ.get('WEB_ACCESS_LOG') or None
+
+_logger = logging.getLogger('gunicorn.error')
+
+
+def when_ready(server):
+    # --preload のときはアプリがマスターで読み込み済みなので、ここで重いライブラリも読み込んでおく
+    if preload_app:
+        from webtools_common.app_factory import warm_up
+        warm_up()
+
+
+def post_worker_init(worker):
+    # --preload なしで起動したときや、マスターでのウォームアップに失敗したときは
+    # ワーカーでアプリを読み込んだ直後に始める
+    from webtools_common.app_factory import warm_up_async
+    warm_up_async()
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0  # /proc がない環境では RSS による入れ替えはしない
+
+
+def post_request(worker, req, environ, resp):
+    if max_rss_bytes and worker.alive and _current_rss() > max_rss_bytes:
+        _logger.info('Worker %s exceeded %d MB RSS; restarting after in-flight requests',
+                     worker.pid, max_rss_bytes // (1024 * 1024))
+        worker.alive = False
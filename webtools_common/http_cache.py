@@ -0,0 +1,66 @@
+"""
+ページ画像と結合結果を返すときの HTTP キャッシュ (ETag・Cache-Control・304・Range)。
+
+ETag には内容のハッシュ (ページ画像ならレンダーキャッシュのキー、結合結果なら SHA-256) を使う。
+URL に内容のハッシュ (?v=...) が入っているときは、同じ URL の内容は変わらないので
+immutable を付けて1年キャッシュさせる。入っていないときは毎回 ETag で問い合わせさせる (no-cache)。
+どちらもワークスペースのファイルなので private にし、共有キャッシュには残さない。
+
+Range リクエスト (206) と If-None-Match (304) の判定は send_file (werkzeug の make_conditional) が行う。
+not_modified() を使うと、ファイルを探したり画像を描いたりする前に 304 を返せる。
+"""
+from flask import current_app, request, send_file
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def version_token(digest):
+    """URL に付ける内容のハッシュ (?v=...)。"""
+    return digest[:16]
+
+
+def _is_versioned(digest):
+    return request.args.get('v') == version_token(digest)
+
+
+def _apply_cache_control(response, digest):
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if _is_versioned(digest):
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = False
+    else:
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, digest, vary=()):
+    """
+    ブラウザの持っているものが etag と同じなら 304 のレスポンスを、違えば None を返す。
+    digest は URL の ?v= と比べる内容のハッシュ。vary は内容を変えるリクエストヘッダー (Accept など)。
+    """
+    if not request.if_none_match.contains(etag):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.vary.update(vary)
+    return _apply_cache_control(response, digest)
+
+
+def send_cached_file(path, etag, digest, vary=(), **kwargs):
+    """
+    path を ETag・Cache-Control 付きで返す。Range と条件付きリクエストにも応答する。
+    kwargs は send_file にそのまま渡す (mimetype, as_attachment など)。
+    """
+    response = send_file(path, etag=etag, conditional=True, **kwargs)
+    response.vary.update(vary)
+    return _apply_cache_control(response, digest)
+
+
+def cached_response(response, etag, digest):
+    """ファイル以外のレスポンス (JSON など) に ETag と Cache-Control を付け、条件付きリクエストなら 304 にする。"""
+    response.set_etag(etag)
+    _apply_cache_control(response, digest)
+    return response.make_conditional(request)
@@ -0,0 +1,424 @@
+"""
+リクエスト時間と処理段階ごとの時間・ページ数・バイト数を計測し、/metrics で
+Prometheus のテキスト形式で公開する。
+
+gunicorn はワーカーごとに別プロセスなので、各ワーカーは自分の計測値を
+<METRICS_DIR>/<pid>.json に (最短でも1秒おきに) 書き出し、/metrics を受けたワーカーが
+全ワーカーの値を合算して返す。書き出すのはリクエストとバックグラウンドジョブの終わりと、
+プロセスの終了時。終了したワーカーのカウンターとヒストグラムは
+<METRICS_DIR>/dead.json に足し込んでから消すので、ワーカーが入れ替わっても値は減らない
+(gauge はその時点の状態なので、生きているワーカーの分だけを使う)。外部ライブラリは使わない。
+
+一括処理のプール (spawn した子プロセス) は計測値を書き出さない。タスクで記録した値は
+結果と一緒に親に返し、親が自分の値に足し込む (Registry.drain / absorb)。
+
+使い方:
+
+    with stage('rasterize', pages=10):
+        ...                          # webtools_stage_seconds{stage="rasterize"} などに記録される
+    record_bytes('save_upload', n)
+
+ログは logging を使い、LOG_LEVEL (既定 INFO) で出力レベルを切り替える。
+logger.debug("... %s", x) の形で書けば、無効なレベルでは文字列の組み立ても行われない。
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, request
+
+from webtools_common.util import pid_alive, remove_quietly
+
+try:
+    import fcntl
+except ImportError:  # Windows ではロックなしで動かす
+    fcntl = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_FLUSH_INTERVAL = 1.0
+_DEAD_FILE = 'dead.json'
+_DEAD_LOCK = 'dead.lock'
+
+
+class _Metric:
+    def __init__(self, registry, name, help_text, kind, labelnames=(), buckets=None, mode='sum'):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if buckets else None
+        self.mode = mode  # ワーカー間の合算方法 (gauge のみ): 'sum' または 'max'
+        self._values = {}
+        self._lock = registry.lock
+        registry.metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(key), value] for key, value in self._values.items()]
+        return {
+            'kind': self.kind,
+            'help': self.help,
+            'labelnames': list(self.labelnames),
+            'buckets': list(self.buckets) if self.buckets else None,
+            'mode': self.mode,
+            'values': values,
+        }
+
+
+class Counter(_Metric):
+    def __init__(self, registry, name, help_text, labelnames=()):
+        super().__init__(registry, name, help_text, 'counter', labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    def __init__(self, registry, name, help_text, labelnames=(), mode='sum'):
+        super().__init__(registry, name, help_text, 'gauge', labelnames, mode=mode)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text, 'histogram', labelnames, buckets=buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [各バケットの件数 (累積ではない)..., +Inf の件数, 合計, 件数]
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 3)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            else:
+                entry[len(self.buckets)] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.callbacks = []
+        self.directory = None
+        self._last_flush = 0.0
+
+    def counter(self, name, help_text, labelnames=()):
+        return Counter(self, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=(), mode='sum'):
+        return Gauge(self, name, help_text, labelnames, mode)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return Histogram(self, name, help_text, labelnames, buckets)
+
+    def register_callback(self, callback):
+        """スナップショットの直前に呼ばれる関数を登録する (他モジュールの統計値を gauge に写すため)。"""
+        self.callbacks.append(callback)
+
+    def snapshot(self):
+        for callback in self.callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.getLogger(__name__).exception('metrics callback failed')
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def drain(self):
+        """
+        カウンターとヒストグラムの値を返して 0 に戻す。プールの子プロセスは計測値を
+        書き出さないので、タスクの結果と一緒にこの値を親に返し、親が absorb() で足し込む。
+        """
+        with self.lock:
+            values = {metric.name: [[list(key), value] for key, value in metric._values.items()]
+                      for metric in self.metrics if metric.kind != 'gauge' and metric._values}
+            for metric in self.metrics:
+                if metric.kind != 'gauge':
+                    metric._values.clear()
+        return values
+
+    def absorb(self, values):
+        """別のプロセスの drain() の結果を、このプロセスの値に足し込む。"""
+        metrics = {metric.name: metric for metric in self.metrics}
+        with self.lock:
+            for name, entries in values.items():
+                metric = metrics.get(name)
+                if metric is None or metric.kind == 'gauge':
+                    continue
+                for key, value in entries:
+                    key = tuple(key)
+                    current = metric._values.get(key)
+                    if current is None:
+                        metric._values[key] = value
+                    elif metric.kind == 'histogram':
+                        metric._values[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        metric._values[key] = current + value
+
+    def flush(self, force=False):
+        """このプロセスの計測値をファイルに書き出す (前回から1秒未満なら何もしない)。"""
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < _FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """全ワーカー (終了したワーカーのカウンターとヒストグラムを含む) の計測値を合算して返す。"""
+        self.flush(force=True)
+        snapshots = []
+        dead = []
+        for entry in os.scandir(self.directory):
+            name, ext = os.path.splitext(entry.name)
+            if ext != '.json' or not name.isdigit():
+                continue
+            if not pid_alive(int(name)):
+                dead.append(entry.path)
+                continue
+            snapshot = _load_snapshot(entry.path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        snapshot = self._retire(dead)
+        if snapshot:
+            snapshots.append(snapshot)
+        return _merge(snapshots)
+
+    def _retire(self, paths):
+        """
+        終了したワーカーのファイル paths を dead.json に足し込んでから消し、dead.json の中身を返す。
+        足し込みと削除は dead.lock を持って行うので、同時に /metrics を受けたワーカーが二重に足すことはない。
+        """
+        dead_path = os.path.join(self.directory, _DEAD_FILE)
+        if not paths:
+            return _load_snapshot(dead_path)
+        with open(os.path.join(self.directory, _DEAD_LOCK), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            aggregate = _load_snapshot(dead_path) or {}
+            retired = [snapshot for snapshot in map(_load_snapshot, paths) if snapshot is not None]
+            if retired:
+                aggregate = _merge_to_snapshot([aggregate] + [_without_gauges(s) for s in retired])
+                tmp_path = f"{dead_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(aggregate, f)
+                os.replace(tmp_path, dead_path)
+            for path in paths:
+                remove_quietly(path)
+        return aggregate
+
+    def render(self):
+        return render_text(self.collect())
+
+
+def _load_snapshot(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _without_gauges(snapshot):
+    return {name: metric for name, metric in snapshot.items() if metric['kind'] != 'gauge'}
+
+
+def _merge_to_snapshot(snapshots):
+    """_merge の結果を、ファイルに書けるスナップショットの形 (values はリスト) に戻す。"""
+    return {name: dict(metric, values=[[list(key), value] for key, value in metric['values'].items()])
+            for name, metric in _merge(snapshots).items()}
+
+
+def _merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, values={}))
+            for key, value in metric['values']:
+                key = tuple(key)
+                current = target['values'].get(key)
+                if current is None:
+                    target['values'][key] = value
+                elif metric['kind'] == 'histogram':
+                    target['values'][key] = [a + b for a, b in zip(current, value)]
+                elif metric['mode'] == 'max':
+                    target['values'][key] = max(current, value)
+                else:
+                    target['values'][key] = current + value
+    return merged
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_text(metrics):
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric['values'].items()):
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_format_labels(metric['labelnames'], key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric['buckets'] + ['+Inf'], value):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_format_labels(metric['labelnames'], key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric['labelnames'], key)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(metric['labelnames'], key)} {value[-1]}")
+    return '\n'.join(lines) + '\n'
+
+
+# --- 既定のレジストリと共通の計測項目 ---
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'webtools_request_seconds', 'HTTP request duration in seconds.', ['endpoint', 'method', 'status'])
+STAGE_SECONDS = REGISTRY.histogram(
+    'webtools_stage_seconds', 'Duration of pipeline stages in seconds.', ['stage'])
+PAGES_TOTAL = REGISTRY.counter(
+    'webtools_pages_processed_total', 'Pages processed by pipeline stage.', ['stage'])
+BYTES_TOTAL = REGISTRY.counter(
+    'webtools_bytes_processed_total', 'Bytes processed by pipeline stage.', ['stage'])
+RENDER_CACHE_REQUESTS = REGISTRY.counter(
+    'webtools_render_cache_requests_total', 'Render cache lookups by result (hit or miss).', ['result'])
+JOBS_IN_FLIGHT = REGISTRY.gauge(
+    'webtools_jobs_in_flight', 'Background jobs queued or running.', ['kind'])
+JOBS_TOTAL = REGISTRY.counter(
+    'webtools_jobs_total', 'Finished background jobs by final state.', ['kind', 'state'])
+OPTIMIZE_SAVED_BYTES = REGISTRY.counter(
+    'webtools_optimize_saved_bytes_total', 'Bytes removed from written PDFs by optimization step.', ['step'])
+RENDER_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'webtools_render_queue_wait_seconds', 'Time spent waiting for a rasterization slot.', ['result'])
+RENDER_REJECTED = REGISTRY.counter(
+    'webtools_render_rejected_total', 'Rasterization requests refused by the governor.', ['reason'])
+
+
+@contextmanager
+def stage(name, pages=0, nbytes=0):
+    """ブロックの実行時間を段階 name の時間として記録する。pages / nbytes は処理量。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+        if pages:
+            PAGES_TOTAL.inc(pages, stage=name)
+        if nbytes:
+            BYTES_TOTAL.inc(nbytes, stage=name)
+
+
+def record_pages(stage_name, pages):
+    PAGES_TOTAL.inc(pages, stage=stage_name)
+
+
+def record_bytes(stage_name, nbytes):
+    BYTES_TOTAL.inc(nbytes, stage=stage_name)
+
+
+def register_stats(prefix, stats_fn, fields=None, mode='max', counters=()):
+    """
+    stats_fn() が返す dict の値を webtools_<prefix>_<キー> という gauge として公開する。
+    fields を渡すとそのキーだけを公開する。counters に挙げたキー (プロセス内の累計値) は
+    webtools_<prefix>_<キー>_total という counter にし、全ワーカーの合計を返す。
+    """
+    gauges = {key: REGISTRY.gauge(f'webtools_{prefix}_{key}', f'{prefix} {key} (from stats()).', mode=mode)
+              for key in (fields or stats_fn()) if key not in counters}
+    totals = {key: REGISTRY.counter(f'webtools_{prefix}_{key}_total', f'{prefix} {key} (from stats()).')
+              for key in counters}
+    last = dict.fromkeys(counters, 0)
+
+    def update():
+        stats = stats_fn()
+        for key, gauge in gauges.items():
+            gauge.set(stats[key])
+        for key, counter in totals.items():
+            # stats() の値は累計なので、前回から増えた分だけを足す
+            if stats[key] > last[key]:
+                counter.inc(stats[key] - last[key])
+            last[key] = stats[key]
+
+    REGISTRY.register_callback(update)
+
+
+def configure_logging():
+    level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(level=level, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+
+
+def _flush_at_exit():
+    try:
+        REGISTRY.flush(force=True)
+    except OSError:
+        pass  # METRICS_DIR が先に消された (ベンチマークの一時ディレクトリなど)
+
+
+def init_app(app, name):
+    """リクエスト時間の計測と /metrics エンドポイントを app に追加する。name はアプリ名。"""
+    configure_logging()
+    root = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'webtools_metrics'))
+    REGISTRY.directory = os.path.join(root, name)
+    os.makedirs(REGISTRY.directory, exist_ok=True)
+    # 終了直前の値も dead.json に入るように、最後に必ず書き出す
+    atexit.register(_flush_at_exit)
+
+    @app.before_request
+    def _start_timer():
+        request.environ['webtools.start'] = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = request.environ.get('webtools.start')
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=request.endpoint or 'unknown',
+                                    method=request.method, status=response.status_code)
+        REGISTRY.flush()
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
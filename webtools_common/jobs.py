@@ -0,0 +1,151 @@
+"""
+結合・分割・サムネイル生成などの重い処理をリクエストの外で実行するジョブキュー。
+
+ジョブは登録したプロセス内のスレッドプールで実行し (同時実行数は max_workers まで)、
+状態は1ジョブ1ファイルの JSON としてディスクに保存する。gunicorn の別ワーカーが
+進捗の問い合わせを受けても同じ状態を返せるよう、状態の読み書きはすべてファイル経由で行う。
+外部サービスは使わない。
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from webtools_common.instrumentation import JOBS_IN_FLIGHT, JOBS_TOTAL, REGISTRY
+from webtools_common.util import is_hex_id, pid_alive, process_start_token
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    def __init__(self, root, max_workers):
+        self.root = root
+        self.max_workers = max_workers
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, name):
+        """
+        name はアプリごとのサブディレクトリ名 (ジョブIDの名前空間を分けるため)。
+        JOB_WORKERS はこのプロセス (gunicorn のワーカー1つ) の同時実行数。
+        """
+        root = os.environ.get('JOB_DIR', os.path.join(tempfile.gettempdir(), 'webtools_jobs'))
+        max_workers = int(os.environ.get('JOB_WORKERS', 2))
+        return cls(os.path.join(root, name), max_workers)
+
+    def _get_pool(self):
+        # gunicorn の --preload 後に fork されてもスレッドを持ち越さないよう、初回投入時に作る
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+            return self._pool
+
+    def submit(self, kind, func, *args, **kwargs):
+        """
+        func(progress, *args, **kwargs) をバックグラウンドで実行し、ジョブIDを返す。
+        progress(done, total, message=None) で進捗を記録できる。
+        func の戻り値 (JSON に変換できる値) がジョブの result になる。
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._write(job_id, {
+            'id': job_id,
+            'kind': kind,
+            'state': QUEUED,
+            'done': 0,
+            'total': 0,
+            'message': None,
+            'result': None,
+            'error': None,
+            'pid': os.getpid(),
+            'pid_start': process_start_token(),  # pid が再利用されても生きていると誤らないように
+            'created': now,
+            'updated': now,
+        })
+        JOBS_IN_FLIGHT.inc(kind=kind)
+        self._get_pool().submit(self._run, job_id, kind, func, args, kwargs)
+        return job_id
+
+    def status(self, job_id):
+        """ジョブの状態 (dict) を返す。存在しないIDなら None。"""
+        if not is_hex_id(job_id):
+            return None
+        try:
+            with open(self._path(job_id), encoding='utf-8') as f:
+                job = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if job['state'] in (QUEUED, RUNNING) and not pid_alive(job['pid'], job.get('pid_start')):
+            # 実行していたワーカーが再起動などで終了した
+            job = self._update(job_id, state=ERROR, error='ジョブを実行していたワーカーが終了しました')
+        return job
+
+    def prune(self, older_than):
+        """終了してから older_than (UNIX時刻) より前に更新されたジョブの状態ファイルを削除し、件数を返す。"""
+        removed = 0
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith('.json') or entry.stat().st_mtime >= older_than:
+                continue
+            job = self.status(entry.name[:-len('.json')])
+            if job and job['state'] in (QUEUED, RUNNING):
+                continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def _run(self, job_id, kind, func, args, kwargs):
+        state = ERROR
+        try:
+            self._update(job_id, state=RUNNING)
+
+            def progress(done, total, message=None):
+                self._update(job_id, done=done, total=total, message=message)
+
+            try:
+                result = func(progress, *args, **kwargs)
+            except Exception as e:
+                logger.exception('Job %s (%s) failed', job_id, kind)
+                self._update(job_id, state=ERROR, error=str(e))
+                return
+            self._update(job_id, state=DONE, result=result)
+            state = DONE
+        finally:
+            JOBS_IN_FLIGHT.dec(kind=kind)
+            JOBS_TOTAL.inc(kind=kind, state=state)
+            # ジョブの処理時間は次のリクエストを待たずに /metrics に出るようにする
+            try:
+                REGISTRY.flush(force=True)
+            except OSError as e:
+                logger.warning('Writing metrics failed: %s', e)
+
+    def _path(self, job_id):
+        return os.path.join(self.root, f"{job_id}.json")
+
+    def _update(self, job_id, **fields):
+        # 1ジョブの状態を書くのはそのジョブを実行しているスレッドだけなので、読み直して上書きすればよい
+        with open(self._path(job_id), encoding='utf-8') as f:
+            job = json.load(f)
+        job.update(fields, updated=time.time())
+        self._write(job_id, job)
+        return job
+
+    def _write(self, job_id, job):
+        path = self._path(job_id)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
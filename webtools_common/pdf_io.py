@@ -0,0 +1,30 @@
+"""
+保存済みのPDFファイルを、メモリにコピーせずに PdfReader で開く。
+
+PdfReader にパスを渡すと、PyPDF2 はファイル全体を読み込んで BytesIO にコピーする。
+ここではファイルを mmap して渡すので、実際に参照したオブジェクトの部分だけが読まれ、
+ページはOSのページキャッシュから直接読まれる。
+"""
+import mmap
+from contextlib import contextmanager
+
+
+@contextmanager
+def open_pdf_reader(path):
+    """with ブロックの間だけ有効な PdfReader を返す。ブロックを抜けるとファイルを閉じる。"""
+    from PyPDF2 import PdfReader  # 読み込みに時間がかかるので使うときに import する (app_factory 参照)
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield PdfReader(mapped)
+
+
+def page_metadata(reader):
+    """ページごとの表示サイズ (回転を反映した幅・高さ、pt単位) のリストを返す。"""
+    pages = []
+    for page in reader.pages:
+        width, height = float(page.mediabox.width), float(page.mediabox.height)
+        if (page.get('/Rotate') or 0) % 180:
+            width, height = height, width
+        pages.append({'width': width, 'height': height})
+    return pages
@@ -0,0 +1,85 @@
+"""
+ページ単位の並び順からPDFを結合するエンジン。
+
+元PDFは1ファイルにつき1回だけ開き、ページは PdfWriter.add_page で参照ごと追加する。
+PdfWriter は「どの reader のどのオブジェクトを既にコピーしたか」を reader ごとに
+覚えているので、同じ reader から追加したページ同士が共有するフォントや画像は
+出力に1回だけ書かれる (ページごとに reader を作り直すと毎回コピーされてしまう)。
+PdfMerger.append と違い、しおりや名前付き宛先の処理もページごとには行わない。
+元PDFは mmap で開くので、ファイル全体をメモリにコピーしない。
+書き出すときは pdf_optimize で重複したオブジェクトをまとめ、ストリームを圧縮する。
+"""
+import logging
+from contextlib import ExitStack
+
+from webtools_common.instrumentation import stage
+from webtools_common.pdf_io import open_pdf_reader
+from webtools_common.pdf_optimize import PdfOptimizer
+
+logger = logging.getLogger(__name__)
+
+
+class MergeEngine:
+    def __init__(self, optimizer=None):
+        from PyPDF2 import PdfWriter
+
+        self._readers = {}
+        self._files = ExitStack()
+        self._writer = PdfWriter()
+        self._optimizer = optimizer or PdfOptimizer.from_env()
+        self.page_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._files.close()
+        self._readers = {}
+
+    def _reader(self, pdf_path):
+        # 出力を書き終えるまで reader を保持しておく
+        # (PdfWriter は id(reader) でコピー済みオブジェクトを管理している)
+        reader = self._readers.get(pdf_path)
+        if reader is None:
+            reader = self._readers[pdf_path] = self._files.enter_context(open_pdf_reader(pdf_path))
+        return reader
+
+    def source_page_count(self, pdf_path):
+        """元PDFのページ数。元PDFはここで開いたものが add_page でもそのまま使われる。"""
+        return len(self._reader(pdf_path).pages)
+
+    def add_page(self, pdf_path, page_index, rotation=0):
+        """rotation (90 の倍数、時計回り) は出力側のページだけに付ける。元PDFは変更しない。"""
+        page = self._writer.add_page(self._reader(pdf_path).pages[page_index])
+        if rotation % 360:
+            page.rotate(rotation % 360)
+        self.page_count += 1
+
+    def write(self, output):
+        """output はファイルパスか書き込み可能なストリーム。最適化の結果 (PdfOptimizer.write) を返す。"""
+        return self._optimizer.write(self._writer, output)
+
+
+def merge_pages(pages, output, progress=None, optimizer=None):
+    """
+    pages は出力順に並んだ (pdf_path, page_index) または (pdf_path, page_index, rotation) のリスト。
+    読み込めないページは飛ばし、最適化の結果に結合できたページ数 ('pages') を加えた dict を返す
+    (結合できたページがないときは何も書き出さずに None を返す)。
+    """
+    with MergeEngine(optimizer) as engine:
+        with stage('merge_pages'):
+            for done, (pdf_path, page_index, *rotation) in enumerate(pages, start=1):
+                try:
+                    engine.add_page(pdf_path, page_index, *rotation)
+                except Exception as e:
+                    logger.warning('Error appending page %d from %s: %s', page_index + 1, pdf_path, e)
+                if progress:
+                    progress(done, len(pages))
+        if not engine.page_count:
+            return None
+        with stage('merge_write', pages=engine.page_count):
+            report = engine.write(output)
+        return dict(report, pages=engine.page_count)
@@ -0,0 +1,357 @@
+"""
+結合・分割・一括処理APIで書き出すPDFを小さくする最適化 (両アプリ共通)。
+
+PdfWriter に読み込んだ内容を書き出す直前に、次の処理を順に行う。
+
+1. 同じ内容のオブジェクトを1つにまとめる。入力ごとに入っている同じフォントやロゴなどが、
+   出力には1回だけ書かれるようになる
+2. image_dpi を指定したときは、ページに貼られた画像をページ全体に広げても
+   その解像度を超えない大きさまで縮小する (既定では行わない)。縮小しても小さくならない画像はそのまま
+3. 圧縮されていないストリーム (ページの内容など) を Flate で圧縮する
+4. qpdf があれば、相互参照表とオブジェクトを圧縮したストリーム (object streams) にまとめて書き直す。
+   linearize を指定したときは線形化 (Web 表示用に最適化) もする。ブラウザの PDF ビューアは
+   Range リクエストで先頭から読み、ファイル全体が届く前に最初のページを表示できる。
+   PyPDF2 はどちらも書けないので、ここだけは poppler と同じく外部コマンドを使う。
+   出力ごとに qpdf を1回起動するので、出力の多い分割のパートでは既定で行わない
+   (PDF_SPLIT_OBJECT_STREAMS=1 で行う)
+
+write() は書き出したファイルの大きさ、最適化で減らした大きさ、かかった時間を返し、
+ジョブの結果と /metrics (webtools_optimize_saved_bytes_total) に記録する。
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from io import BytesIO
+
+from webtools_common.instrumentation import OPTIMIZE_SAVED_BYTES, stage
+
+logger = logging.getLogger(__name__)
+
+# まとめてよい辞書の /Type。注釈 (ウィジェット) やフォームのフィールド、署名、ページのように
+# 同じ内容でも1つずつ別のものとして扱われる (/P や /Parent で参照元を指す、AcroForm が数える)
+# 辞書はまとめない。ストリーム (画像・フォントファイル・ページの内容) と配列は /XRef などを除いてまとめる
+_SHAREABLE_TYPES = ('/Font', '/FontDescriptor', '/ExtGState', '/XObject', '/Encoding', '/Pattern')
+_UNSHAREABLE_STREAMS = ('/XRef', '/ObjStm')
+# Pillow で開き直せる画像の色空間
+_IMAGE_MODES = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L'}
+# これより小さいストリームは圧縮しても縮まらない
+_MIN_COMPRESS_BYTES = 64
+
+
+class PdfOptimizer:
+    def __init__(self, enabled=True, image_dpi=0, jpeg_quality=75, object_streams=True, linearize=False):
+        self.enabled = enabled
+        self.image_dpi = image_dpi
+        self.jpeg_quality = jpeg_quality
+        self.object_streams = object_streams
+        self.linearize = linearize
+        self.qpdf = shutil.which('qpdf') if object_streams or linearize else None
+        if linearize and not self.qpdf:
+            logger.warning('PDF_LINEARIZE is set but qpdf is not installed; outputs will not be linearized')
+
+    @classmethod
+    def from_env(cls, split_parts=False):
+        """
+        PDF_OPTIMIZE=0 で無効、PDF_IMAGE_DPI で画像の縮小 (0 で縮小しない)、
+        PDF_OBJECT_STREAMS=0 でオブジェクトストリーム化を行わない。PDF_LINEARIZE=1 で線形化する。
+        split_parts (分割のパートを書き出す) のときは、オブジェクトストリーム化は
+        PDF_SPLIT_OBJECT_STREAMS=1 のときだけ行う (1000ページを1ページずつ分ければ qpdf も1000回起動するため)。
+        """
+        if split_parts:
+            object_streams = os.environ.get('PDF_SPLIT_OBJECT_STREAMS', '0') == '1'
+        else:
+            object_streams = os.environ.get('PDF_OBJECT_STREAMS', '1') != '0'
+        return cls(
+            enabled=os.environ.get('PDF_OPTIMIZE', '1') != '0',
+            image_dpi=int(os.environ.get('PDF_IMAGE_DPI', 0)),
+            jpeg_quality=int(os.environ.get('PDF_JPEG_QUALITY', 75)),
+            object_streams=object_streams,
+            linearize=os.environ.get('PDF_LINEARIZE', '0') == '1',
+        )
+
+    def write(self, writer, output):
+        """
+        writer を最適化して output (ファイルパスか書き込み可能なストリーム) に書き出し、
+        {'bytes', 'saved_bytes', 'seconds', ...} を返す。writer の中身は書き換わる。
+        """
+        start = time.perf_counter()
+        report = {'deduplicated': 0, 'compressed': 0, 'downsampled': 0, 'object_streams': False, 'linearized': False}
+        saved = {}
+        if self.enabled:
+            with stage('optimize'):
+                # 先にまとめておくと、同じ画像を何度も縮小せずに済む
+                report['deduplicated'], saved['dedup'] = _deduplicate(writer)
+                if self.image_dpi:
+                    report['downsampled'], saved['images'] = self._downsample_images(writer)
+                report['compressed'], saved['compress'] = _compress_streams(writer)
+
+        if self.qpdf and (self.enabled or self.linearize):
+            size, saved['object_streams'], rewritten = self._write_with_qpdf(writer, output)
+            report['object_streams'] = rewritten and self.enabled and self.object_streams
+            report['linearized'] = rewritten and self.linearize
+        else:
+            with stage('optimize_write'):
+                size = _write(writer, output)
+
+        for step, nbytes in saved.items():
+            if nbytes > 0:
+                OPTIMIZE_SAVED_BYTES.inc(nbytes, step=step)
+        report.update(bytes=size, saved_bytes=max(sum(saved.values()), 0),
+                      seconds=round(time.perf_counter() - start, 3))
+        return report
+
+    def _write_with_qpdf(self, writer, output):
+        """qpdf で書き直して output に書き出し、(大きさ, 減った大きさ, 書き直したか) を返す。"""
+        command = [self.qpdf]
+        if self.enabled and self.object_streams:
+            command += ['--object-streams=generate', '--compress-streams=y']
+        if self.linearize:
+            command.append('--linearize')
+        with tempfile.TemporaryDirectory(prefix='webtools_optimize_') as tmp:
+            plain_path = os.path.join(tmp, 'plain.pdf')
+            packed_path = os.path.join(tmp, 'packed.pdf')
+            with stage('optimize_write'):
+                plain_size = _write(writer, plain_path)
+            with stage('qpdf'):
+                # 終了コード 3 は警告があったが書き出せたという意味
+                result = subprocess.run(command + [plain_path, packed_path],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            rewritten = result.returncode in (0, 3) and os.path.exists(packed_path)
+            if not rewritten:
+                logger.warning('qpdf failed (%d): %s', result.returncode, result.stderr.decode(errors='replace').strip())
+            elif not self.linearize and os.path.getsize(packed_path) >= plain_size:
+                rewritten = False  # 小さくならなければ元のまま (線形化したものは大きくなっても使う)
+            if not rewritten:
+                packed_path = plain_path
+            size = os.path.getsize(packed_path)
+            if isinstance(output, (str, os.PathLike)):
+                shutil.move(packed_path, output)
+            else:
+                with open(packed_path, 'rb') as f:
+                    shutil.copyfileobj(f, output)
+        return size, plain_size - size, rewritten
+
+    def _downsample_images(self, writer):
+        from PyPDF2.generic import IndirectObject
+
+        count = saved = 0
+        done = set()
+        for page in writer.pages:
+            resources = page['/Resources'] if '/Resources' in page else {}
+            xobjects = resources['/XObject'] if '/XObject' in resources else {}
+            # ページ全体に広げたときに image_dpi になる大きさ (px) を上限にする
+            limit = max(float(page.mediabox.width), float(page.mediabox.height)) / 72 * self.image_dpi
+            for ref in xobjects.values():
+                if not isinstance(ref, IndirectObject) or ref.idnum in done:
+                    continue
+                done.add(ref.idnum)
+                image = ref.get_object()
+                try:
+                    replacement = self._resized_image(image, limit)
+                except Exception as e:
+                    logger.debug('Skipping image %d: %s', ref.idnum, e)
+                    continue
+                if replacement is not None:
+                    saved += len(image._data) - len(replacement._data)
+                    writer._objects[ref.idnum - 1] = replacement
+                    count += 1
+        return count, saved
+
+    def _resized_image(self, image, limit):
+        """縮小した画像のストリーム。縮小しない (できない) ときは None。"""
+        from PIL import Image
+        from PyPDF2.generic import DecodedStreamObject, NameObject, NumberObject
+
+        if image.get('/Subtype') != '/Image' or image.get('/ImageMask') or '/Decode' in image:
+            return None
+        width, height = int(image['/Width']), int(image['/Height'])
+        mode = _IMAGE_MODES.get(image.get('/ColorSpace'))
+        if max(width, height) <= limit or mode is None or image.get('/BitsPerComponent') != 8:
+            return None
+
+        filters = image.get('/Filter')
+        jpeg = filters == '/DCTDecode'
+        if jpeg:
+            picture = Image.open(BytesIO(image._data))
+            picture.draft(mode, (width, height))
+        elif filters in (None, '/FlateDecode'):
+            picture = Image.frombytes(mode, (width, height), image.get_data())
+        else:
+            return None
+        scale = limit / max(width, height)
+        picture = picture.convert(mode).resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+        stream = DecodedStreamObject()
+        for key, value in image.items():
+            if key not in ('/Filter', '/DecodeParms', '/Length'):
+                stream[NameObject(key)] = value
+        stream[NameObject('/Width')] = NumberObject(picture.width)
+        stream[NameObject('/Height')] = NumberObject(picture.height)
+        if jpeg:
+            buffer = BytesIO()
+            picture.save(buffer, format='JPEG', quality=self.jpeg_quality)
+            stream._data = buffer.getvalue()
+            stream[NameObject('/Filter')] = NameObject('/DCTDecode')
+        else:
+            stream._data = picture.tobytes()
+            stream = _flate_encode(stream)
+        return stream if len(stream._data) < len(image._data) else None
+
+
+def _write(writer, output):
+    """書き出して大きさを返す。"""
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, 'wb') as f:
+            writer.write(f)
+        return os.path.getsize(output)
+    start = output.tell()
+    writer.write(output)
+    return output.tell() - start
+
+
+def _serialize(obj):
+    buffer = BytesIO()
+    obj.write_to_stream(buffer, None)
+    return buffer.getvalue()
+
+
+def _deduplicate(writer):
+    """
+    内容が同じオブジェクトへの参照を、最初の1つへの参照に置き換える。
+    参照先がまとまると参照元も同じ内容になるので (同じフォントを指すフォント辞書など)、
+    まとめるものがなくなるまで繰り返す。まとめたオブジェクトは null にして残す
+    (PyPDF2 の相互参照表はオブジェクト番号が連続している前提なので、詰めることはできない)。
+
+    各オブジェクトのキー (内容のハッシュ) は1回だけ求め、2回目以降は参照を置き換えた
+    オブジェクトだけ求め直す。ストリームの中身 (画像など) は参照の置き換えで変わらないので、
+    中身のハッシュは最初の1回だけ計算する。
+    """
+    from PyPDF2.generic import NullObject
+
+    objects = writer._objects
+    protected = {ref.idnum for ref in (writer._root, writer._info, writer._pages) if ref is not None}
+    candidates = [idnum for idnum, obj in enumerate(objects, start=1)
+                  if idnum not in protected and _can_share(obj)]
+    keys = {}
+    data_hashes = {}
+    dirty = candidates
+    count = saved = 0
+    while dirty:
+        for idnum in dirty:
+            keys[idnum] = _object_key(objects[idnum - 1], idnum, data_hashes)
+        seen = {}
+        duplicates = {}
+        for idnum in candidates:
+            key, size = keys[idnum]
+            if key in seen:
+                duplicates[idnum] = seen[key]
+                saved += size
+            else:
+                seen[key] = idnum
+        if not duplicates:
+            break
+        changed = {idnum for idnum, obj in enumerate(objects, start=1)
+                   if obj is not None and _replace_references(obj, duplicates)}
+        for idnum in duplicates:
+            objects[idnum - 1] = NullObject()
+        candidates = [idnum for idnum in candidates if idnum not in duplicates]
+        # 参照が変わらなかったオブジェクトのキーはそのまま使える
+        dirty = [idnum for idnum in candidates if idnum in changed]
+        count += len(duplicates)
+    return count, saved
+
+
+def _can_share(obj):
+    from PyPDF2.generic import ArrayObject, DictionaryObject, StreamObject
+
+    if isinstance(obj, StreamObject):
+        return obj.get('/Type') not in _UNSHAREABLE_STREAMS
+    if isinstance(obj, DictionaryObject):
+        return obj.get('/Type') in _SHAREABLE_TYPES
+    return isinstance(obj, ArrayObject)
+
+
+def _object_key(obj, idnum, data_hashes):
+    """(内容のハッシュ, 書き出したときのおよその大きさ)。ストリームの中身のハッシュは data_hashes に残す。"""
+    from PyPDF2.generic import DictionaryObject, StreamObject
+
+    if not isinstance(obj, StreamObject):
+        data = _serialize(obj)
+        return hashlib.sha256(data).digest(), len(data)
+    if idnum not in data_hashes:
+        data_hashes[idnum] = hashlib.sha256(obj._data).digest()
+    buffer = BytesIO()
+    DictionaryObject.write_to_stream(obj, buffer, None)  # 辞書の部分だけ (/Length は中身のハッシュに含まれる)
+    head = buffer.getvalue()
+    return hashlib.sha256(head + data_hashes[idnum]).digest(), len(head) + len(obj._data)
+
+
+def _replace_references(obj, duplicates):
+    """obj (の中の直接オブジェクト) にある duplicates への参照を置き換え、置き換えたかどうかを返す。"""
+    from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject
+
+    changed = False
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, DictionaryObject):
+            items = list(current.items())
+        elif isinstance(current, ArrayObject):
+            items = list(enumerate(current))
+        else:
+            continue
+        for key, value in items:
+            if isinstance(value, IndirectObject):
+                if value.idnum in duplicates:
+                    current[key] = IndirectObject(duplicates[value.idnum], 0, value.pdf)
+                    changed = True
+            elif isinstance(value, (DictionaryObject, ArrayObject)):
+                stack.append(value)
+    return changed
+
+
+def _compress_streams(writer):
+    """フィルタの付いていないストリームを Flate で圧縮する。"""
+    from PyPDF2.generic import StreamObject
+
+    count = saved = 0
+    for index, obj in enumerate(writer._objects):
+        if not isinstance(obj, StreamObject) or '/Filter' in obj:
+            continue
+        data = obj.get_data()
+        if len(data) < _MIN_COMPRESS_BYTES:
+            continue
+        compressed = _flate_encode(obj)
+        if len(compressed._data) < len(data):
+            writer._objects[index] = compressed
+            saved += len(data) - len(compressed._data)
+            count += 1
+    return count, saved
+
+
+def _flate_encode(stream):
+    # PyPDF2 の flate_encode は /Filter 以外のキー (/Subtype や /Width など) を引き継がない
+    from PyPDF2.generic import NameObject
+
+    encoded = stream.flate_encode()
+    for key, value in stream.items():
+        if key not in ('/Filter', '/Length'):
+            encoded[NameObject(key)] = value
+    return encoded
+
+
+def combine_reports(reports):
+    """複数の出力 (分割パートなど) の結果を1つにまとめる。"""
+    total = {'bytes': 0, 'saved_bytes': 0, 'seconds': 0.0, 'deduplicated': 0, 'compressed': 0,
+             'downsampled': 0, 'object_streams': False, 'linearized': False}
+    for report in reports:
+        for key in ('bytes', 'saved_bytes', 'seconds', 'deduplicated', 'compressed', 'downsampled'):
+            total[key] += report[key]
+        for key in ('object_streams', 'linearized'):
+            total[key] = total[key] or report[key]
+    total['seconds'] = round(total['seconds'], 3)
+    return total
@@ -0,0 +1,146 @@
+"""
+PDFのページ画像をまとめて生成し、render_cache に格納する。
+
+1ページごとに convert_from_path を呼ぶと、そのたびに pdftoppm が起動して PDF 全体を
+解析し直す。ここではキャッシュにないページを連続した範囲にまとめ、範囲ごとに
+pdftoppm を1回だけ起動して PNG を直接ファイルに書き出させる (PIL での再エンコードもしない)。
+
+範囲はプールで並列に処理する。実際の処理は pdftoppm の子プロセスで行われるので、
+プールはスレッドで十分である。プールのサイズはワーカーごとの上限で、全ワーカーを通した
+同時実行数は render_governor のスロットで制限する (スロットが空くまで待つ)。
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from webtools_common.instrumentation import stage
+from webtools_common.render_governor import RenderBusy, estimate_cost, get_governor
+
+logger = logging.getLogger(__name__)
+
+# 1回の pdftoppm で処理するページ数の下限。これより細かく分けても起動コストの方が大きい
+MIN_PAGES_PER_TASK = 8
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def pool_size():
+    return int(os.environ.get('RENDER_POOL_SIZE', os.cpu_count() or 1))
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # fork 前に作られたプールのスレッドは子プロセスには存在しないので、プロセスごとに作る
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=pool_size(), thread_name_prefix='rasterize')
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _page_runs(page_indexes, max_run):
+    """ソート済みのページ番号を、連続していて長さ max_run 以下の (first, last) 範囲に分ける。"""
+    runs = []
+    for page in page_indexes:
+        if runs and page == runs[-1][1] + 1 and page - runs[-1][0] < max_run:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return [tuple(run) for run in runs]
+
+
+def _render_run(cache, pdf_path, doc_hash, first, last, width, page_count, interactive):
+    """first..last (0ベース) を1回の pdftoppm で描画してキャッシュに格納する。"""
+    from pdf2image import convert_from_path
+
+    rendered = {}
+    # os.replace でキャッシュに移せるよう、一時ディレクトリはキャッシュと同じファイルシステムに作る
+    with cache.temporary_directory() as tmp_dir:
+        try:
+            cost = estimate_cost(last - first + 1, width, os.path.getsize(pdf_path), page_count)
+            # pdftoppm が PNG まで書き出すので、ラスタライズとエンコードは1つの段階として計測する
+            with get_governor().slot(cost, interactive=interactive), stage('rasterize', pages=last - first + 1):
+                paths = convert_from_path(
+                    pdf_path,
+                    first_page=first + 1,
+                    last_page=last + 1,
+                    size=(width, None),
+                    fmt='png',
+                    output_folder=tmp_dir,
+                    paths_only=True,
+                )
+        except RenderBusy:
+            raise  # 呼び出し元のリクエストを 503 にする (interactive のときだけ起きる)
+        except Exception as e:
+            logger.error('Batch rasterization failed for %s pages %d-%d: %s', pdf_path, first + 1, last + 1, e)
+            return rendered
+        for tmp_path in paths:
+            # pdftoppm の出力名は "<prefix>-<1始まりのページ番号>.png"
+            page_index = int(os.path.splitext(os.path.basename(tmp_path))[0].rsplit('-', 1)[1]) - 1
+            path = cache.entry_path(doc_hash, page_index, width=width)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cache.commit(tmp_path, path)
+            rendered[page_index] = path
+    return rendered
+
+
+def missing_pages(cache, documents, width):
+    """documents のうち、まだキャッシュにないページの数を返す。"""
+    count = 0
+    for _, doc_hash, page_count in documents:
+        for page_index in range(page_count):
+            if not os.path.exists(cache.entry_path(doc_hash, page_index, width=width)):
+                count += 1
+    return count
+
+
+def render_documents(cache, documents, width, progress=None, interactive=False, pages=None):
+    """
+    複数のPDFのサムネイルをまとめて用意する。
+
+    documents は (pdf_path, doc_hash, page_count) のリスト。
+    戻り値は doc_hash ごとの {page_index: キャッシュ上のパス} で、生成に失敗したページは含まれない。
+    progress を渡すと、範囲の描画が終わるたびに progress(描画済みページ数, 未生成ページ数) を呼ぶ。
+    interactive はリクエストの応答を待たせている描画か (render_governor の slot() を参照)。
+    そのときは描画の空きがなければ RenderBusy を送出する。
+    pages (ページ番号のリスト) を渡すと、各文書のそのページだけを用意する。
+    """
+    results = {}
+    missing = []  # (pdf_path, doc_hash, page_count, [page_index, ...])
+    for pdf_path, doc_hash, page_count in documents:
+        if doc_hash in results:
+            continue  # 同じ内容のPDFは1回だけ描画する
+        results[doc_hash] = {}
+        todo = []
+        for page_index in (range(page_count) if pages is None else pages):
+            path = cache.get(doc_hash, page_index, width=width)
+            if path:
+                results[doc_hash][page_index] = path
+            else:
+                todo.append(page_index)
+        if todo:
+            missing.append((pdf_path, doc_hash, page_count, todo))
+    if not missing:
+        return results
+
+    # 未生成のページをプールのワーカー数ぶんのタスクに分けられる大きさで範囲にまとめる
+    total_missing = sum(len(pages) for _, _, _, pages in missing)
+    max_run = max(MIN_PAGES_PER_TASK, -(-total_missing // pool_size()))
+    pool = _get_pool()
+    tasks = {}
+    for pdf_path, doc_hash, page_count, pages in missing:
+        for first, last in _page_runs(pages, max_run):
+            future = pool.submit(_render_run, cache, pdf_path, doc_hash, first, last, width, page_count, interactive)
+            tasks[future] = (doc_hash, last - first + 1)
+
+    done = 0
+    for future in as_completed(tasks):
+        doc_hash, page_count = tasks[future]
+        results[doc_hash].update(future.result())
+        done += page_count
+        if progress:
+            progress(done, total_missing)
+    return results
@@ -0,0 +1,226 @@
+"""
+ページ画像のディスクキャッシュ。
+
+キーは「PDFの内容のハッシュ + ページ番号 + 描画パラメータ」なので、同じファイルを
+何度アップロードしても poppler を呼ばずに済む。キャッシュディレクトリは
+pdf-splitter と pdf-merger の両方からマウントされる前提で、次の方針で実装している。
+
+- 書き込みは同じディレクトリの一時ファイルに書いてから os.replace する (アトミック)。
+  pdftoppm のように複数のファイルを書き出すものは <root>/.tmp/ の下の一時ディレクトリに書かせる
+  (LRU の走査には含めないので、書き込み中のファイルを数えたり削除したりしない)
+- 参照時に mtime を更新し、合計サイズが上限を超えたら mtime の古い順に削除する (LRU)
+- 削除処理はロックファイルで複数ワーカー間の同時実行を避ける
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from webtools_common.instrumentation import RENDER_CACHE_REQUESTS, record_bytes, stage
+from webtools_common.util import remove_quietly
+
+try:
+    import fcntl
+except ImportError:  # Windows ではロックなしで動かす
+    fcntl = None
+
+# 描画方法を変えたときはこの値を上げれば古いエントリは参照されなくなる
+RENDER_VERSION = 1
+
+_CHUNK_SIZE = 1024 * 1024
+_TMP_SUFFIX = '.tmp'
+_TMP_DIR = '.tmp'
+_STALE_TMP_SECONDS = 3600
+
+
+def file_digest(path):
+    """ファイルの SHA-256 (16進文字列) を返す。ファイル全体をメモリに載せない。"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_with_digest(file_storage, save_path):
+    """
+    アップロードされたファイルを保存しつつ SHA-256 を計算する。
+    保存後にもう一度読み直す必要がないよう、書き込みと同時にハッシュを更新する。
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with stage('save_upload'), open(save_path, 'wb') as out:
+        for chunk in iter(lambda: file_storage.stream.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    record_bytes('save_upload', size)
+    return digest.hexdigest()
+
+
+class RenderCache:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._approx_bytes = None  # 初回の put 時にディレクトリを走査して求める
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        root = os.environ.get('RENDER_CACHE_DIR',
+                              os.path.join(tempfile.gettempdir(), 'webtools_render_cache'))
+        max_bytes = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+        return cls(root, max_bytes)
+
+    @staticmethod
+    def entry_key(doc_hash, page_index, **params):
+        """
+        エントリのキー (16進文字列)。同じキーなら同じ画像なので、HTTP の ETag にも使える。
+        params には幅やDPIなど描画結果を変える値をすべて渡すこと。
+        """
+        param_str = ','.join(f"{k}={params[k]}" for k in sorted(params))
+        return hashlib.sha256(
+            f"v{RENDER_VERSION}:{doc_hash}:{page_index}:{param_str}".encode('utf-8')
+        ).hexdigest()
+
+    def entry_path(self, doc_hash, page_index, ext='png', **params):
+        """キャッシュエントリのパス。"""
+        key = self.entry_key(doc_hash, page_index, **params)
+        return os.path.join(self.root, key[:2], f"{key}.{ext}")
+
+    def get(self, doc_hash, page_index, ext='png', **params):
+        """キャッシュ済みならそのパスを、なければ None を返す。"""
+        path = self.entry_path(doc_hash, page_index, ext=ext, **params)
+        try:
+            os.utime(path)  # LRU のために最終参照時刻を更新
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            RENDER_CACHE_REQUESTS.inc(result='miss')
+            return None
+        with self._lock:
+            self.hits += 1
+        RENDER_CACHE_REQUESTS.inc(result='hit')
+        return path
+
+    def get_or_render(self, doc_hash, page_index, render, ext='png', **params):
+        """
+        キャッシュにあればそのパスを返し、なければ render(tmp_path) で生成して格納する。
+        render は tmp_path に画像を書き出し、失敗時は None を返す関数。
+        """
+        path = self.get(doc_hash, page_index, ext=ext, **params)
+        if path:
+            return path
+        path = self.entry_path(doc_hash, page_index, ext=ext, **params)
+        tmp_path = self.tmp_path_for(path)
+        try:
+            if not render(tmp_path) or not os.path.exists(tmp_path):
+                return None
+            self.commit(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def tmp_path_for(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f"{path}.{uuid.uuid4().hex}{_TMP_SUFFIX}"
+
+    def temporary_directory(self):
+        """エントリを書き出すための一時ディレクトリ (with で使う)。commit で同じファイルシステムに移せる。"""
+        tmp_root = os.path.join(self.root, _TMP_DIR)
+        os.makedirs(tmp_root, exist_ok=True)
+        return tempfile.TemporaryDirectory(dir=tmp_root)
+
+    def commit(self, tmp_path, path):
+        """一時ファイルをエントリとして確定させる。同じキーを別ワーカーが書いていても壊れない。"""
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        self._account(size)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self._approx_bytes or 0,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _account(self, size):
+        with self._lock:
+            if self._approx_bytes is None:
+                self._approx_bytes = self._scan_size()
+            else:
+                self._approx_bytes += size
+            over = self._approx_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def _iter_entries(self):
+        for sub in os.scandir(self.root):
+            if not sub.is_dir() or sub.name == _TMP_DIR:
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.is_file():
+                    yield entry
+
+    def _scan_size(self):
+        return sum(e.stat().st_size for e in self._iter_entries() if not e.name.endswith(_TMP_SUFFIX))
+
+    def evict(self):
+        """合計サイズが上限の 9 割になるまで、最終参照の古いエントリから削除する。"""
+        lock_file = open(os.path.join(self.root, '.evict.lock'), 'w')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return  # 他のワーカーが削除中
+            now = time.time()
+            entries = []
+            for entry in self._iter_entries():
+                st = entry.stat()
+                if entry.name.endswith(_TMP_SUFFIX):
+                    # 書き込み途中で落ちたワーカーの残骸
+                    if now - st.st_mtime > _STALE_TMP_SECONDS:
+                        remove_quietly(entry.path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+            self._sweep_tmp_dirs(now)
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            removed = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                if remove_quietly(path):
+                    total -= size
+                    removed += 1
+            with self._lock:
+                self._approx_bytes = total
+                self.evictions += removed
+        finally:
+            lock_file.close()
+
+    def _sweep_tmp_dirs(self, now):
+        """描画の途中で落ちたワーカーが残した一時ディレクトリを削除する。"""
+        try:
+            dirs = list(os.scandir(os.path.join(self.root, _TMP_DIR)))
+        except FileNotFoundError:
+            return
+        for entry in dirs:
+            try:
+                if now - entry.stat().st_mtime > _STALE_TMP_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
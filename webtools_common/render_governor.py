@@ -0,0 +1,268 @@
+"""
+poppler (pdftoppm) の同時実行数を、gunicorn の全ワーカーを通して制限する。
+
+rasterize.py のプールや各アプリのスレッド数はワーカーごとの値なので、ワーカーが
+増えるとそのぶん pdftoppm も増え、CPU とメモリを取り合ってどれも遅くなる。
+ここではディレクトリ (RENDER_GOVERNOR_DIR) 上のファイルで次のことを行う。
+
+- スロット: slot-<n>.lock を fcntl.flock で排他ロックしている間だけ pdftoppm を動かせる。
+  ロックはプロセスが落ちればカーネルが外すので、残骸で詰まることはない
+- 待ち行列: 描画を待っている (または実行中の) 要求ごとにチケットファイルを置く。
+  ファイル名には作った時刻・プロセスID・コスト (ページ数と大きさからの見積もり) が入っていて、
+  どのワーカーからも待ち行列の長さと合計コストがわかる。スロットは到着順 (FIFO) に渡し、
+  自分より前に待っているチケットが空きスロットの数以上あるうちは取りにいかない。
+  チケットは持ち主がロックしているので、ロックを取れたチケットは落ちたワーカーの残骸として消す。
+  ロックする前の作りかけ (.new) は、持ち主のプロセスがもういなければ消す
+
+画面のページ画像など、ユーザーが応答を待っている描画 (slot(..., interactive=True)) は、
+待ち行列の合計コストが上限を超えていればすぐに、空きを待つ時間が request_timeout を超えれば
+諦めて RenderBusy を送出する (アプリは 503 と Retry-After で返す)。バックグラウンドのジョブは
+受け付け済みなので断らず、job_timeout まで待つ。どちらかは呼び出し側が決める
+(描画はプールのスレッドで行うこともあり、そこには Flask のリクエストコンテキストがないため)。
+
+コストは「幅 200px のサムネイル1ページ」を 1 とした見積もりで、ページ数・画像の面積・
+1ページあたりのファイルサイズ (スキャン画像の多いPDFほど解析が重い) から求める。
+"""
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from webtools_common.instrumentation import RENDER_QUEUE_WAIT_SECONDS, RENDER_REJECTED
+from webtools_common.util import pid_alive, remove_quietly
+
+try:
+    import fcntl
+except ImportError:  # Windows では制限なしで動かす
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_BASE_WIDTH = 200
+_MB = 1024 * 1024
+_POLL_MIN = 0.02
+_POLL_MAX = 0.2
+_TICKET_SUFFIX = '.ticket'
+_NEW_SUFFIX = '.new'
+_STALE_NEW_SECONDS = 60
+
+
+class RenderBusy(Exception):
+    """描画の空きがない。retry_after はクライアントに再試行を勧める秒数。"""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(f"rasterization is busy ({reason}); retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def estimate_cost(pages, width=_BASE_WIDTH, file_bytes=0, page_count=None):
+    """
+    pages ページを幅 width px で描画するコスト。file_bytes と page_count (PDF全体のサイズと
+    ページ数) を渡すと、1ページあたりのサイズが大きいほど重く見積もる (最大5倍)。
+    """
+    area = max(1.0, (width / _BASE_WIDTH) ** 2)
+    weight = 1.0
+    if file_bytes and page_count:
+        weight += min(4.0, file_bytes / page_count / _MB)
+    return round(pages * area * weight, 2)
+
+
+class RenderGovernor:
+    def __init__(self, root, slots, max_queue_cost, request_timeout, job_timeout, seconds_per_cost=0.05):
+        self.root = root
+        self.slots = slots
+        self.max_queue_cost = max_queue_cost
+        self.request_timeout = request_timeout
+        self.job_timeout = job_timeout
+        # 実際にかかった時間から更新する (Retry-After の見積もり用。プロセスごと)
+        self.seconds_per_cost = seconds_per_cost
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        root = os.environ.get('RENDER_GOVERNOR_DIR',
+                              os.path.join(tempfile.gettempdir(), 'webtools_render_governor'))
+        slots = int(os.environ.get('RENDER_MAX_CONCURRENT', os.cpu_count() or 1))
+        return cls(
+            root,
+            slots=slots,
+            max_queue_cost=float(os.environ.get('RENDER_MAX_QUEUE_COST', slots * 200)),
+            request_timeout=float(os.environ.get('RENDER_REQUEST_TIMEOUT', 10)),
+            job_timeout=float(os.environ.get('RENDER_JOB_TIMEOUT', 600)),
+        )
+
+    # --- 待ち行列 (チケット) ---
+
+    def _tickets(self):
+        """
+        生きているチケットの (状態, 順番, コスト) のリスト。状態は 'q' (待ち) か 'r' (実行中)、
+        順番は (作った時刻, ID) で、小さいほど先に来た。
+        """
+        tickets = []
+        for entry in os.scandir(self.root):
+            name = entry.name
+            if name.endswith(_NEW_SUFFIX):
+                name, new = name[:-len(_NEW_SUFFIX)], True
+            else:
+                new = False
+            parts = name[:-len(_TICKET_SUFFIX)].split('-')
+            if len(parts) != 5 or parts[0] not in ('q', 'r') or not name.endswith(_TICKET_SUFFIX):
+                continue
+            state, created, pid, ticket_id, cost = parts
+            try:
+                created, pid, cost = int(created), int(pid), float(cost)
+            except ValueError:
+                continue
+            if new:
+                if self._is_stale_new(entry.path, pid):
+                    remove_quietly(entry.path)
+                continue
+            if self._is_stale(entry.path):
+                remove_quietly(entry.path)
+                continue
+            tickets.append((state, (created, ticket_id), cost))
+        return tickets
+
+    @staticmethod
+    def _is_stale(path):
+        if fcntl is None:
+            return False
+        try:
+            with open(path, 'rb') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False  # 持ち主が生きている
+                return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _is_stale_new(path, pid):
+        """ロックして名前を変える前に持ち主が落ちた .new か。"""
+        if not pid_alive(pid):
+            return True
+        # pid が別のプロセスに再利用された場合に備え、古いものも消す (名前を変えるまでは一瞬)
+        try:
+            return time.time() - os.stat(path).st_mtime > _STALE_NEW_SECONDS
+        except FileNotFoundError:
+            return False
+
+    def stats(self):
+        tickets = self._tickets()
+        return {
+            'queued': sum(1 for state, _, _ in tickets if state == 'q'),
+            'running': sum(1 for state, _, _ in tickets if state == 'r'),
+            'queued_cost': round(sum(cost for state, _, cost in tickets if state == 'q'), 2),
+            'slots': self.slots,
+        }
+
+    def retry_after(self, tickets=None):
+        """いまの待ち行列が捌けるまでの見積もり (秒、1〜300)。"""
+        if tickets is None:
+            tickets = self._tickets()
+        backlog = sum(cost for _, _, cost in tickets)
+        return max(1, min(300, math.ceil(backlog * self.seconds_per_cost / self.slots)))
+
+    # --- スロット ---
+
+    def _my_turn(self, order):
+        """順番が order のチケットがスロットを取りにいってよいか (前に待っているチケットが空きより少ない)。"""
+        tickets = self._tickets()
+        running = sum(1 for state, _, _ in tickets if state == 'r')
+        ahead = sum(1 for state, other, _ in tickets if state == 'q' and other < order)
+        return ahead < self.slots - running
+
+    def _try_slot(self):
+        for n in range(self.slots):
+            f = open(os.path.join(self.root, f"slot-{n}.lock"), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            return f
+        return None
+
+    @contextmanager
+    def slot(self, cost, interactive=False):
+        """
+        スロットを1つ確保している間だけ with の中を実行する。
+        interactive なら、待ち行列が一杯か request_timeout 待っても空かなければ RenderBusy を送出する。
+        """
+        if fcntl is None:
+            yield
+            return
+        timeout = self.request_timeout if interactive else self.job_timeout
+        if interactive and self.max_queue_cost:
+            tickets = self._tickets()
+            queued = sum(c for state, _, c in tickets if state == 'q')
+            # 待ちがなければ、上限より大きい要求でも受け付ける (永久に断らないように)
+            if queued and queued + cost > self.max_queue_cost:
+                RENDER_REJECTED.inc(reason='queue_full')
+                raise RenderBusy(self.retry_after(tickets), 'queue_full')
+
+        order = (time.time_ns(), uuid.uuid4().hex)
+        ticket_name = f"{order[0]}-{os.getpid()}-{order[1]}-{cost}{_TICKET_SUFFIX}"
+        ticket_path = os.path.join(self.root, f"q-{ticket_name}")
+        # ロックしてから名前を付けるので、他のワーカーがロック前のチケットを残骸と見なすことはない
+        ticket = open(f"{ticket_path}{_NEW_SUFFIX}", 'w')
+        fcntl.flock(ticket, fcntl.LOCK_EX)
+        os.replace(f"{ticket_path}{_NEW_SUFFIX}", ticket_path)
+        slot_file = None
+        try:
+            start = time.perf_counter()
+            deadline = time.monotonic() + timeout
+            delay = _POLL_MIN
+            while True:
+                if self._my_turn(order):
+                    slot_file = self._try_slot()
+                    if slot_file is not None:
+                        break
+                if time.monotonic() >= deadline:
+                    RENDER_QUEUE_WAIT_SECONDS.observe(time.perf_counter() - start, result='timeout')
+                    RENDER_REJECTED.inc(reason='timeout')
+                    raise RenderBusy(self.retry_after(), 'timeout')
+                time.sleep(delay)
+                delay = min(delay * 2, _POLL_MAX)
+            waited = time.perf_counter() - start
+            RENDER_QUEUE_WAIT_SECONDS.observe(waited, result='acquired')
+            if waited > 1:
+                logger.info('Waited %.2fs for a rasterization slot (cost %s)', waited, cost)
+
+            running_path = os.path.join(self.root, f"r-{ticket_name}")
+            os.replace(ticket_path, running_path)
+            ticket_path = running_path
+            start = time.perf_counter()
+            yield
+            self._observe(cost, time.perf_counter() - start)
+        finally:
+            if slot_file is not None:
+                slot_file.close()  # ロックも外れる
+            remove_quietly(ticket_path)
+            ticket.close()
+
+    def _observe(self, cost, seconds):
+        if cost <= 0:
+            return
+        with self._lock:
+            self.seconds_per_cost = 0.8 * self.seconds_per_cost + 0.2 * (seconds / cost)
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor():
+    """環境変数から作った共有のインスタンス (rasterize.py と各アプリの1ページ描画で使う)。"""
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = RenderGovernor.from_env()
+        return _governor
@@ -0,0 +1,163 @@
+"""
+アップロードしたPDF・結合結果・分割ZIPなど、ワークスペースごとに作られるファイルの置き場所と後片付け。
+
+ファイルは <root>/<ワークスペースID>/ にまとめて置く (/tmp 直下に平置きしない)。
+バックグラウンドのスイーパーが定期的に次を行う。
+
+- 最終アクセスから ttl 秒を過ぎたワークスペースをディレクトリごと削除する
+  (最終アクセス時刻は WorkspaceStore が記録しているものを使う)
+- 残ったファイルの合計が quota_bytes を超えていれば、最終アクセスの古いワークスペースから削除する
+- 終了したジョブの状態ファイルのうち ttl を過ぎたものを削除する
+
+ページ画像は内容ハッシュで共有されるので、ワークスペースとは別に render_cache のLRUで管理している。
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows ではロックなしで動かす
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class StorageManager:
+    def __init__(self, root, workspace_store, ttl, quota_bytes, sweep_interval, job_queue=None):
+        self.root = root
+        self.workspace_store = workspace_store
+        self.job_queue = job_queue
+        self.ttl = ttl
+        self.quota_bytes = quota_bytes
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+        self.reclaimed_bytes = 0
+        self.live_bytes = 0
+        self.live_workspaces = 0
+        self.sweeps = 0
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, name, workspace_store, job_queue=None):
+        """name はアプリ名。アプリごとに別のディレクトリを使う。"""
+        root = os.environ.get('STORAGE_DIR', os.path.join(tempfile.gettempdir(), 'webtools_storage'))
+        return cls(
+            os.path.join(root, name),
+            workspace_store,
+            ttl=int(os.environ.get('STORAGE_TTL_SECONDS', 6 * 3600)),
+            quota_bytes=int(os.environ.get('STORAGE_QUOTA_BYTES', 5 * 1024 * 1024 * 1024)),
+            sweep_interval=int(os.environ.get('STORAGE_SWEEP_INTERVAL', 300)),
+            job_queue=job_queue,
+        )
+
+    def workspace_dir(self, workspace_id):
+        path = os.path.join(self.root, workspace_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def workspace_path(self, workspace_id, filename):
+        """ワークスペース内のファイルのパス (ディレクトリは作成済み)。"""
+        return os.path.join(self.workspace_dir(workspace_id), filename)
+
+    def remove_workspace(self, workspace_id):
+        """ワークスペースのファイルをすべて削除し、削除したバイト数を返す。"""
+        path = os.path.join(self.root, workspace_id)
+        size = _dir_size(path)
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self.reclaimed_bytes += size
+        return size
+
+    def ensure_sweeper(self):
+        """このプロセスでスイーパーが動いていなければ起動する (fork 後のワーカーでも1回だけ起動される)。"""
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name='storage-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Storage sweep failed')
+
+    def sweep(self):
+        """期限切れ・容量超過のワークスペースを削除し、今回削除したバイト数を返す。"""
+        lock_file = open(os.path.join(self.root, '.sweep.lock'), 'w')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return 0  # 他のワーカーが掃除中
+            return self._sweep_locked()
+        finally:
+            lock_file.close()
+
+    def _sweep_locked(self):
+        now = time.time()
+        expire_before = now - self.ttl
+        accessed = self.workspace_store.accessed_times()
+
+        workspaces = []  # (最終アクセス, ID, サイズ)
+        reclaimed = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            # ストアにない (リセット済みなど) ワークスペースはディレクトリの更新時刻で判断する
+            last_access = accessed.get(entry.name, entry.stat().st_mtime)
+            if last_access < expire_before:
+                reclaimed += self.remove_workspace(entry.name)
+                self.workspace_store.delete(entry.name)
+            else:
+                workspaces.append((last_access, entry.name, _dir_size(entry.path)))
+
+        # ファイルのないワークスペース (セッションだけのもの) の期限切れ分も消す
+        self.workspace_store.purge(expire_before)
+
+        live_bytes = sum(size for _, _, size in workspaces)
+        workspaces.sort()
+        while workspaces and live_bytes > self.quota_bytes:
+            _, workspace_id, size = workspaces.pop(0)
+            reclaimed += self.remove_workspace(workspace_id)
+            self.workspace_store.delete(workspace_id)
+            live_bytes -= size
+
+        if self.job_queue is not None:
+            self.job_queue.prune(expire_before)
+
+        with self._lock:
+            self.live_bytes = live_bytes
+            self.live_workspaces = len(workspaces)
+            self.sweeps += 1
+        return reclaimed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'reclaimed_bytes': self.reclaimed_bytes,
+                'live_bytes': self.live_bytes,
+                'live_workspaces': self.live_workspaces,
+                'sweeps': self.sweeps,
+            }
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                pass
+    return total
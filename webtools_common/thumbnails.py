@@ -0,0 +1,216 @@
+"""
+サムネイルの配信形式 (WebP / JPEG / PNG) の選択と、複数ページを1枚にまとめた画像 (ストリップ)。
+
+ページ画像は render_cache に PNG で保存されている (rasterize.py)。ここではそれを
+
+- Accept ヘッダーから選んだ形式 (WebP > JPEG > PNG) に変換してキャッシュする
+- 1文書の連続したページを縦に並べた1枚の画像 (ストリップ) にして、まとめて1回でエンコードする
+
+ストリップの中の各ページの位置 (y と高さ) はインデックス (JSON) で返すので、画面は
+ページごとにリクエストせず、ストリップを背景画像として切り出して表示できる。
+400ページの文書でも strip_pages=25 なら16回のリクエストで済む。
+WebP は1辺 16383px までなので、ストリップの高さがこれを超えないところで区切る。
+"""
+import json
+import logging
+import os
+
+from webtools_common.instrumentation import stage
+from webtools_common.pdf_io import open_pdf_reader
+from webtools_common.rasterize import render_documents
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {  # 名前: (MIME タイプ, Pillow の形式名)
+    'webp': ('image/webp', 'WEBP'),
+    'jpeg': ('image/jpeg', 'JPEG'),
+    'png': ('image/png', 'PNG'),
+}
+# 画面や API で指定できるページ画像の幅 (px) の範囲
+MIN_WIDTH = 50
+MAX_WIDTH = 1200
+_MAX_STRIP_HEIGHT = 16383
+# インデックスやストリップの形式を変えたときはこの値を上げる
+_LAYOUT_VERSION = 2
+
+
+def _supported(fmt):
+    from PIL import features
+
+    return fmt == 'png' or features.check({'webp': 'webp', 'jpeg': 'jpg'}[fmt])
+
+
+class ThumbnailEncoder:
+    def __init__(self, cache, webp_quality=80, jpeg_quality=85, strip_pages=25):
+        self.cache = cache
+        self.qualities = {'webp': webp_quality, 'jpeg': jpeg_quality}
+        self.strip_pages = strip_pages
+        self._formats = None
+
+    @classmethod
+    def from_env(cls, cache):
+        return cls(
+            cache,
+            webp_quality=int(os.environ.get('THUMBNAIL_WEBP_QUALITY', 80)),
+            jpeg_quality=int(os.environ.get('THUMBNAIL_JPEG_QUALITY', 85)),
+            strip_pages=int(os.environ.get('THUMBNAIL_STRIP_PAGES', 25)),
+        )
+
+    @property
+    def formats(self):
+        # Pillow を読み込むので、最初に使うときに調べる (app_factory のウォームアップ参照)
+        if self._formats is None:
+            self._formats = [fmt for fmt in FORMATS if _supported(fmt)]
+        return self._formats
+
+    def negotiate(self, request):
+        """
+        形式を選ぶ。?format= があればそれを、なければ Accept に WebP が明示されていれば WebP、
+        JPEG を受け付けるなら (image/* や */* を含む) JPEG、どちらでもなければ PNG。
+        """
+        requested = request.args.get('format')
+        if requested in self.formats:
+            return requested
+        accept = request.accept_mimetypes
+        if 'webp' in self.formats and any(value == 'image/webp' and quality > 0 for value, quality in accept):
+            return 'webp'
+        if 'jpeg' in self.formats and accept['image/jpeg'] > 0:
+            return 'jpeg'
+        return 'png'
+
+    def _params(self, width, fmt, **extra):
+        # PNG は rasterize.py が書いたエントリそのものなので、キーは幅だけ
+        if fmt == 'png':
+            return dict(extra, width=width)
+        return dict(extra, width=width, format=fmt, quality=self.qualities[fmt])
+
+    def etag(self, doc_hash, page_index, width, fmt):
+        return self.cache.entry_key(doc_hash, page_index, **self._params(width, fmt))
+
+    def page_image(self, doc_hash, page_index, png_path, width, fmt):
+        """キャッシュ上の PNG (png_path) を fmt に変換したもののパス。"""
+        if fmt == 'png':
+            return png_path
+        return self.cache.get_or_render(
+            doc_hash, page_index, lambda tmp_path: self._encode([png_path], tmp_path, fmt),
+            ext=fmt, **self._params(width, fmt))
+
+    # --- ストリップ ---
+
+    def layout(self, pdf_path, doc_hash, width, interactive=False):
+        """
+        ストリップのインデックス。まだページ画像のないページはここで描画する
+        (interactive はリクエストの処理中か。rasterize.render_documents を参照)。
+        {'page_count', 'strips': [{'width', 'height', 'pages': [{'page', 'y', 'width', 'height'}, ...]}, ...]}
+        描画に失敗したページはどのストリップにも入らない (画面はページ単位の画像で表示する)。
+        """
+        params = dict(width=width, strip_pages=self.strip_pages, layout=_LAYOUT_VERSION)
+        path = self.cache.get_or_render(
+            doc_hash, 'strips', lambda tmp_path: self._write_layout(pdf_path, doc_hash, width, tmp_path, interactive),
+            ext='json', **params)
+        if not path:
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def cached_layout(self, doc_hash, width):
+        """作成済みのインデックス。まだなければ None (描画はしない)。"""
+        path = self.cache.get(doc_hash, 'strips', ext='json', width=width, strip_pages=self.strip_pages,
+                              layout=_LAYOUT_VERSION)
+        if not path:
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None  # 読む前に LRU で削除された
+
+    def layout_etag(self, doc_hash, width):
+        return self.cache.entry_key(doc_hash, 'strips', width=width, strip_pages=self.strip_pages, layout=_LAYOUT_VERSION)
+
+    def _write_layout(self, pdf_path, doc_hash, width, tmp_path, interactive):
+        from PIL import Image
+
+        with open_pdf_reader(pdf_path) as reader:
+            page_count = len(reader.pages)
+        rendered = render_documents(self.cache, [(pdf_path, doc_hash, page_count)], width,
+                                    interactive=interactive)[doc_hash]
+        strips = []
+        for page_index in range(page_count):
+            if page_index not in rendered:
+                continue
+            with Image.open(rendered[page_index]) as image:  # ヘッダーだけ読む
+                page_width, page_height = image.size
+            strip = strips[-1] if strips else None
+            if (strip is None or len(strip['pages']) >= self.strip_pages
+                    or strip['height'] + page_height > _MAX_STRIP_HEIGHT):
+                strip = {'width': 0, 'height': 0, 'pages': []}
+                strips.append(strip)
+            strip['pages'].append({'page': page_index, 'y': strip['height'], 'width': page_width, 'height': page_height})
+            strip['width'] = max(strip['width'], page_width)
+            strip['height'] += page_height
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'page_count': page_count, 'strips': strips}, f)
+        return tmp_path
+
+    def _strip_params(self, width, fmt):
+        return self._params(width, fmt, strip_pages=self.strip_pages, layout=_LAYOUT_VERSION)
+
+    def strip_etag(self, doc_hash, number, width, fmt):
+        return self.cache.entry_key(doc_hash, f'strip-{number}', **self._strip_params(width, fmt))
+
+    def strip_image(self, pdf_path, doc_hash, layout, number, width, fmt, interactive=False):
+        """
+        layout の number 番目 (0始まり) のストリップを fmt でエンコードしたもののパス。
+        インデックスを作った後にページ画像が LRU で削除されていれば、そのページを描画し直す。
+        """
+        strip = layout['strips'][number]
+
+        def compose(tmp_path):
+            page_indexes = [page['page'] for page in strip['pages']]
+            rendered = render_documents(self.cache, [(pdf_path, doc_hash, layout['page_count'])], width,
+                                        interactive=interactive, pages=page_indexes)[doc_hash]
+            if len(rendered) < len(page_indexes):
+                logger.warning('Pages of strip %d of %s could not be rendered again', number, doc_hash)
+                return None
+            return self._encode([rendered[i] for i in page_indexes], tmp_path, fmt,
+                                size=(strip['width'], strip['height']))
+
+        return self.cache.get_or_render(doc_hash, f'strip-{number}', compose, ext=fmt,
+                                        **self._strip_params(width, fmt))
+
+    def encode_strips(self, pdf_path, doc_hash, width, fmt):
+        """文書のストリップをすべて用意しておく (サムネイル生成ジョブの最後に呼ぶ)。"""
+        layout = self.layout(pdf_path, doc_hash, width)
+        for number in range(len(layout['strips']) if layout else 0):
+            self.strip_image(pdf_path, doc_hash, layout, number, width, fmt)
+
+    def _save_options(self, fmt):
+        if fmt == 'webp':
+            # method は速度と圧縮率の兼ね合い (0-6)。既定の 4 は 2 の約2倍かかるのに、大きさはほとんど変わらない
+            return {'quality': self.qualities[fmt], 'method': 2}
+        if fmt == 'jpeg':
+            return {'quality': self.qualities[fmt]}
+        return {}
+
+    def _encode(self, png_paths, tmp_path, fmt, size=None):
+        """png_paths を縦に並べて1枚にし、fmt で tmp_path に書き出す。"""
+        from PIL import Image
+
+        try:
+            with stage('encode_thumbnail', pages=len(png_paths)):
+                if size is None:
+                    with Image.open(png_paths[0]) as image:
+                        canvas = image.convert('RGB')
+                else:
+                    canvas = Image.new('RGB', size, 'white')
+                    y = 0
+                    for png_path in png_paths:
+                        with Image.open(png_path) as image:
+                            canvas.paste(image.convert('RGB'), (0, y))
+                            y += image.height
+                canvas.save(tmp_path, format=FORMATS[fmt][1], **self._save_options(fmt))
+        except (OSError, ValueError) as e:
+            logger.error('Encoding %s thumbnails failed: %s', fmt, e)
+            return None
+        return tmp_path
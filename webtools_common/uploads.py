@@ -0,0 +1,245 @@
+"""
+大きなPDFを小さなチャンクに分けて送り、途中で切れても続きから再開できるアップロード。
+
+multipart のアップロードは1回のリクエストでファイル全体を受け取るので、接続が切れると
+最初からやり直しになり、PDFでないファイルも全部受け取ってから PdfReader で失敗するまで
+わからない。ここでは次のようにする。
+
+    POST  /uploads       {"filename": ..., "size": バイト数, "sha256": (省略可)}  → upload_id
+    PATCH /uploads/<id>  ヘッダー Upload-Offset: 書き込む位置、本文はチャンクのバイト列
+    GET   /uploads/<id>  受け取り済みのバイト数 (offset)。切れたらここから再開する
+
+- チャンクはワークスペースの <id>.part に直接書く (メモリにもフォームの一時ファイルにも溜めない)
+- Upload-Offset が受け取り済みのバイト数と違うチャンクは 409 で断り、正しい offset を返す
+- 最初の 1024 バイトが揃った時点でPDFのヘッダー (%PDF-) を確かめ、違えばその場で断る
+- SHA-256 はチャンクを受け取るたびに更新する。続きのチャンクが別のワーカーに届いたときは、
+  そのワーカーで受け取り済みの部分を読み直してから続ける
+- 最後のチャンクを受け取ったら、末尾 (%%EOF と startxref)、クライアントが送った SHA-256、
+  ページ数を確かめてから <id>.pdf にする
+
+状態 (<id>.upload.json) もワークスペースに置くので、どのワーカーがチャンクを受けてもよい。
+途中で放置されたアップロードはワークスペースごとスイーパーが削除する。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from webtools_common.instrumentation import record_bytes, record_pages, stage
+from webtools_common.pdf_io import open_pdf_reader
+from webtools_common.util import is_hex_id, remove_quietly
+
+try:
+    import fcntl
+except ImportError:  # Windows ではロックなしで動かす
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_READ_SIZE = 1024 * 1024
+_HEADER_WINDOW = 1024  # ヘッダーはファイルの先頭 1024 バイト以内にあればよい (PDF の仕様)
+_TRAILER_WINDOW = 1024
+_STARTXREF = re.compile(rb'startxref\s+(\d+)\s+%%EOF')
+_MAX_HASHERS = 64
+
+
+class UploadError(Exception):
+    """アップロードを受け付けられない。status は HTTP のステータス、offset は受け取り済みのバイト数。"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.offset = offset
+
+
+class ChunkedUploads:
+    def __init__(self, storage, max_bytes, chunk_bytes):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.chunk_bytes = chunk_bytes
+        self._lock = threading.Lock()
+        # upload_id -> (受け取り済みのバイト数, その位置までの SHA-256)。このプロセスで受けたものだけ
+        self._hashers = OrderedDict()
+
+    @classmethod
+    def from_env(cls, storage):
+        return cls(
+            storage,
+            max_bytes=int(os.environ.get('UPLOAD_MAX_BYTES', 1024 * 1024 * 1024)),
+            chunk_bytes=int(os.environ.get('UPLOAD_CHUNK_BYTES', 8 * 1024 * 1024)),
+        )
+
+    def _paths(self, workspace_id, upload_id):
+        if not is_hex_id(upload_id):
+            raise UploadError('Unknown upload.', 404)
+        directory = self.storage.workspace_dir(workspace_id)
+        return (os.path.join(directory, f"{upload_id}.upload.json"),
+                os.path.join(directory, f"{upload_id}.part"),
+                os.path.join(directory, f"{upload_id}.pdf"))
+
+    def _load(self, workspace_id, upload_id):
+        meta_path, _, _ = self._paths(workspace_id, upload_id)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Unknown upload.', 404) from None
+
+    def _save(self, workspace_id, meta):
+        meta_path, _, _ = self._paths(workspace_id, meta['upload_id'])
+        tmp_path = f"{meta_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _status(self, workspace_id, meta):
+        _, part_path, pdf_path = self._paths(workspace_id, meta['upload_id'])
+        status = dict(meta, chunk_size=self.chunk_bytes)
+        if meta['complete']:
+            status['offset'] = meta['size']
+        else:
+            status['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return status
+
+    def create(self, workspace_id, filename, size, sha256=None):
+        """アップロードを始める。戻り値は status() と同じ形。"""
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise UploadError('size must be a positive integer.')
+        if size > self.max_bytes:
+            raise UploadError(f'File is larger than the limit of {self.max_bytes} bytes.', 413)
+        if sha256 is not None and not re.fullmatch(r'[0-9a-f]{64}', str(sha256)):
+            raise UploadError('sha256 must be a lowercase hex SHA-256 digest.')
+        meta = {
+            'upload_id': uuid.uuid4().hex,
+            'filename': str(filename or 'document.pdf'),
+            'size': size,
+            'expected_sha256': sha256,
+            'created': time.time(),
+            'complete': False,
+        }
+        _, part_path, _ = self._paths(workspace_id, meta['upload_id'])
+        open(part_path, 'wb').close()
+        self._save(workspace_id, meta)
+        return self._status(workspace_id, meta)
+
+    def status(self, workspace_id, upload_id):
+        return self._status(workspace_id, self._load(workspace_id, upload_id))
+
+    def write_chunk(self, workspace_id, upload_id, offset, stream):
+        """
+        stream (リクエスト本文) を offset の位置から書き込む。最後のチャンクなら検証して完了させる。
+        戻り値は書き込み後の status()。
+        """
+        meta = self._load(workspace_id, upload_id)
+        _, part_path, _ = self._paths(workspace_id, upload_id)
+        if meta['complete']:
+            raise UploadError('Upload is already complete.', 409, offset=meta['size'])
+        with open(part_path, 'r+b') as part:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise UploadError('Another chunk of this upload is being written.', 409,
+                                      offset=os.path.getsize(part_path)) from None
+            current = os.fstat(part.fileno()).st_size
+            if offset != current:
+                raise UploadError(f'Expected Upload-Offset {current}.', 409, offset=current)
+            hasher = self._hasher(upload_id, part, current)
+            remaining = meta['size'] - current
+            written = 0
+            part.seek(current)
+            with stage('save_upload'):
+                for data in iter(lambda: stream.read(_READ_SIZE), b''):
+                    if written + len(data) > min(remaining, self.chunk_bytes):
+                        part.truncate(current)
+                        raise UploadError('Chunk is larger than the remaining size or the chunk limit.',
+                                          413, offset=current)
+                    part.write(data)
+                    hasher.update(data)
+                    written += len(data)
+                part.flush()
+            record_bytes('save_upload', written)
+            end = current + written
+            self._remember(upload_id, end, hasher)
+
+            if current < min(_HEADER_WINDOW, meta['size']) <= end:
+                part.seek(0)
+                if b'%PDF-' not in part.read(_HEADER_WINDOW):
+                    self.discard(workspace_id, upload_id)
+                    raise UploadError('File is not a PDF (no %PDF- header).', 415)
+            if end == meta['size']:
+                self._finish(workspace_id, meta, part, hasher.hexdigest())
+        return self._status(workspace_id, meta)
+
+    def _hasher(self, upload_id, part, offset):
+        with self._lock:
+            cached = self._hashers.pop(upload_id, None)
+        if cached and cached[0] == offset:
+            return cached[1]
+        # 前のチャンクが別のワーカーに届いた (または再開した) ので、受け取り済みの部分から求め直す
+        hasher = hashlib.sha256()
+        part.seek(0)
+        left = offset
+        while left:
+            data = part.read(min(_READ_SIZE, left))
+            if not data:
+                break
+            hasher.update(data)
+            left -= len(data)
+        return hasher
+
+    def _remember(self, upload_id, offset, hasher):
+        with self._lock:
+            self._hashers[upload_id] = (offset, hasher)
+            while len(self._hashers) > _MAX_HASHERS:
+                self._hashers.popitem(last=False)
+
+    def _finish(self, workspace_id, meta, part, digest):
+        upload_id = meta['upload_id']
+        _, part_path, pdf_path = self._paths(workspace_id, upload_id)
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        part.seek(max(0, meta['size'] - _TRAILER_WINDOW))
+        match = _STARTXREF.search(part.read())
+        if not match or int(match.group(1)) >= meta['size']:
+            self.discard(workspace_id, upload_id)
+            raise UploadError('File is not a complete PDF (no startxref/%%EOF at the end).', 422)
+        if meta['expected_sha256'] and meta['expected_sha256'] != digest:
+            self.discard(workspace_id, upload_id)
+            raise UploadError('SHA-256 of the received file does not match.', 422)
+        try:
+            with stage('parse'), open_pdf_reader(part_path) as reader:
+                page_count = len(reader.pages)
+        except Exception as e:
+            self.discard(workspace_id, upload_id)
+            raise UploadError(f'PDF could not be read: {e}', 422) from None
+        record_pages('parse', page_count)
+        os.replace(part_path, pdf_path)
+        meta.update(complete=True, sha256=digest, page_count=page_count)
+        self._save(workspace_id, meta)
+        logger.info('Upload %s complete: %d bytes, %d pages', upload_id, meta['size'], page_count)
+
+    def take(self, workspace_id, upload_id):
+        """
+        完了したアップロードを引き取る。{'upload_id', 'filename', 'path', 'sha256', 'page_count'} を返す。
+        PDFはそのままワークスペースに残り、状態ファイルだけを消す (同じアップロードは1回しか使えない)。
+        """
+        meta = self._load(workspace_id, upload_id)
+        if not meta['complete']:
+            raise UploadError('Upload is not complete.', 409, offset=self.status(workspace_id, upload_id)['offset'])
+        meta_path, _, pdf_path = self._paths(workspace_id, upload_id)
+        remove_quietly(meta_path)
+        return {'upload_id': upload_id, 'filename': meta['filename'], 'path': pdf_path,
+                'sha256': meta['sha256'], 'page_count': meta['page_count']}
+
+    def discard(self, workspace_id, upload_id):
+        with self._lock:
+            self._hashers.pop(upload_id, None)
+        for path in self._paths(workspace_id, upload_id):
+            remove_quietly(path)
@@ -0,0 +1,46 @@
+"""
+複数のモジュールで使う小さな関数 (ワーカー間で共有するファイルの後片付けなど)。
+"""
+import os
+
+
+def pid_alive(pid, start_token=None):
+    """
+    このホストで pid のプロセスが動いているか。start_token (process_start_token() の値) を
+    渡すと、pid が別のプロセスに再利用されていれば動いていないとみなす。
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # 他のユーザーのプロセス
+    return start_token is None or process_start_token(pid) in (None, start_token)
+
+
+def process_start_token(pid=None):
+    """
+    プロセスの起動時刻 (/proc/<pid>/stat の starttime)。pid と組にすれば再利用された pid と区別できる。
+    /proc のない環境や、もうないプロセスでは None。
+    """
+    try:
+        with open(f"/proc/{pid or os.getpid()}/stat", encoding='ascii') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 2番目の項目 (comm) は括弧に囲まれ空白を含みうるので、最後の ')' の後から数える (starttime は22番目)
+    return int(stat[stat.rindex(')') + 2:].split()[19])
+
+
+def remove_quietly(path):
+    """path を削除する。もうなければ何もしない。削除したら True を返す。"""
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def is_hex_id(value):
+    """uuid4().hex 形式 (32桁の小文字16進) の ID か。URL から受け取った ID をパスに使う前に確かめる。"""
+    return len(value) == 32 and all(c in '0123456789abcdef' for c in value)
@@ -0,0 +1,296 @@
+"""
+作業状態 (アップロードしたファイルの一覧、ページ順、分割位置など) をサーバー側に保存するストア。
+
+Cookie には署名付きのワークスペースIDだけを入れ、中身は SQLite に置く。
+WorkspaceSessionInterface を app.session_interface に設定すると、これまでどおり
+flask.session を使うだけでサーバー側に保存される。gunicorn の全ワーカーが同じ
+SQLite ファイルを参照するので、どのワーカーがリクエストを受けても同じ状態が見える。
+
+ページ順はページ数に比例して大きくなるので、セッションとは別に
+(文書番号, ページ番号) の組を詰めた配列 (array('I')) として保存し、
+並び替えは全体を送り直さず move / delete / insert の差分で更新できる。
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS workspaces (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS page_orders (
+    workspace_id TEXT PRIMARY KEY,
+    doc_ids TEXT NOT NULL,
+    pages BLOB NOT NULL
+);
+"""
+
+
+class WorkspaceStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10)
+        try:
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    @classmethod
+    def from_env(cls, name):
+        """name はアプリ名。アプリごとに別のDBファイルを使う。"""
+        root = os.environ.get('WORKSPACE_DIR', os.path.join(tempfile.gettempdir(), 'webtools_workspaces'))
+        return cls(os.path.join(root, f"{name}.sqlite3"))
+
+    def _connect(self):
+        # sqlite3 の接続はスレッドやfork後のプロセスをまたいで使えないので、スレッド・プロセスごとに持つ
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def check(self):
+        """
+        DBに接続できることを確かめる (起動時のウォームアップ用)。
+        fork 前のマスターで呼ばれても接続を持ち越さないよう、その場で閉じる。
+        """
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute('SELECT count(*) FROM workspaces').fetchone()
+        finally:
+            conn.close()
+
+    # --- ワークスペース本体 (セッションの中身) ---
+
+    def create(self):
+        workspace_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO workspaces (id, created, accessed, data) VALUES (?, ?, ?, ?)',
+            (workspace_id, now, now, '{}'))
+        return workspace_id
+
+    def load(self, workspace_id):
+        """ワークスペースの中身 (dict) を返す。存在しなければ None。"""
+        row = self._connect().execute(
+            'SELECT data FROM workspaces WHERE id = ?', (workspace_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, workspace_id, data):
+        self._connect().execute(
+            'INSERT INTO workspaces (id, created, accessed, data) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET accessed = excluded.accessed, data = excluded.data',
+            (workspace_id, time.time(), time.time(), json.dumps(data, ensure_ascii=False)))
+
+    def touch(self, workspace_id):
+        self._connect().execute('UPDATE workspaces SET accessed = ? WHERE id = ?', (time.time(), workspace_id))
+
+    def delete(self, workspace_id):
+        conn = self._connect()
+        conn.execute('DELETE FROM workspaces WHERE id = ?', (workspace_id,))
+        conn.execute('DELETE FROM page_orders WHERE workspace_id = ?', (workspace_id,))
+
+    def purge(self, older_than):
+        """最終アクセスが older_than (UNIX時刻) より前のワークスペースを削除し、そのIDを返す。"""
+        conn = self._connect()
+        ids = [row[0] for row in conn.execute('SELECT id FROM workspaces WHERE accessed < ?', (older_than,))]
+        for workspace_id in ids:
+            self.delete(workspace_id)
+        return ids
+
+    def accessed_times(self):
+        """{ワークスペースID: 最終アクセス時刻} を返す。"""
+        return dict(self._connect().execute('SELECT id, accessed FROM workspaces'))
+
+    # --- ページ順 ---
+
+    def get_page_order(self, workspace_id):
+        """[(doc_id, page_index), ...] を返す。"""
+        row = self._connect().execute(
+            'SELECT doc_ids, pages FROM page_orders WHERE workspace_id = ?', (workspace_id,)).fetchone()
+        if not row:
+            return []
+        doc_ids = json.loads(row[0])
+        pages = array('I')
+        pages.frombytes(row[1])
+        return [(doc_ids[pages[i]], pages[i + 1]) for i in range(0, len(pages), 2)]
+
+    def set_page_order(self, workspace_id, order):
+        """order は [(doc_id, page_index), ...]。不正な組があれば ValueError で、何も変更しない。"""
+        doc_ids = []
+        doc_index = {}
+        pages = array('I')
+        for doc_id, page_index in order:
+            _check_page(doc_id, page_index)
+            if doc_id not in doc_index:
+                doc_index[doc_id] = len(doc_ids)
+                doc_ids.append(doc_id)
+            pages.append(doc_index[doc_id])
+            pages.append(page_index)
+        self._write_page_order(self._connect(), workspace_id, doc_ids, pages)
+
+    def patch_page_order(self, workspace_id, ops):
+        """
+        ページ順に差分を適用する。ops は次の dict のリストで、先頭から順に適用する (位置は0始まり)。
+
+        - {'op': 'move', 'from': i, 'to': j, 'count': n}  i から n ページを、取り除いた後の位置 j に移す
+        - {'op': 'delete', 'index': i, 'count': n}
+        - {'op': 'insert', 'index': i, 'pages': [[doc_id, page_index], ...]}
+
+        範囲外の指定は ValueError。途中で失敗した場合は何も変更しない。
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')  # 同じワークスペースへの同時更新を直列化する
+        try:
+            row = conn.execute(
+                'SELECT doc_ids, pages FROM page_orders WHERE workspace_id = ?', (workspace_id,)).fetchone()
+            doc_ids = json.loads(row[0]) if row else []
+            pages = array('I')
+            if row:
+                pages.frombytes(row[1])
+            for op in ops:
+                _apply_op(op, doc_ids, pages)
+            self._write_page_order(conn, workspace_id, doc_ids, pages)
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return len(pages) // 2
+
+    def _write_page_order(self, conn, workspace_id, doc_ids, pages):
+        conn.execute(
+            'INSERT INTO page_orders (workspace_id, doc_ids, pages) VALUES (?, ?, ?) '
+            'ON CONFLICT(workspace_id) DO UPDATE SET doc_ids = excluded.doc_ids, pages = excluded.pages',
+            (workspace_id, json.dumps(doc_ids), pages.tobytes()))
+
+
+def _apply_op(op, doc_ids, pages):
+    if not isinstance(op, dict):
+        raise ValueError(f"invalid op: {op!r}")
+    length = len(pages) // 2
+    kind = op.get('op')
+    if kind == 'move':
+        start, to, count = int(op['from']), int(op['to']), int(op.get('count', 1))
+        if count < 1 or start < 0 or start + count > length or to < 0 or to > length - count:
+            raise ValueError(f"move out of range: {op}")
+        moved = pages[start * 2:(start + count) * 2]
+        del pages[start * 2:(start + count) * 2]
+        pages[to * 2:to * 2] = moved
+    elif kind == 'delete':
+        index, count = int(op['index']), int(op.get('count', 1))
+        if count < 1 or index < 0 or index + count > length:
+            raise ValueError(f"delete out of range: {op}")
+        del pages[index * 2:(index + count) * 2]
+    elif kind == 'insert':
+        index = int(op['index'])
+        if index < 0 or index > length:
+            raise ValueError(f"insert out of range: {op}")
+        inserted = array('I')
+        for doc_id, page_index in op['pages']:
+            _check_page(doc_id, page_index)
+            if doc_id not in doc_ids:
+                doc_ids.append(doc_id)
+            inserted.append(doc_ids.index(doc_id))
+            inserted.append(page_index)
+        pages[index * 2:index * 2] = inserted
+    else:
+        raise ValueError(f"unknown op: {op}")
+
+
+def _check_page(doc_id, page_index):
+    """ページ順の1組を検証する (page_index は array('I') に入る0以上の整数)。"""
+    if not isinstance(doc_id, str) or not doc_id:
+        raise ValueError(f"invalid document id: {doc_id!r}")
+    if isinstance(page_index, bool) or not isinstance(page_index, int) or not 0 <= page_index < 2 ** 32:
+        raise ValueError(f"invalid page index: {page_index!r}")
+
+
+class WorkspaceSession(CallbackDict, SessionMixin):
+    """中身が変更されたときだけ保存する。sid がワークスペースID。"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class WorkspaceSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='webtools-workspace')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                workspace_id = self._signer(app).unsign(cookie).decode('ascii')
+            except BadSignature:
+                workspace_id = None
+            data = self.store.load(workspace_id) if workspace_id else None
+            if data is not None:
+                return WorkspaceSession(data, sid=workspace_id)
+        return WorkspaceSession(sid=None, new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session and session.sid and not session.new and session.modified:
+            # session.clear() された
+            self.store.delete(session.sid)
+            response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session and session.sid is None:
+            return  # 保存するものがない
+
+        if session.sid is None:
+            session.sid = self.store.create()
+        if session.modified or session.new:
+            self.store.save(session.sid, dict(session))
+        else:
+            self.store.touch(session.sid)
+
+        if session.new or session.modified:
+            response.vary.add('Cookie')
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode('ascii'),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def ensure_workspace_id(session, store):
+    """ページ順など、セッション以外のテーブルに書く前にワークスペースIDを確定させる。"""
+    if session.sid is None:
+        session.sid = store.create()
+        session.modified = True  # Cookie を発行させる
+    return session.sid
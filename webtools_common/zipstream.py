@@ -0,0 +1,97 @@
+"""
+ZIPをメモリに溜めずに、エントリを1つ書くたびにバイト列として順に返すジェネレータ。
+
+zipfile は seek できない出力先にも書けるので、書かれたバイトを受け取るだけの
+出力先を渡し、エントリを追加するたびにその中身を取り出して yield する。
+保持するのは「いま書いているエントリ1つぶん」だけになる。エントリの中身にファイルのパスを
+渡すと、ファイルを少しずつ読んで書くので、大きなファイルでもエントリ全体をメモリに載せない。
+"""
+import os
+import time
+import zipfile
+from urllib.parse import quote
+
+from webtools_common.instrumentation import STAGE_SECONDS, record_bytes, stage
+
+COMPRESSION = {
+    'stored': zipfile.ZIP_STORED,      # PDFはほとんど縮まないので通常はこちらで十分
+    'deflated': zipfile.ZIP_DEFLATED,
+}
+
+_READ_SIZE = 1024 * 1024
+
+
+class _ChunkSink:
+    """zipfile の出力先。tell() はできるが seek() はできない書き込み専用ストリーム。"""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(entries, compression='stored'):
+    """
+    entries は (ZIP内のファイル名, bytes またはファイルのパス) を順に返すイテラブル (ジェネレータ推奨)。
+    ZIPのバイト列をエントリごとに (パスなら読んだ 1MB ごとに) yield する。
+    compression は 'stored' か 'deflated'。
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=COMPRESSION[compression]) as zipf:
+        for name, data in entries:
+            if isinstance(data, (str, os.PathLike)):
+                yield from _write_file(zipf, sink, name, data)
+                continue
+            with stage('zip', nbytes=len(data)):
+                zipf.writestr(name, data)
+            del data  # 次のエントリを作る前に手放す
+            yield sink.drain()
+    # 中央ディレクトリ
+    yield sink.drain()
+
+
+def _write_file(zipf, sink, name, path):
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = zipf.compression
+    info.external_attr = 0o600 << 16
+    # 大きさを先に入れておくと、4GB を超えるときに zipfile が ZIP64 で書く
+    info.file_size = os.path.getsize(path)
+    seconds = 0.0
+    with open(path, 'rb') as src, zipf.open(info, 'w') as dst:
+        for data in iter(lambda: src.read(_READ_SIZE), b''):
+            start = time.perf_counter()
+            dst.write(data)
+            seconds += time.perf_counter() - start  # 受け手を待っている時間は含めない
+            yield sink.drain()
+    # 段階の時間はまとめて1回記録する (チャンクごとに記録するとヒストグラムの件数が増えるだけなので)
+    STAGE_SECONDS.observe(seconds, stage='zip')
+    record_bytes('zip', info.file_size)
+    yield sink.drain()
+
+
+def write_zip(path, entries, compression='stored'):
+    """iter_zip の結果をファイルに書き出す。"""
+    with open(path, 'wb') as f:
+        for chunk in iter_zip(entries, compression):
+            f.write(chunk)
+
+
+def attachment_header(filename):
+    """日本語のファイル名でも崩れない Content-Disposition ヘッダーの値を返す。"""
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download.zip'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"